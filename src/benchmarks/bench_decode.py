@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""
+ IoT Gateway Modbus
+ (C)2020 - Michael Feil
+ This is distributed under MIT license, see LICENSE
+"""
+
+"""bench_decode.py
+
+Function: Throughput of decoding register frames to typed values, per value Python conversion against the bulk decoding of g_decode.
+
+A frame holds 120 registers (the size of a merged read of the read plan), split into members of --registers registers each.
+Variants:
+    per_value: every value is combined from its registers in Python and scaled, as done by consumers of the raw results
+    struct: g_decode.decode_frame, one struct.Struct.unpack_from per member
+    numpy: g_decode.decode_frame with NumPy views, only if NumPy is installed (used from g_decode.NUMPY_MIN_VALUES values per member)
+Reported: decoded values per second and microseconds per frame.
+
+Usage: python benchmarks/bench_decode.py --registers 2 8 120 --duration 2
+"""
+
+# [START includes]
+import argparse
+import os
+import random
+import struct
+import sys
+import time
+
+dirname = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(dirname)                                #import the gateway modules from src
+
+import g_decode
+from g_decode import decode_frame, DATA_TYPES
+# [End includes]
+
+FRAME_REGISTERS = 120
+
+
+def decode_per_value(frame, result):
+    """reference: per value conversion in Python"""
+    decoded = list()
+    for request in frame["members"]:
+        start = request["startadress"] - frame["startadress"]
+        registers = result[start:start + request["quantity_of_x"]]
+        code, words, unused_dtype = DATA_TYPES[request["data_type"]]
+        if request.get("word_order", "big") == "little":
+            registers = [word for index in range(0, len(registers), words) for word in reversed(registers[index:index + words])]
+        values = list()
+        for index in range(0, len(registers), words):
+            raw = struct.pack(">{}H".format(words), *registers[index:index + words])
+            values.append(struct.unpack(">" + code, raw)[0] * request.get("scale", 1) + request.get("offset", 0))
+        decoded.append((request, values))
+    return decoded
+
+
+def make_frame(data_type, registers_per_member, word_order):
+    members = [{"startadress": start, "quantity_of_x": registers_per_member, "data_type": data_type, "word_order": word_order, "scale": 0.1}
+               for start in range(0, FRAME_REGISTERS - registers_per_member + 1, registers_per_member)]
+    result = tuple(random.randint(0, 0xffff) for unused in range(FRAME_REGISTERS))
+    return {"startadress": 0, "members": members}, result
+
+
+def measure(function, frame, result, duration):
+    frames = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for unused in range(100):
+            function(frame, result)
+        frames += 100
+    elapsed = time.perf_counter() - start
+    values = sum(len(values) for unused_request, values in function(frame, result))
+    return values * frames / elapsed, 1e6 * elapsed / frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--registers", type=int, nargs="+", default=[2, 8, 120], help="registers per member")
+    parser.add_argument("--data-types", nargs="+", default=["int32", "float32", "float64"])
+    parser.add_argument("--word-order", choices=["big", "little"], default="big")
+    parser.add_argument("--duration", type=float, default=2)
+    args = parser.parse_args()
+    random.seed(0)
+
+    numpy = g_decode.numpy
+    variants = ["per_value", "struct"] + (["numpy"] if numpy is not None else [])
+    print("NumPy {}".format("installed" if numpy is not None else "not installed"))
+    print("{:>8} {:>10} {:>10} {:>14} {:>10}".format("type", "registers", "variant", "values_per_s", "us_frame"))
+
+    for data_type in args.data_types:
+        for registers in args.registers:
+            registers -= registers % DATA_TYPES[data_type][1]
+            if registers <= 0:
+                continue
+            frame, result = make_frame(data_type, registers, args.word_order)
+            for variant in variants:
+                if variant == "per_value":
+                    function = decode_per_value
+                else:
+                    g_decode.numpy = numpy if variant == "numpy" else None
+                    g_decode.NUMPY_MIN_VALUES = 0 if variant == "numpy" else 64
+                    function = decode_frame
+                values_per_s, us_frame = measure(function, frame, result, args.duration)
+                print("{:>8} {:>10} {:>10} {:>14.0f} {:>10.1f}".format(data_type, registers, variant, values_per_s, us_frame))
+
+
+if __name__ == "__main__":
+    main()
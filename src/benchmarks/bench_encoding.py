@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""
+ IoT Gateway Modbus
+ (C)2020 - Michael Feil
+ This is distributed under MIT license, see LICENSE
+"""
+
+"""bench_encoding.py
+
+Function: Size and CPU time of telemetry batches: indented JSON against the binary columnar format of g_telemetry_encoder,
+each uncompressed, with gzip level 9 and with LZMA preset 9 (the "compression" choices of setup_mqtt.json).
+
+A batch holds --batch samples of --names operations, sampled in turn every 100 ms: 2 registers changing slowly,
+every fourth operation decoded to float32 values and one failed request per 50 samples.
+Reported: bytes per batch and per sample, encoding with compression and decoding with g_telemetry_decoder in ms per batch.
+Every binary batch is checked to decode to the samples (timestamps in milliseconds).
+
+Usage: python benchmarks/bench_encoding.py --batch 10 100 250 --names 20
+"""
+
+# [START includes]
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+dirname = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(dirname)                                #import the gateway modules from src
+
+import g_mqtt_client
+from g_telemetry_decoder import decode_payload
+# [End includes]
+
+REQUEST_NOT_POSSIBLE = [99999, "modbus_request_not_possible"]
+
+
+def make_samples(count, names, seed=0):
+    """samples as published by Modbus_reader.publish_result"""
+    rng = random.Random(seed)
+    registers = [[rng.randint(0, 4000), rng.randint(0, 65535)] for unused in range(names)]
+    now = 1600000000.0
+    samples = list()
+    for index in range(count):
+        operation = index % names
+        now += 0.1 + rng.random() * 0.01
+        if rng.random() < 0.02:
+            result = REQUEST_NOT_POSSIBLE
+        elif operation % 4 == 3:
+            result = [round(rng.gauss(230.0, 2.0), 6), round(rng.gauss(50.0, 0.05), 6)]
+        else:
+            registers[operation] = [max(0, value + rng.randint(-3, 3)) for value in registers[operation]]
+            result = list(registers[operation])
+        samples.append({"na": "sensor_{:02d}_power_{}".format(operation, 100 + 2 * operation), "res": result, "sl": 1 + operation % 8, "time": now})
+    return samples
+
+
+def measure(function, duration):
+    runs = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        function()
+        runs += 1
+    return 1000 * (time.perf_counter() - start) / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch", type=int, nargs="+", default=[10, 100, 250], help="samples per batch (puffer_lengh + 1)")
+    parser.add_argument("--names", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=1)
+    args = parser.parse_args()
+
+    print("{:>6} {:>8} {:>6} {:>10} {:>12} {:>12} {:>12}".format("batch", "encoding", "codec", "bytes", "bytes_sample", "encode_ms", "decode_ms"))
+    for batch in args.batch:
+        samples = make_samples(batch, args.names)
+        for encoding in ("json", "binary"):
+            for compression in ("none", "gzip", "lzma"):
+                g_mqtt_client.ENCODING = encoding
+                g_mqtt_client.COMPRESSION = compression
+                payload = g_mqtt_client.encode_telemetry(samples)
+                size = len(payload.encode("utf-8") if isinstance(payload, str) else payload)
+
+                decoded = decode_payload(payload)
+                if encoding == "binary":
+                    expected = [dict(sample, time=round(sample["time"] * 1000) / 1000.0) for sample in samples]
+                    if json.dumps(decoded) != json.dumps(expected):
+                        raise AssertionError("binary batch does not decode to its samples")
+
+                encode_ms = measure(lambda: g_mqtt_client.encode_telemetry(samples), args.duration)
+                decode_ms = measure(lambda: decode_payload(payload), args.duration)
+                print("{:>6} {:>8} {:>6} {:>10} {:>12.1f} {:>12.3f} {:>12.3f}".format(batch, encoding, compression, size, size / float(batch), encode_ms, decode_ms))
+
+
+if __name__ == "__main__":
+    main()
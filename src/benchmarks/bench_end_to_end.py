@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+"""
+ IoT Gateway Modbus
+ (C)2020 - Michael Feil
+ This is distributed under MIT license, see LICENSE
+"""
+
+"""bench_end_to_end.py
+
+Function: End to end throughput of the gateway without hardware, from the simulated slaves to the stand-in MQTT broker.
+
+The gateway (Scheduler, Modbus_readers, formatted_publish_message and handle_mqtt, as started by startup_solution.py) runs
+in a fresh subprocess per configuration with its own setup_modbus.json and setup_mqtt.json, see sim_slaves.py for the bus and broker.
+Every configuration has N read operations of 2 holding registers, spread over --slaves slaves with sampling intervals out of --intervals.
+
+Reported over --duration seconds after --warmup:
+    reads_s: published results without error per second
+    e2e_p50_ms, e2e_p99_ms: time from reading a value to its arrival at the broker
+    errors: published error results (e.g. not responding slaves)
+    cpu_pct, rss_mib: CPU usage (100 = one core) and resident memory of the gateway process
+    bytes_s, bytes_value: MQTT bytes published per second and per published result
+--aggregation publishes the statistics per window of that many seconds instead of every result (see g_aggregation), reads_s then counts statistics samples.
+--output saves the results as json, --baseline compares with saved results: change in percent per value.
+
+Usage: python benchmarks/bench_end_to_end.py --operations 10 100 1000 2000 --duration 20 --baudrate 19200
+Requires Linux (pseudo terminals) and the openssl command.
+"""
+
+# [START includes]
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+dirname = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(dirname)                                #import the gateway modules from src
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sim_slaves import SlaveFarm, StandInBroker, make_certificate
+from g_telemetry_decoder import decode_payload, register_dictionary
+# [End includes]
+
+ERROR_CODES = (99998, 99999) #first element of the published error results of g_modbus
+COLUMNS = ["operations", "reads_s", "e2e_p50_ms", "e2e_p99_ms", "errors", "cpu_pct", "rss_mib", "bytes_s", "bytes_value"]
+
+
+def rss_mib():
+    """resident set size of this process in MiB"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2.0 ** 20
+
+
+def run_single(args):
+    """runs the gateway with the setup files in args.workdir, prints the measurement window and resources as json"""
+    import g_shared_utils as su
+    su.setup_mqtt_filepath = os.path.join(args.workdir, "setup_mqtt.json")
+    su.setup_modbus_filepath = os.path.join(args.workdir, "setup_modbus.json")
+    su.setup_modbus_temp_filepath = os.path.join(args.workdir, "setup_modbus_temp.json")
+    su.learned_timeouts_filepath = os.path.join(args.workdir, "learned_timeouts.json")
+    logging.disable(getattr(logging, args.log_level)) #messages up to this level are dropped
+
+    import startup_solution #reads the setup files on import
+    gateway = threading.Thread(target=startup_solution.main_asyncio if args.runtime == "asyncio" else startup_solution.main)
+    gateway.daemon = True
+    gateway.start()
+
+    time.sleep(args.warmup)
+    window_start = time.time()
+    cpu_start = time.process_time()
+    time.sleep(args.duration)
+    cpu_seconds = time.process_time() - cpu_start
+    window_end = time.time()
+    result = {
+        "window_start": window_start,
+        "window_end": window_end,
+        "cpu_pct": round(100 * cpu_seconds / (window_end - window_start), 1),
+        "rss_mib": round(rss_mib(), 1),
+    }
+    print(json.dumps(result))
+    sys.stdout.flush()
+    time.sleep(args.drain) #results of the window still on their way to the broker
+    os._exit(0)
+
+
+def write_setup_files(workdir, farm, broker, certfile, operations, args):
+    """setup_modbus.json with operations reads on the farm and setup_mqtt.json for the broker"""
+    rng = random.Random(operations)
+    slave_ids = farm.slave_ids + [max(farm.slave_ids) + 1 + index for index in range(args.dead_slaves)] #dead slaves are not in the farm
+    slaveconfig = dict()
+    for index in range(operations):
+        slave_id = slave_ids[index % len(slave_ids)]
+        slave = slaveconfig.setdefault("slave{}".format(slave_id), {"slave_id": slave_id, "operations": dict()})
+        number = len(slave["operations"])
+        slave["operations"]["op{}".format(number)] = {
+            "startadress": 2 * number,
+            "function_code": 3,
+            "display_name": "s{}_{}".format(slave_id, number),
+            "sampling_interval": rng.choice(args.intervals),
+            "quantity_of_x": 2,
+        }
+        if args.aggregation > 0:
+            slave["operations"]["op{}".format(number)]["aggregation"] = {"window": args.aggregation}
+    setup_modbus = {"port_config": farm.port_config(timeout_connection=args.timeout), "slaveconfig": slaveconfig}
+
+    secret_file = os.path.join(workdir, "jwt_secret")
+    with open(secret_file, "w") as f:
+        f.write("stand-in broker ignores the password")
+    setup_mqtt = {
+        "jwt_config": {"algorithm": "HS256", "ca_certs": certfile, "private_key_file": secret_file, "jwt_expires_minutes": 60},
+        "cloud_destination": {"cloud_region": "bench", "device_id": "bench", "project_id": "bench", "registry_id": "bench",
+                              "mqtt_bridge_hostname": "localhost", "mqtt_bridge_port": broker.port, "keepalive": 60},
+        "paramteter_settings": {"puffer_lengh": args.puffer_length, "compression": args.compression, "encoding": args.encoding, "metrics_interval": 0,
+                                "compression_dictionary": args.compression_dictionary,
+                                "fast_start": True, "runtime": args.runtime},
+        "global_topics": {"topic_event": "events", "topic_state": "state"},
+    }
+    for name, content in (("setup_modbus.json", setup_modbus), ("setup_mqtt.json", setup_mqtt)):
+        with open(os.path.join(workdir, name), "w") as f:
+            json.dump(content, f, indent=4)
+
+
+def evaluate(publishes, window, operations):
+    """metrics of the publishes received by the broker in the measurement window"""
+    window_start, window_end = window["window_start"], window["window_end"]
+    duration = window_end - window_start
+    latencies = list()
+    errors = 0
+    published_bytes = 0
+    for arrival, topic, payload, length in publishes: #dictionaries of "compression": "adaptive"
+        if topic.endswith("/state") and b"compression_dictionary" in payload:
+            register_dictionary(json.loads(payload.decode("utf-8"))["compression_dictionary"]["data"])
+    for arrival, topic, payload, length in publishes:
+        if window_start <= arrival < window_end:
+            published_bytes += length
+        if not topic.endswith("/events"):
+            continue
+        for result in decode_payload(payload):
+            if not window_start <= result["time"] < window_end:
+                continue
+            if isinstance(result["res"], list) and result["res"][:1] and result["res"][0] in ERROR_CODES:
+                errors += 1
+            else:
+                latencies.append(arrival - result["time"])
+
+    latencies.sort()
+    values = len(latencies) + errors
+    return {
+        "operations": operations,
+        "reads_s": round(len(latencies) / duration, 1),
+        "e2e_p50_ms": round(1000 * latencies[len(latencies) // 2], 1) if latencies else None,
+        "e2e_p99_ms": round(1000 * latencies[int(len(latencies) * 0.99)], 1) if latencies else None,
+        "errors": errors,
+        "cpu_pct": window["cpu_pct"],
+        "rss_mib": window["rss_mib"],
+        "bytes_s": round(published_bytes / duration),
+        "bytes_value": round(published_bytes / float(values), 1) if values else None,
+    }
+
+
+def print_row(row, baseline=None):
+    cells = list()
+    for column in COLUMNS:
+        value = row[column]
+        if baseline is not None and column != "operations" and value is not None and baseline.get(column):
+            value = "{} ({:+.0f}%)".format(value, 100.0 * (value - baseline[column]) / baseline[column])
+        cells.append("{:>16}".format(str(value)))
+    print(" ".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--operations", type=int, nargs="+", default=[10, 100, 1000, 2000])
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--warmup", type=float, default=15, help="seconds before the window, covers the startup state messages")
+    parser.add_argument("--drain", type=float, default=3, help="seconds the gateway keeps running after the window")
+    parser.add_argument("--slaves", type=int, default=10)
+    parser.add_argument("--intervals", type=float, nargs="+", default=[1, 2, 5, 10], help="sampling intervals of the operations")
+    parser.add_argument("--baudrate", type=int, default=19200)
+    parser.add_argument("--turnaround", type=float, default=0.005, help="response delay of the slaves in seconds")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="probability of a missing response")
+    parser.add_argument("--corrupt-rate", type=float, default=0.0, help="probability of a response with wrong CRC")
+    parser.add_argument("--dead-slaves", type=int, default=0, help="configured slaves that never respond")
+    parser.add_argument("--timeout", type=float, default=0.5, help="timeout_connection of the port")
+    parser.add_argument("--puffer-length", type=int, default=10)
+    parser.add_argument("--compression", choices=["gzip", "lzma", "none", "adaptive"], default="gzip")
+    parser.add_argument("--compression-dictionary", action="store_true", help="preset dictionary with --compression adaptive")
+    parser.add_argument("--encoding", choices=["json", "binary"], default="json")
+    parser.add_argument("--aggregation", type=float, default=0, help="seconds per aggregation window of every operation, 0: every result")
+    parser.add_argument("--runtime", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING"], default="INFO", help="gateway log messages up to this level are dropped")
+    parser.add_argument("--output", help="save the results as json")
+    parser.add_argument("--baseline", help="compare with results saved by --output")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        run_single(args)
+        return
+
+    baseline = dict()
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {row["operations"]: row for row in json.load(f)}
+
+    rows = list()
+    with tempfile.TemporaryDirectory() as workdir:
+        certfile, keyfile = make_certificate(workdir)
+        broker = StandInBroker(certfile, keyfile)
+        broker.start()
+        farm = SlaveFarm(range(1, args.slaves + 1), baudrate=args.baudrate, turnaround=args.turnaround,
+                         drop_rate=args.drop_rate, corrupt_rate=args.corrupt_rate)
+        farm.start()
+
+        print(" ".join("{:>16}".format(column) for column in COLUMNS))
+        for operations in args.operations:
+            write_setup_files(workdir, farm, broker, certfile, operations, args)
+            broker.take_publishes()
+            command = [sys.executable, os.path.abspath(__file__), "--single", "--workdir", workdir, "--runtime", args.runtime,
+                       "--duration", str(args.duration), "--warmup", str(args.warmup), "--drain", str(args.drain), "--log-level", args.log_level]
+            output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, check=True).stdout
+            window = json.loads(output.strip().splitlines()[-1])
+            row = evaluate(broker.take_publishes(), window, operations)
+            rows.append(row)
+            print_row(row, baseline.get(operations))
+
+        farm.stop()
+        broker.stop()
+        print("slave farm: {}".format(farm.counters))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""
+ IoT Gateway Modbus
+ (C)2020 - Michael Feil 
+ This is distributed under MIT license, see LICENSE
+"""
+
+"""bench_scheduler.py
+
+Function: Compares the thread per operation RepeatedFunction scheduling with the single thread TimerHeap of g_modbus.
+
+Every variant runs in a fresh subprocess and schedules N operations with sampling intervals between 0.5s and 10s.
+Reported: threads, resident memory, cpu seconds, runs and lateness of the runs against their ideal deadline.
+
+Usage: python benchmarks/bench_scheduler.py --operations 100 1000 2000 --duration 20
+"""
+
+# [START includes]
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+dirname = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(dirname)                                #import the gateway modules from src
+
+from g_modbus import RepeatedFunction, TimerHeap
+from g_shared_utils import logger
+# [End includes]
+
+
+def rss_kib():
+    """resident set size of this process in KiB"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+class Probe(object):
+    """records the lateness of every run of one scheduled operation against first run + k * interval"""
+
+    def __init__(self, interval, lateness):
+        self.interval = interval
+        self.lateness = lateness
+        self.first = None
+        self.count = 0
+
+    def __call__(self, *unused_args):
+        now = time.monotonic()
+        if self.first is None:
+            self.first = now
+        else:
+            self.lateness.append(now - (self.first + self.count * self.interval))
+        self.count += 1
+
+
+def run_single(variant, operations, duration):
+    """runs one variant in this process and prints the result as json"""
+    logger.setLevel(logging.WARNING)
+    random.seed(0)
+    intervals = [random.choice([0.5, 1, 2, 5, 10]) for unused in range(operations)]
+    lateness = list()
+    probes = [Probe(interval, lateness) for interval in intervals]
+
+    rss_start = rss_kib()
+    cpu_start = time.process_time()
+
+    stop_event = threading.Event()
+    if variant == "repeated_function":
+        threads = [RepeatedFunction(interval, probe) for interval, probe in zip(intervals, probes)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+    else:
+        timer_heap = TimerHeap()
+        first_run = time.monotonic()
+        for interval, probe in zip(intervals, probes):
+            probe.first = first_run #deadlines of the heap are known in advance
+            timer_heap.schedule(interval, probe, first_run=first_run)
+        engine = threading.Thread(target=timer_heap.run, args=(stop_event,))
+        engine.daemon = True
+        engine.start()
+
+    time.sleep(duration / 2)
+    thread_count = threading.active_count()
+    time.sleep(duration / 2)
+    rss_end = rss_kib()
+    cpu_seconds = time.process_time() - cpu_start
+
+    if variant == "repeated_function":
+        for thread in threads:
+            thread.stop_event.set()
+    else:
+        stop_event.set()
+        timer_heap.wakeup()
+
+    lateness.sort()
+    result = {
+        "variant": variant,
+        "operations": operations,
+        "threads": thread_count,
+        "rss_kib": rss_end - rss_start,
+        "cpu_s": round(cpu_seconds, 3),
+        "runs": sum(probe.count for probe in probes),
+        "lateness_p50_ms": round(1000 * lateness[len(lateness) // 2], 3) if lateness else None,
+        "lateness_p99_ms": round(1000 * lateness[int(len(lateness) * 0.99)], 3) if lateness else None,
+    }
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--operations", type=int, nargs="+", default=[100, 1000, 2000])
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--single", choices=["repeated_function", "timer_heap"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        run_single(args.single, args.operations[0], args.duration)
+        return
+
+    print("{:>18} {:>10} {:>8} {:>10} {:>8} {:>8} {:>12} {:>12}".format(
+        "variant", "operations", "threads", "rss_kib", "cpu_s", "runs", "late_p50_ms", "late_p99_ms"))
+    for operations in args.operations:
+        for variant in ("repeated_function", "timer_heap"):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), "--single", variant,
+                                     "--operations", str(operations), "--duration", str(args.duration)],
+                                    stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+            r = json.loads(output.strip().splitlines()[-1])
+            print("{variant:>18} {operations:>10} {threads:>8} {rss_kib:>10} {cpu_s:>8} {runs:>8} {lateness_p50_ms:>12} {lateness_p99_ms:>12}".format(**r))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""
+ IoT Gateway Modbus
+ (C)2020 - Michael Feil
+ This is distributed under MIT license, see LICENSE
+"""
+
+"""bench_tcp.py
+
+Function: Modbus TCP and Modbus RTU over TCP transports of g_transport against the in-process TcpSlaveServer of sim_slaves.py.
+
+Per framing, a TcpMaster is acquired from the connection_pool (as by the Modbus_readers) and first checked:
+    - FC3 reads return the registers of the simulated slaves
+    - FC16 writes are read back with FC3
+    - pipelined FC3/FC16 requests return the results in the order of the requests, ports to the same server share one connection
+Then --requests FC3 reads of --registers registers are executed with each --pipeline depth (max_pipeline of the port),
+RTU over TCP has no transaction ids and is never pipelined.
+Reported: requests per second, milliseconds per request and the most requests the server received before answering.
+
+Usage: python benchmarks/bench_tcp.py --pipeline 1 2 4 8 --latency 0.002
+"""
+
+# [START includes]
+import argparse
+import os
+import sys
+import time
+
+dirname = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(dirname)                                #import the gateway modules from src
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from sim_slaves import TcpSlaveServer
+from g_transport import connection_pool
+# [End includes]
+
+COLUMNS = ["framing", "max_pipeline", "requests_s", "ms_request", "pipelined"]
+
+
+def read_request(slave_id, startadress, quantity):
+    return {"slave_id": slave_id, "function_code": 3, "startadress": startadress, "quantity_of_x": quantity}
+
+
+def expected_registers(slave_id, startadress, quantity):
+    return tuple((slave_id * 1000 + address) & 0xffff for address in range(startadress, startadress + quantity))
+
+
+def check(server, args):
+    """FC3, FC16 and pipelining through the connection_pool, raises AssertionError on a wrong result"""
+    port_config = server.port_config(max_pipeline=max(args.pipeline))
+    master = connection_pool.acquire(port_config)
+    shared = connection_pool.acquire(dict(port_config)) #a second port to the same server
+    try:
+        assert shared is master, "ports to the same server do not share the connection"
+        for slave_id in server.slave_ids:
+            result = master.execute(slave_id, 3, 100, args.registers)
+            assert result == expected_registers(slave_id, 100, args.registers), "FC3 of slave {}: {}".format(slave_id, result)
+
+            values = [slave_id, 0x7fff, 0, 12345]
+            master.execute(slave_id, 16, 1500, output_value=values)
+            result = master.execute(slave_id, 3, 1500, len(values))
+            assert list(result) == values, "FC16 of slave {} read back as {}".format(slave_id, result)
+
+        requests = list()
+        for index, slave_id in enumerate(server.slave_ids * 4):
+            requests.append(read_request(slave_id, 10 * index, args.registers))
+            requests.append({"slave_id": slave_id, "function_code": 16, "startadress": 1600 + index, "output_value": [index]})
+        results = master.execute_pipelined(requests, port_config["max_pipeline"])
+        for request, result in zip(requests, results):
+            if request["function_code"] == 3:
+                expected = expected_registers(request["slave_id"], request["startadress"], request["quantity_of_x"])
+            else:
+                expected = (request["startadress"], 1)
+            assert result == expected, "pipelined {} returned {}".format(request, result)
+        assert server.counters["connections"] == 1, "{} connections instead of one".format(server.counters["connections"])
+    finally:
+        connection_pool.release(shared)
+        connection_pool.release(master)
+
+
+def measure(server, max_pipeline, args):
+    master = connection_pool.acquire(server.port_config(max_pipeline=max_pipeline))
+    try:
+        slave_ids = server.slave_ids
+        requests = [read_request(slave_ids[index % len(slave_ids)], 0, args.registers) for index in range(args.requests)]
+        server.counters["pipelined"] = 0
+        start = time.perf_counter()
+        results = master.execute_pipelined(requests, max_pipeline)
+        elapsed = time.perf_counter() - start
+    finally:
+        connection_pool.release(master)
+
+    assert not any(isinstance(result, Exception) for result in results)
+    return {
+        "framing": server.framing,
+        "max_pipeline": max_pipeline if server.framing == "tcp" else 1,
+        "requests_s": round(len(requests) / elapsed),
+        "ms_request": round(1000 * elapsed / len(requests), 3),
+        "pipelined": server.counters["pipelined"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--framing", choices=["tcp", "rtu_over_tcp"], nargs="+", default=["tcp", "rtu_over_tcp"])
+    parser.add_argument("--pipeline", type=int, nargs="+", default=[1, 2, 4, 8], help="max_pipeline of the port, 1 to 16")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--registers", type=int, default=10, help="registers per FC3 read")
+    parser.add_argument("--slaves", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.002, help="seconds from a request to its response, the network round trip")
+    parser.add_argument("--turnaround", type=float, default=0.0, help="seconds the server needs per request")
+    args = parser.parse_args()
+
+    print(" ".join("{:>14}".format(column) for column in COLUMNS))
+    for framing in args.framing:
+        server = TcpSlaveServer(range(1, args.slaves + 1), framing=framing, latency=args.latency, turnaround=args.turnaround)
+        server.start()
+        check(server, args)
+        for max_pipeline in (args.pipeline if framing == "tcp" else [1]):
+            row = measure(server, max_pipeline, args)
+            print(" ".join("{:>14}".format(str(row[column])) for column in COLUMNS))
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
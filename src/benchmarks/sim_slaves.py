@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+
+"""
+ IoT Gateway Modbus
+ (C)2020 - Michael Feil
+ This is distributed under MIT license, see LICENSE
+"""
+
+"""sim_slaves.py
+
+Function: Test bench without hardware: simulated Modbus RTU slaves on a pseudo terminal, an in-process Modbus TCP server and a stand-in MQTT broker.
+
+SlaveFarm answers Modbus RTU requests of the gateway on the other end of a pseudo terminal pair (Linux), with the
+timing of a real serial line: every response is delayed by the wire time of request and response at the emulated
+baudrate plus the turnaround of the slave. Failures can be injected: dropped responses, corrupted CRCs and dead slaves.
+
+TcpSlaveServer answers Modbus TCP (MBAP header) or Modbus RTU over TCP requests on 127.0.0.1 with the same slaves,
+pipelined requests are answered in order, each after the emulated network latency.
+
+StandInBroker accepts the MQTT 3.1.1 connection of the gateway (TLS with a self signed certificate from make_certificate)
+and records every PUBLISH with its time of arrival and size, without forwarding anything.
+
+Used by bench_end_to_end.py and bench_tcp.py.
+"""
+
+# [START includes]
+import os
+import random
+import select
+import socket
+import ssl
+import struct
+import subprocess
+import threading
+import time
+import tty
+
+import modbus_tk.defines as cst
+from modbus_tk import modbus, modbus_rtu, modbus_tcp
+# [End includes]
+
+BLOCK_SIZE = 2000 #registers, coils and discrete inputs per block of every slave, starting at address 0
+
+
+def char_bits(parity="N", stopbits=1):
+    """bits on the wire per byte: start bit, 8 data bits, parity bit and stop bits"""
+    return 1 + 8 + (0 if parity == "N" else 1) + stopbits
+
+
+def make_databank(slave_ids):
+    """slaves with BLOCK_SIZE holding registers (slave_id * 1000 + address), input registers (address), coils and discrete inputs"""
+    databank = modbus.Databank(error_on_missing_slave=False) #dead slaves do not respond
+    for slave_id in slave_ids:
+        slave = databank.add_slave(slave_id)
+        slave.add_block("h", cst.HOLDING_REGISTERS, 0, BLOCK_SIZE)
+        slave.add_block("i", cst.ANALOG_INPUTS, 0, BLOCK_SIZE)
+        slave.add_block("c", cst.COILS, 0, BLOCK_SIZE)
+        slave.add_block("d", cst.DISCRETE_INPUTS, 0, BLOCK_SIZE)
+        slave.set_values("h", 0, [(slave_id * 1000 + address) & 0xffff for address in range(BLOCK_SIZE)])
+        slave.set_values("i", 0, [address for address in range(BLOCK_SIZE)])
+    return databank
+
+
+def request_length(buffer):
+    """length of the RTU request starting buffer, None if not yet known, 0 if not a request"""
+    if len(buffer) < 2:
+        return None
+    function_code = buffer[1]
+    if function_code in (1, 2, 3, 4, 5, 6):
+        return 8
+    if function_code in (15, 16):
+        return 9 + buffer[6] if len(buffer) >= 7 else None
+    return 0
+
+
+# [Start Class SlaveFarm]
+class SlaveFarm(object):
+    """
+    Simulated Modbus RTU slaves sharing one pseudo terminal as bus
+        ...
+
+    Attributes
+    ----------
+    slave_ids : list
+        slaves answering, each with holding registers, input registers, coils and discrete inputs at 0 to BLOCK_SIZE
+    baudrate, parity, stopbits : int, str, int
+        emulated serial line, used for the delay of every response
+    turnaround : float
+        seconds between the end of a request and the start of the response
+    drop_rate, corrupt_rate : float
+        probability of a response not being sent, or being sent with a wrong CRC
+    counters : dict
+        requests, responses, dropped, corrupted and unanswered (no such slave)
+
+    Methods
+    -------
+    start()
+        Opens the pseudo terminal and answers requests in a thread, returns the device path for the gateway
+    port_config(**settings)
+        Returns a port_config of setup_modbus.json for this bus
+    stop()
+        Ends the thread and closes the pseudo terminal
+    """
+
+    def __init__(self, slave_ids, baudrate=19200, parity="N", stopbits=1, turnaround=0.005, drop_rate=0.0, corrupt_rate=0.0, seed=0):
+        self.slave_ids = list(slave_ids)
+        self.baudrate = baudrate
+        self.parity = parity
+        self.stopbits = stopbits
+        self.turnaround = turnaround
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.random = random.Random(seed)
+        self.counters = {"requests": 0, "responses": 0, "dropped": 0, "corrupted": 0, "unanswered": 0}
+
+        self.databank = make_databank(self.slave_ids)
+
+        self.running = False
+        self.thread = None
+        self.master_fd = None
+        self.slave_fd = None
+        self.device = None
+
+    def start(self):
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.master_fd)
+        tty.setraw(self.slave_fd)
+        self.device = os.ttyname(self.slave_fd)
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, name="slave_farm")
+        self.thread.daemon = True
+        self.thread.start()
+        return self.device
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        for fd in (self.master_fd, self.slave_fd):
+            if fd is not None:
+                os.close(fd)
+        self.master_fd = self.slave_fd = None
+
+    def port_config(self, **settings):
+        port_config = {"port": self.device, "baudrate": self.baudrate, "databits": 8, "parity": self.parity, "stopbits": self.stopbits, "timeout_connection": 0.5}
+        port_config.update(settings)
+        return port_config
+
+    def wire_time(self, length):
+        return length * char_bits(self.parity, self.stopbits) / float(self.baudrate)
+
+    def serve(self):
+        buffer = b""
+        while self.running:
+            readable, unused_w, unused_x = select.select([self.master_fd], [], [], 0.1)
+            if not readable:
+                buffer = b"" #silence on the bus ends every incomplete frame
+                continue
+            buffer += os.read(self.master_fd, 4096)
+
+            while buffer:
+                length = request_length(buffer)
+                if length == 0: #no request, resynchronise at the next silence
+                    buffer = b""
+                elif length is None or len(buffer) < length:
+                    break
+                else:
+                    request, buffer = buffer[:length], buffer[length:]
+                    self.answer(request)
+
+    def answer(self, request):
+        self.counters["requests"] += 1
+        response = self.databank.handle_request(modbus_rtu.RtuQuery(), request)
+        if not response:
+            self.counters["unanswered"] += 1
+            return
+        if self.random.random() < self.drop_rate:
+            self.counters["dropped"] += 1
+            return
+        if self.random.random() < self.corrupt_rate:
+            self.counters["corrupted"] += 1
+            response = response[:-1] + bytes([response[-1] ^ 0xff])
+
+        time.sleep(self.wire_time(len(request) + len(response)) + self.turnaround)
+        os.write(self.master_fd, response)
+        self.counters["responses"] += 1
+# [End Class SlaveFarm]
+
+
+# [Start Class TcpSlaveServer]
+class TcpSlaveServer(object):
+    """
+    In-process Modbus TCP or Modbus RTU over TCP server on 127.0.0.1 with simulated slaves
+        ...
+
+    Attributes
+    ----------
+    framing : str
+        "tcp" (MBAP header with transaction id) or "rtu_over_tcp" (RTU frames with CRC), as "type" of the port_config
+    latency : float
+        seconds from a request to its response, pipelined requests wait in parallel (network round trip)
+    turnaround : float
+        seconds the server needs per request, one request after the other
+    counters : dict
+        connections, requests, responses, unanswered (no such slave) and pipelined (most requests received before answering)
+
+    Methods
+    -------
+    start()
+        Listens and serves connections in threads, returns the port
+    port_config(**settings)
+        Returns a port_config of setup_modbus.json for the server
+    stop()
+        Closes the listening socket
+    """
+
+    def __init__(self, slave_ids, framing="tcp", latency=0.002, turnaround=0.0):
+        self.slave_ids = list(slave_ids)
+        self.framing = framing
+        self.latency = latency
+        self.turnaround = turnaround
+        self.databank = make_databank(self.slave_ids)
+        self.counters = {"connections": 0, "requests": 0, "responses": 0, "unanswered": 0, "pipelined": 0}
+        self.lock = threading.Lock()
+        self.listener = None
+        self.port = None
+
+    def start(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(4)
+        self.port = self.listener.getsockname()[1]
+        thread = threading.Thread(target=self.accept, name="tcp_slave_server")
+        thread.daemon = True
+        thread.start()
+        return self.port
+
+    def stop(self):
+        self.listener.close()
+
+    def port_config(self, **settings):
+        port_config = {"type": self.framing, "host": "127.0.0.1", "tcp_port": self.port, "timeout_connection": 0.5}
+        port_config.update(settings)
+        return port_config
+
+    def accept(self):
+        while True:
+            try:
+                connection, unused_address = self.listener.accept()
+            except OSError: #stopped
+                return
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                self.counters["connections"] += 1
+            thread = threading.Thread(target=self.serve, args=(connection,), name="tcp_slave_server_client")
+            thread.daemon = True
+            thread.start()
+
+    def split_requests(self, buffer):
+        """complete requests at the start of buffer and the rest"""
+        requests = list()
+        while True:
+            if self.framing == "tcp":
+                length = 6 + struct.unpack(">H", buffer[4:6])[0] if len(buffer) >= 6 else None
+            else:
+                length = request_length(buffer)
+                if length == 0: #no request
+                    return requests, b""
+            if length is None or len(buffer) < length:
+                return requests, buffer
+            requests.append(buffer[:length])
+            buffer = buffer[length:]
+
+    def serve(self, connection):
+        query_class = modbus_tcp.TcpQuery if self.framing == "tcp" else modbus_rtu.RtuQuery
+        buffer = b""
+        due = 0.0
+        try:
+            while True:
+                data = connection.recv(4096)
+                if not data:
+                    return
+                arrival = time.monotonic()
+                requests, buffer = self.split_requests(buffer + data)
+                with self.lock:
+                    self.counters["requests"] += len(requests)
+                    self.counters["pipelined"] = max(self.counters["pipelined"], len(requests))
+
+                for request in requests:
+                    response = self.databank.handle_request(query_class(), request)
+                    due = max(arrival + self.latency, due + self.turnaround)
+                    if not response:
+                        with self.lock:
+                            self.counters["unanswered"] += 1
+                        continue
+                    time.sleep(max(0, due - time.monotonic()))
+                    connection.sendall(response)
+                    with self.lock:
+                        self.counters["responses"] += 1
+        except OSError:
+            pass
+        finally:
+            connection.close()
+# [End Class TcpSlaveServer]
+
+
+def make_certificate(directory, hostname="localhost"):
+    """self signed certificate and key for hostname in directory with the openssl command, returns (certfile, keyfile)"""
+    certfile = os.path.join(directory, "broker_cert.pem")
+    keyfile = os.path.join(directory, "broker_key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-keyout", keyfile, "-out", certfile,
+                    "-subj", "/CN={}".format(hostname), "-addext", "subjectAltName=DNS:{}".format(hostname)],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return certfile, keyfile
+
+
+# [Start Class StandInBroker]
+class StandInBroker(object):
+    """
+    Minimal MQTT 3.1.1 broker for one publishing client: acknowledges CONNECT, SUBSCRIBE, PINGREQ and QoS 1 PUBLISH.
+    As Google Cloud IoT Core, a new connection closes the previous one of the device (session takeover).
+        ...
+
+    Attributes
+    ----------
+    publishes : list
+        (time.time() of arrival, topic, payload, bytes of the PUBLISH packet) of every received PUBLISH
+    port : int
+        listening TCP port on 127.0.0.1, chosen by the system
+    connects : int
+        received CONNECT packets
+
+    Methods
+    -------
+    start()
+        Listens and serves clients in threads, returns the port
+    take_publishes()
+        Returns and clears the recorded publishes
+    stop()
+        Closes the listening socket
+    """
+
+    def __init__(self, certfile=None, keyfile=None):
+        self.context = None
+        if certfile is not None:
+            self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.context.load_cert_chain(certfile, keyfile)
+        self.publishes = list()
+        self.lock = threading.Lock()
+        self.listener = None
+        self.port = None
+        self.connects = 0
+        self.connection = None #the connection of the last CONNECT
+
+    def start(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(4)
+        self.port = self.listener.getsockname()[1]
+        thread = threading.Thread(target=self.accept, name="stand_in_broker")
+        thread.daemon = True
+        thread.start()
+        return self.port
+
+    def stop(self):
+        self.listener.close()
+
+    def take_publishes(self):
+        with self.lock:
+            publishes, self.publishes = self.publishes, list()
+        return publishes
+
+    def accept(self):
+        while True:
+            try:
+                connection, unused_address = self.listener.accept()
+            except OSError: #stopped
+                return
+            thread = threading.Thread(target=self.serve, args=(connection,), name="stand_in_broker_client")
+            thread.daemon = True
+            thread.start()
+
+    @staticmethod
+    def receive_exactly(connection, length):
+        data = b""
+        while len(data) < length:
+            chunk = connection.recv(length - len(data))
+            if not chunk:
+                raise ConnectionError("client disconnected")
+            data += chunk
+        return data
+
+    def receive_packet(self, connection):
+        """(first byte, variable header and payload, bytes of the packet)"""
+        first = self.receive_exactly(connection, 1)[0]
+        remaining, multiplier, header_length = 0, 1, 1
+        while True:
+            byte = self.receive_exactly(connection, 1)[0]
+            header_length += 1
+            remaining += (byte & 0x7f) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return first, self.receive_exactly(connection, remaining), header_length + remaining
+
+    def serve(self, connection):
+        try:
+            if self.context is not None:
+                connection = self.context.wrap_socket(connection, server_side=True)
+            while True:
+                first, body, length = self.receive_packet(connection)
+                packet_type = first >> 4
+                if packet_type == 1: #CONNECT
+                    with self.lock:
+                        previous, self.connection = self.connection, connection
+                        self.connects += 1
+                    if previous is not None:
+                        self.close(previous)
+                    connection.sendall(b"\x20\x02\x00\x00")
+                elif packet_type == 3: #PUBLISH
+                    qos = (first >> 1) & 0x03
+                    topic_length = struct.unpack(">H", body[:2])[0]
+                    topic = body[2:2 + topic_length].decode("utf-8")
+                    offset = 2 + topic_length
+                    if qos:
+                        connection.sendall(b"\x40\x02" + body[offset:offset + 2])
+                        offset += 2
+                    with self.lock:
+                        self.publishes.append((time.time(), topic, body[offset:], length))
+                elif packet_type == 8: #SUBSCRIBE
+                    granted = self.granted_qos(body[2:]) #after the packet id
+                    connection.sendall(bytes([0x90, 2 + len(granted)]) + body[:2] + granted)
+                elif packet_type == 12: #PINGREQ
+                    connection.sendall(b"\xd0\x00")
+                elif packet_type == 14: #DISCONNECT
+                    break
+        except (ConnectionError, OSError, ssl.SSLError):
+            pass
+        finally:
+            connection.close()
+
+    @staticmethod
+    def close(connection):
+        try:
+            connection.shutdown(socket.SHUT_RDWR)
+        except OSError: #already closed
+            pass
+
+    @staticmethod
+    def granted_qos(topics):
+        """SUBACK return codes for the topic filters of a SUBSCRIBE, QoS up to 1"""
+        granted = list()
+        offset = 0
+        while offset < len(topics):
+            topic_length = struct.unpack(">H", topics[offset:offset + 2])[0]
+            offset += 2 + topic_length
+            granted.append(min(topics[offset], 1))
+            offset += 1
+        return bytes(granted)
+# [End Class StandInBroker]
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+"""
+ IoT Gateway Modbus
+ (C)2020 - Michael Feil
+ This is distributed under MIT license, see LICENSE
+"""
+
+"""g_aggregation.py
+
+Function: Edge aggregation. Instead of every read result, operations with "aggregation" publish min, max, mean and count
+of their values per time window, so fast operations are sampled at the edge and only their statistics are transmitted.
+
+Every result updates the window of its display_name in O(1) (amortised for sliding windows). A closed window is published
+as four samples "<display_name>:min", ":max", ":mean" (per value of the result) and ":count" with the time of the end of the window.
+Windows are closed by the next result or, without a further result, by the Scheduler every CLOSE_INTERVAL seconds. 
+The open window of a removed operation or of changed aggregation settings is published at once.
+Error results are published at once and are not aggregated.
+
+Per operation in setup_modbus.json (optional):
+    "aggregation": {
+        "window": seconds per window,
+        "mode": "tumbling" (default): consecutive windows aligned to multiples of window since 1970,
+                "sliding": the last window seconds, published every "step" seconds (default: window / 10),
+        "step": seconds between the statistics of a sliding window,
+        "keep_raw": number of raw samples kept per operation for a burst upload, default 0
+    }
+A burst upload is requested with a message {"burst_upload": ["display_name", ...]} or {"burst_upload": "all"} on the commands topic,
+the kept raw samples are published on the events topic.
+"""
+
+#[Start includes]
+import collections
+import threading
+import time
+#[End includes]
+
+#[Start Global Variables]
+AGGREGATION_KEYS = ("aggregation",) #keys of an operation copied to the request
+STATISTICS = ("min", "max", "mean", "count")
+CLOSE_INTERVAL = 1.0                #seconds between closing the windows due without a further result
+#[End Global Variables]
+
+
+# [Start Windows]
+class TumblingWindow(object):
+    """count, sum, min and max per value of the results within one window"""
+
+    def __init__(self, length, start, width):
+        self.end = start + length
+        self.width = width
+        self.count = 0
+        self.sums = self.minimum = self.maximum = None
+
+    def add(self, values):
+        if self.count == 0:
+            self.sums = list(values)
+            self.minimum = list(values)
+            self.maximum = list(values)
+        else:
+            for index, value in enumerate(values):
+                self.sums[index] += value
+                if value < self.minimum[index]:
+                    self.minimum[index] = value
+                elif value > self.maximum[index]:
+                    self.maximum[index] = value
+        self.count += 1
+
+    def statistics(self):
+        return {"min": self.minimum, "max": self.maximum, "mean": [round(total / float(self.count), 6) for total in self.sums], "count": [self.count]}
+
+
+class SlidingWindow(object):
+    """
+    count, sum, min and max per value of the results of the last length seconds.
+    min and max from monotonic queues: every value enters and leaves each queue once.
+    """
+
+    def __init__(self, length, width):
+        self.length = length
+        self.width = width
+        self.samples = collections.deque()                                  #(time, values) within the window
+        self.sums = [0] * width
+        self.minimum = [collections.deque() for unused in range(width)]     #(time, value), increasing values
+        self.maximum = [collections.deque() for unused in range(width)]     #(time, value), decreasing values
+
+    def add(self, now, values):
+        self.samples.append((now, values))
+        for index, value in enumerate(values):
+            self.sums[index] += value
+            minimum, maximum = self.minimum[index], self.maximum[index]
+            while minimum and minimum[-1][1] >= value:
+                minimum.pop()
+            minimum.append((now, value))
+            while maximum and maximum[-1][1] <= value:
+                maximum.pop()
+            maximum.append((now, value))
+        self.expire(now)
+
+    def expire(self, now):
+        """removes the samples older than length seconds"""
+        oldest = now - self.length
+        while self.samples and self.samples[0][0] <= oldest:
+            unused_time, values = self.samples.popleft()
+            for index, value in enumerate(values):
+                self.sums[index] -= value
+        for queues in (self.minimum, self.maximum):
+            for values in queues:
+                while values and values[0][0] <= oldest:
+                    values.popleft()
+
+    def statistics(self):
+        count = len(self.samples)
+        return {"min": [values[0][1] for values in self.minimum], "max": [values[0][1] for values in self.maximum],
+                "mean": [round(total / float(count), 6) for total in self.sums], "count": [count]}
+# [End Windows]
+
+
+# [Start Class Aggregator]
+class Aggregator(object):
+    """
+    Aggregates the results of requests with "aggregation" per display_name, used by one Modbus_reader
+        ...
+
+    Attributes
+    ----------
+    windows : dict
+        display_name: [TumblingWindow or SlidingWindow, time.time() of the next statistics of a sliding window, settings of the window,
+                       last sample of the window]
+    raw : dict
+        display_name: collections.deque of the last keep_raw samples
+    lock : threading.Lock
+        the Modbus_reader aggregates, the Scheduler closes due windows and flushes windows of removed operations
+
+    Methods
+    -------
+    aggregate(request, sample)
+        Returns the samples to publish for the sample of a request with "aggregation": statistics of closed windows or error results
+    close_due(now)
+        Returns the statistics of the windows due at now without a further result
+    flush(names)
+        Returns the statistics of the open windows of names and removes them, e.g. of removed operations
+    take_raw(names)
+        Returns and removes the kept raw samples of names, of all operations if names is "all"
+    """
+
+    def __init__(self):
+        self.windows = dict()
+        self.raw = dict()
+        self.lock = threading.Lock()
+
+    def aggregate(self, request, sample):
+        with self.lock:
+            return self.add_sample(request, sample)
+
+    def add_sample(self, request, sample):
+        settings = request["aggregation"]
+        name = sample["na"]
+        result, now = sample["res"], sample["time"]
+
+        keep_raw = settings.get("keep_raw", 0)
+        if keep_raw > 0:
+            raw = self.raw.get(name)
+            if raw is None or raw.maxlen != keep_raw:
+                raw = self.raw[name] = collections.deque(raw or (), maxlen=keep_raw)
+            raw.append(sample)
+        elif name in self.raw:
+            del self.raw[name]
+
+        if not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in result):
+            return [sample] #error result
+
+        published = list()
+        entry = self.windows.get(name)
+        if entry is not None and (entry[2] != settings or entry[0].width != len(result)):
+            published = self.close(entry, now) #settings or size of the result changed
+            entry = None
+
+        length = settings["window"]
+        if settings.get("mode", "tumbling") == "sliding":
+            if entry is None:
+                entry = [SlidingWindow(length, len(result)), now + settings.get("step", length / 10.0), settings, sample]
+            entry[0].add(now, result)
+            entry[3] = sample
+            if now >= entry[1]:
+                published += self.statistics_samples(sample, entry[0].statistics(), now)
+                self.next_step(entry, now)
+        else:
+            if entry is not None and now >= entry[0].end:
+                published += self.close(entry, now)
+                entry = None
+            if entry is None:
+                entry = [TumblingWindow(length, now - now % length, len(result)), None, settings, sample]
+            entry[0].add(result)
+
+        self.windows[name] = entry
+        return published
+
+    def close_due(self, now):
+        with self.lock:
+            published = list()
+            for name, entry in list(self.windows.items()):
+                window = entry[0]
+                if isinstance(window, SlidingWindow):
+                    if now < entry[1]:
+                        continue
+                    window.expire(now)
+                    if not window.samples: #no result for a whole window, e.g. the operation was removed
+                        del self.windows[name]
+                        continue
+                    published += self.statistics_samples(entry[3], window.statistics(), now)
+                    self.next_step(entry, now)
+                elif now >= window.end:
+                    published += self.close(entry, now)
+                    del self.windows[name]
+            return published
+
+    def flush(self, names):
+        with self.lock:
+            now = time.time()
+            published = list()
+            for name in names:
+                entry = self.windows.pop(name, None)
+                if entry is not None:
+                    published += self.close(entry, now)
+            return published
+
+    def close(self, entry, now):
+        """statistics of the window of entry, a tumbling window closed before its end is published with the time now"""
+        window, unused_next_statistics, unused_settings, sample = entry
+        if isinstance(window, SlidingWindow):
+            window.expire(now)
+            return self.statistics_samples(sample, window.statistics(), now) if window.samples else []
+        return self.statistics_samples(sample, window.statistics(), min(window.end, now))
+
+    @staticmethod
+    def next_step(entry, now):
+        settings = entry[2]
+        step = settings.get("step", settings["window"] / 10.0)
+        entry[1] += step
+        if entry[1] <= now: #no samples for more than a step
+            entry[1] = now + step
+
+    @staticmethod
+    def statistics_samples(sample, statistics, end):
+        return [{"na": "{}:{}".format(sample["na"], statistic), "res": statistics[statistic], "sl": sample["sl"], "time": end}
+                for statistic in STATISTICS]
+
+    def take_raw(self, names):
+        with self.lock:
+            taken = list()
+            for name in list(self.raw) if names == "all" else names:
+                raw = self.raw.get(name)
+                while raw:
+                    taken.append(raw.popleft())
+            return taken
+# [End Class Aggregator]
@@ -0,0 +1,753 @@
+#!/usr/bin/env python
+
+"""
+ IoT Gateway Modbus
+ (C)2020 - Michael Feil
+ This is distributed under MIT license, see LICENSE
+"""
+
+"""g_async_runtime.py
+
+Function: Optional asyncio runtime, runs scheduling, Modbus reads and MQTT publishing in one event loop instead of threads.
+
+Selected with "runtime": "asyncio" in the paramteter_settings of setup_mqtt.json, see startup_solution.main_asyncio.
+The Scheduler, Modbus_readers and handle_mqtt classes are reused, only their waiting is replaced:
+    - scheduled events are timers of the event loop (LoopTimers) instead of the TimerHeap thread
+    - serial ports are read non-blocking when the event loop reports the file descriptor readable (AsyncRtuMaster),
+      Modbus TCP with asyncio streams (AsyncTcpMaster), one connection per remote gateway as in the threads runtime
+    - paho mqtt is driven by the readability/writability of its socket instead of loop_start()
+    - timing and publishing queues wake up their consumer on put() instead of polling with timeouts,
+      the lanes of the publishing queue wait for their tokens with timers of the event loop
+Idle, the gateway wakes up only for due events and once per second for the MQTT keepalive.
+
+Limitation: serial ports need a file descriptor usable by the event loop (Linux, e.g. Raspberry Pi), not on Windows.
+"""
+
+#[Start includes]
+import asyncio
+import datetime
+import functools
+import os
+import queue
+import socket
+import threading
+import time
+
+import serial
+from modbus_tk.exceptions import ModbusError, ModbusInvalidResponseError
+#[End includes]
+
+#[includes own scripts]
+from g_modbus import Scheduler, Modbus_reader, Modbus_readers, DeadlineQueue, REQUEST_NOT_POSSIBLE, is_wake_up, needs_read_back, verified_split
+from g_mqtt_client import handle_mqtt, telemetry_spool, jwt_minter, DEVICE_ID, SPOOL_POLL_INTERVAL, EVENTS_RATE, STATE_RATE, REPLY_RATE
+from g_mqtt_client import JWT_PREPARE_LEAD, ROTATION_CONNACK_TIMEOUT, ROTATION_RETRY_INTERVAL
+from g_publish_lanes import PublishLanes
+from g_schema_check import check_configuration_message, update_configuration, read_setup
+from g_slave_health import TIMEOUTS_SAVE_INTERVAL
+from g_transport import TcpMaster, ConnectionPool, expire, parse_response_pdu, build_rtu_frame, rtu_frame_length, rtu_frame_pdu, DEFAULT_TCP_PORT
+from g_bus_budget import frame_silence
+from g_decode import decode_frame, decode_result
+from g_read_plan import read_back_request
+import g_shared_utils as su
+from g_shared_utils import logger
+#[includes own scripts]
+
+#[Start Global Variables]
+MQTT_MISC_INTERVAL = 1.0    #seconds between paho loop_misc() calls (keepalive, retries)
+#[End Global Variables]
+
+
+# [Start Queues]
+class AsyncPublishLanes(PublishLanes):
+    """PublishLanes whose consumer awaits get_async() in the event loop
+
+    put from another thread (the telemetry_encoder of g_mqtt_client) wakes up the event loop with call_soon_threadsafe.
+    """
+
+    def __init__(self, maxsize=100, events_rate=0, state_rate=0.2, reply_rate=0.5, loop=None):
+        PublishLanes.__init__(self, maxsize, events_rate, state_rate, reply_rate)
+        self.loop = loop
+        self.loop_thread = threading.get_ident() #created in the thread of the event loop
+        self.ready = asyncio.Event()
+
+    def notify(self):
+        PublishLanes.notify(self)
+        if self.loop is not None and threading.get_ident() != self.loop_thread:
+            self.loop.call_soon_threadsafe(self.ready.set)
+        else:
+            self.ready.set()
+
+    async def get_async(self):
+        """waits for the next message whose lane has a token"""
+        while True:
+            with self.condition:
+                message, wait = self.poll(time.monotonic())
+            if message is not None:
+                return message
+            self.ready.clear()
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+
+class AsyncDeadlineQueue(DeadlineQueue):
+    """DeadlineQueue whose consumer awaits get_async() in the event loop"""
+
+    def _init(self, maxsize):
+        DeadlineQueue._init(self, maxsize)
+        self.ready = asyncio.Event()
+
+    def _put(self, item):
+        DeadlineQueue._put(self, item)
+        self.ready.set()
+
+    async def get_async(self):
+        """waits for the most urgent request"""
+        while True:
+            try:
+                return self.get(False)
+            except queue.Empty:
+                self.ready.clear()
+                await self.ready.wait()
+# [End Queues]
+
+
+# [Start Class LoopTimers]
+class LoopTimers(object):
+    """
+    TimerHeap interface on the timers of the event loop, used as Scheduler.timer_heap.
+    As TimerHeap, missed runs are skipped and the phase is kept. Must be used from the event loop only.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.handles = dict()      #timer_id: asyncio.TimerHandle of the next run
+        self.timer_ids = 0
+
+    def __len__(self):
+        return len(self.handles)
+
+    def schedule(self, interval, function, *args, first_run=None, pass_due=False, **kwargs):
+        """schedules function at first_run (time.monotonic(), default now) and then every interval seconds, pass_due as TimerHeap"""
+        if first_run is None:
+            first_run = time.monotonic()
+
+        self.timer_ids += 1
+        self.call_at(self.timer_ids, first_run, interval, function, args, kwargs, pass_due)
+        return self.timer_ids
+
+    def call_at(self, timer_id, deadline, interval, function, args, kwargs, pass_due):
+        #time.monotonic() deadlines, the event loop clock may differ
+        when = self.loop.time() + (deadline - time.monotonic())
+        self.handles[timer_id] = self.loop.call_at(when, self.fire, timer_id, deadline, interval, function, args, kwargs, pass_due)
+
+    def fire(self, timer_id, deadline, interval, function, args, kwargs, pass_due):
+        if interval == 0:
+            del self.handles[timer_id] #run only once
+        else:
+            next_deadline = deadline + interval
+            now = time.monotonic()
+            if next_deadline <= now: #fallen behind, skip missed runs but keep the phase
+                next_deadline += (int((now - next_deadline) / interval) + 1) * interval
+            self.call_at(timer_id, next_deadline, interval, function, args, kwargs, pass_due)
+
+        if pass_due:
+            kwargs = dict(kwargs, due=deadline)
+        try:
+            function(*args, **kwargs)
+        except Exception as e:
+            logger.error("Error in scheduled function {}: {}".format(function, e))
+
+    def cancel(self, timer_id):
+        handle = self.handles.pop(timer_id, None)
+        if handle is not None:
+            handle.cancel()
+
+    def clear(self):
+        for handle in self.handles.values():
+            handle.cancel()
+        self.handles = dict()
+
+    def wakeup(self):
+        pass
+# [End Class LoopTimers]
+
+
+# [Start Async Masters]
+class AsyncRtuMaster(object):
+    """
+    Modbus RTU master on a non-blocking serial port, reads when the event loop reports data and
+    writes what the serial port takes, the rest when the event loop reports it writable.
+    Keeps the silence of 3.5 characters between frames like modbus_tk.
+    """
+
+    def __init__(self, serial_port, port_config, loop):
+        self.serial_port = serial_port
+        self.loop = loop
+        self.timeout = port_config["timeout_connection"]
+        self.silence = frame_silence(port_config)
+        self.buffer = bytearray()
+        self.lock = asyncio.Lock()     #as TcpMaster.lock, one transaction at a time
+        self.data_received = asyncio.Event()
+        self.last_frame_end = 0.0
+        self.loop.add_reader(self.serial_port.fileno(), self.on_readable)
+
+    def on_readable(self):
+        self.buffer += self.serial_port.read(self.serial_port.in_waiting or 1)
+        self.data_received.set()
+
+    def set_timeout(self, timeout_in_sec):
+        self.timeout = timeout_in_sec
+
+    def set_verbose(self, verbose):
+        pass
+
+    def close(self):
+        self.loop.remove_reader(self.serial_port.fileno())
+        self.serial_port.close()
+
+    async def execute(self, request):
+        """executes a request dict, returns the result tuple, raises ModbusError for exception responses"""
+        silence_left = self.last_frame_end + self.silence - time.monotonic()
+        if silence_left > 0:
+            await asyncio.sleep(silence_left)
+
+        del self.buffer[:] #late responses of earlier requests
+        try:
+            frame = await asyncio.wait_for(self.transact(request), self.timeout)
+        except asyncio.TimeoutError:
+            raise ModbusInvalidResponseError("Response length is invalid {0}".format(len(self.buffer)))
+        finally:
+            self.last_frame_end = time.monotonic()
+        return parse_response_pdu(request, rtu_frame_pdu(frame))
+
+    async def transact(self, request):
+        await self.write_frame(build_rtu_frame(request))
+        return await self.receive_frame(request)
+
+    async def write_frame(self, frame):
+        """writes frame to the non-blocking file descriptor of the serial port, which takes as many bytes as fit in its buffer"""
+        data = memoryview(frame)
+        while data:
+            try:
+                data = data[os.write(self.serial_port.fileno(), data):]
+            except BlockingIOError: #output buffer full
+                pass
+            if data:
+                writable = self.loop.create_future()
+                self.loop.add_writer(self.serial_port.fileno(), self.on_writable, writable)
+                try:
+                    await writable
+                finally:
+                    self.loop.remove_writer(self.serial_port.fileno())
+
+    def on_writable(self, writable):
+        if not writable.done():
+            writable.set_result(None)
+
+    async def receive_frame(self, request):
+        while True:
+            if len(self.buffer) >= 2:
+                length = rtu_frame_length(request, self.buffer)
+                if len(self.buffer) >= length:
+                    frame = bytes(self.buffer[:length])
+                    del self.buffer[:length]
+                    return frame
+            self.data_received.clear()
+            await self.data_received.wait()
+
+
+class AsyncTcpMaster(TcpMaster):
+    """TcpMaster on asyncio streams, shared by the ports using the same remote gateway through the async_connection_pool"""
+
+    def __init__(self, host, tcp_port=DEFAULT_TCP_PORT, framing="tcp", timeout=5.0):
+        TcpMaster.__init__(self, host, tcp_port, framing=framing, timeout=timeout)
+        self.lock = asyncio.Lock()     #held by a port for its timeout and transactions, or its pipeline
+        self.reader = None
+        self.writer = None
+
+    async def open(self):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.tcp_port), self.timeout)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader, self.writer = None, None
+            self.buffer = bytearray()
+
+    def set_timeout(self, timeout_in_sec):
+        self.timeout = timeout_in_sec
+
+    async def execute(self, request):
+        result = (await self.execute_pipelined([request], 1))[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def execute_pipelined(self, requests, max_pipeline, timeouts=None):
+        """as TcpMaster.execute_pipelined"""
+        if self.framing != "tcp":
+            max_pipeline = 1
+        if timeouts is None:
+            timeouts = [self.timeout] * len(requests)
+
+        results = [None] * len(requests)
+        try:
+            for chunk_start in range(0, len(requests), max_pipeline):
+                await self.open()
+                in_flight = dict()
+                for index in range(chunk_start, min(chunk_start + max_pipeline, len(requests))):
+                    self.transaction_id = (self.transaction_id + 1) % 0x10000
+                    in_flight[self.transaction_id] = index
+                    self.writer.write(self.build_frame(self.transaction_id, requests[index]))
+                await asyncio.wait_for(self.writer.drain(), self.timeout)
+                sent = time.monotonic()
+
+                while in_flight:
+                    deadline = sent + min(timeouts[index] for index in in_flight.values())
+                    try:
+                        transaction_id, pdu = await self.receive_frame(requests[min(in_flight.values())], deadline)
+                    except socket.timeout as e:
+                        expire(in_flight, results, timeouts, sent, deadline, e)
+                        if self.framing != "tcp":
+                            self.close()
+                        continue
+                    index = in_flight.pop(transaction_id if self.framing == "tcp" else min(in_flight), None)
+                    if index is None: #response to an earlier request
+                        continue
+                    try:
+                        results[index] = parse_response_pdu(requests[index], pdu)
+                    except ModbusError as e:
+                        results[index] = e
+        except Exception:
+            self.close()
+            raise
+        return results
+
+    async def receive_frame(self, request, deadline):
+        """as TcpMaster.receive_frame, reads with the stream reader"""
+        frame = self.buffered_frame(request)
+        while frame is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("No response from {}:{}".format(self.host, self.tcp_port))
+            try:
+                chunk = await asyncio.wait_for(self.reader.read(4096), remaining)
+            except asyncio.TimeoutError:
+                raise socket.timeout("No response from {}:{}".format(self.host, self.tcp_port))
+            if not chunk:
+                raise ModbusInvalidResponseError("Connection closed by {}:{}".format(self.host, self.tcp_port))
+            self.buffer += chunk
+            frame = self.buffered_frame(request)
+        return frame
+
+async_connection_pool = ConnectionPool(AsyncTcpMaster) #shared by all AsyncModbusReaders, as connection_pool of g_transport
+# [End Async Masters]
+
+
+# [Start Class AsyncModbusReader]
+class AsyncModbusReader(Modbus_reader):
+    """
+    Modbus_reader running as task of the event loop instead of its thread, with the same attributes and update(), retire() etc.
+    read_modbus_event awaits its AsyncDeadlineQueue and the async master instead of blocking a thread,
+    setup_modbus.json and learned_timeouts.json are read and written in worker threads.
+    """
+
+    def __init__(self, timing_queue, publishing_queue, port_name=su.DEFAULT_PORT):
+        Modbus_reader.__init__(self, timing_queue, publishing_queue, port_name)
+        self.loop = asyncio.get_event_loop()
+        self.master = None
+        self.master_lock = asyncio.Lock()
+        self.task = None
+        self.resumed = asyncio.Event()   #set by startup()
+
+    def start(self):
+        self.task = self.loop.create_task(self.run())
+
+    async def connect_serial(self):
+        """opens the serial port non-blocking with an AsyncRtuMaster, or an AsyncTcpMaster"""
+        self.close_transport()
+        try:
+            self.serial_connected = False
+            self.master_status = self.max_master_attemps
+
+            if self.port_config.get("type", "rtu") == "rtu":
+                self.serial_port = serial.Serial(
+                    port=self.port_config["port"],
+                    baudrate=self.port_config["baudrate"],
+                    bytesize=self.port_config["databits"],
+                    parity=self.port_config["parity"],
+                    stopbits=self.port_config["stopbits"],
+                    xonxoff=0,
+                    timeout=0)
+                self.master = AsyncRtuMaster(self.serial_port, self.port_config, self.loop)
+            else:
+                self.pooled_master = async_connection_pool.acquire(self.port_config)
+                self.master = self.pooled_master
+                async with self.master.lock:
+                    self.master.set_timeout(self.port_config["timeout_connection"])
+                    await self.master.open()
+            self.master_lock = self.master.lock
+            logger.debug("connected port {}".format(self.port_name))
+
+            self.serial_connected = True
+            self.master_status = 0
+            self.count_connect()
+
+        except Exception as e:
+            logger.error("ERROR Serial Port connection not successful{}".format(e))
+            self.close_transport()
+            await asyncio.sleep(3)
+
+    def close_transport(self):
+        """closes the serial port or releases the pooled AsyncTcpMaster"""
+        if self.pooled_master is not None:
+            async_connection_pool.release(self.pooled_master)
+            self.pooled_master = None
+        elif self.master is not None:
+            try:
+                self.master.close()
+            except Exception as ex:
+                logger.error("error closing port {}: {}".format(self.port_name, ex))
+        self.master = None
+        self.serial_port = "undefined"
+
+    async def execute_request(self, request):
+        """as Modbus_reader.execute_request"""
+        result =  REQUEST_NOT_POSSIBLE
+        if not self.serial_connected:
+            return result
+
+        bus_start = time.monotonic()
+        try:
+            if id(request) in self.prefetched:
+                result, bus_start = self.prefetched.pop(id(request))
+                if isinstance(result, Exception):
+                    raise result
+            else:
+                async with self.master_lock: #no other port sets the timeout of a shared master in between
+                    self.set_request_timeout(request)
+                    result = await self.master.execute(request)
+                self.observe_turnaround(request, time.monotonic() - bus_start)
+            self.request_succeeded(request, result)
+
+        except Exception as ex:
+            result = REQUEST_NOT_POSSIBLE
+            self.request_failed(request, ex)
+
+        finally:
+            request["t_bus_start"] = bus_start
+            request["t_bus_end"] = time.monotonic()
+
+        return result
+
+    async def execute_frame(self, frame):
+        """as Modbus_reader.execute_frame"""
+        try:
+            result = await self.execute_request(frame)
+            if result is REQUEST_NOT_POSSIBLE:
+                return [(request, REQUEST_NOT_POSSIBLE) for request in frame["members"]]
+            split = decode_frame(frame, result)
+
+        except ModbusError:
+            if len(frame["members"]) == 1:
+                return [(frame["members"][0], REQUEST_NOT_POSSIBLE)]
+
+            split = list()
+            for request in frame["members"]:
+                try:
+                    result = await self.execute_request(request)
+                    split.append((request, result if result is REQUEST_NOT_POSSIBLE else decode_result(request, result)))
+                except ModbusError:
+                    split.append((request, REQUEST_NOT_POSSIBLE))
+
+        if needs_read_back(split):
+            try:
+                read_back = await self.execute_request(read_back_request(frame))
+            except ModbusError:
+                read_back = REQUEST_NOT_POSSIBLE
+            split = verified_split(frame, split, read_back)
+        return split
+
+    async def prefetch_frames(self, frames):
+        bus_start = time.monotonic()
+        try:
+            async with self.master_lock:
+                results = await self.master.execute_pipelined(frames, self.port_config["max_pipeline"], [self.response_timeout(frame) for frame in frames])
+        except Exception as ex:
+            logger.warning("pipelined execution failed {}".format(ex))
+            return
+        for frame, result in zip(frames, results):
+            self.prefetched[id(frame)] = (result, bus_start)
+
+    async def read_modbus_event(self):
+        """as Modbus_reader.read_modbus_event"""
+        while self.serial_connected and self.alive and self.master_status<self.max_master_attemps-1:
+
+            request = await self.timing_queue.get_async()
+            if self.alive == False or self.serial_connected == False:
+                self.requeue(request)
+                break
+            if is_wake_up(request):
+                self.timing_queue.task_done()
+                continue
+            requests = [request]
+
+            frames = self.admit_frames(self.plan_requests(requests))
+            if self.port_config.get("max_pipeline", 1) > 1 and isinstance(self.master, AsyncTcpMaster):
+                await self.prefetch_frames(frames)
+
+            for frame in frames:
+                for request, result in await self.execute_frame(frame):
+                    self.publish_result(frame, request, result)
+
+            self.finish_requests(requests)
+
+        logger.warning("Disconnected the Modbus, restarting")
+        self.close_transport()
+
+    async def reconfigure(self):
+        """as Modbus_reader.reconfigure, reads setup_modbus.json (file lock, sleeps) in a worker thread"""
+        port_configs, unused_slaveconfig = await self.loop.run_in_executor(None, functools.partial(
+            read_setup, self.publishing_queue, sleeptime=False, send_answer_to_cloud=(self.port_name == su.DEFAULT_PORT)))
+        self.configure_port(port_configs)
+
+    def save_timeouts(self, force=False):
+        """as Modbus_reader.save_timeouts, writes a snapshot in a worker thread, returns its future or None"""
+        if force or time.monotonic() - self.timeouts_saved > TIMEOUTS_SAVE_INTERVAL:
+            self.timeouts_saved = time.monotonic()
+            return self.loop.run_in_executor(None, self.timeouts.snapshot().save, self.port_name)
+        return None
+
+    async def run(self):
+        self.alive = True
+        await self.loop.run_in_executor(None, self.load_timeouts) #nothing else uses the reader before
+
+        while not self.retired:
+            try:
+                await self.reconfigure()
+
+                while self.alive == True:
+                    await self.connect_serial()
+                    await self.read_modbus_event()
+
+                while self.alive == False and not self.retired:
+                    logger.debug("Modbus reader haltering")
+                    self.resumed.clear()
+                    await self.resumed.wait()
+            except Exception as ex:
+                logger.error("Unexpected run modbus error {}".format(ex))
+                await asyncio.sleep(1)
+        self.close_transport()
+        await self.save_timeouts(force=True)
+
+    def startup(self):
+        Modbus_reader.startup(self)
+        self.resumed.set()
+
+    def retire(self):
+        Modbus_reader.retire(self)
+        self.resumed.set()
+
+
+class AsyncModbusReaders(Modbus_readers):
+    """Modbus_readers with one AsyncModbusReader task per port"""
+    reader_class = AsyncModbusReader
+    queue_class = AsyncDeadlineQueue
+# [End Class AsyncModbusReader]
+
+
+# [Start Class AsyncMqtt]
+class AsyncMqtt(handle_mqtt):
+    """
+    handle_mqtt driven by the event loop: the paho socket is watched by the event loop,
+    the publishing_queue (AsyncPublishLanes) is awaited, reconnects wait for on_disconnect and rotations for the JWT expiry.
+    """
+
+    def __init__(self, publishing_queue, scheduler_obj, modbus_reader_obj, loop):
+        handle_mqtt.__init__(self, publishing_queue, scheduler_obj, modbus_reader_obj)
+        self.loop = loop
+        self.disconnected = asyncio.Event()
+        self.tasks = list()
+        self.loop_thread = threading.get_ident() #created in the thread of the event loop
+        self.connecting = False                  #connect_client() of self.client runs in a worker thread
+
+    def connack_event(self):
+        return asyncio.Event()
+
+    def register_callbacks(self, client):
+        handle_mqtt.register_callbacks(self, client)
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    # [Start Paho socket callbacks]
+    def in_loop(self, function, *args):
+        """calls function in the event loop, the socket callbacks also come from connect_client() in a worker thread"""
+        if threading.get_ident() == self.loop_thread:
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self.in_loop(self.loop.add_reader, sock, client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.in_loop(self.loop.remove_reader, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.in_loop(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.in_loop(self.loop.remove_writer, sock)
+    # [End Paho socket callbacks]
+
+    def on_disconnect(self, client, unused_userdata, rc):
+        handle_mqtt.on_disconnect(self, client, unused_userdata, rc)
+        if not self.retired(client):
+            self.connection_working = False
+            self.disconnected.set()
+
+    def stop_client(self, client):
+        client.disconnect() #the socket is closed by the event loop
+
+    def apply_configuration(self, config_payload):
+        """checks a new config message in a worker thread (file access, sleeps), the update is applied in the event loop"""
+        self.loop.run_in_executor(None, check_configuration_message, config_payload, self.scheduler_obj, self.modbus_reader_obj, self.publishing_queue,
+                                  self.update_in_loop)
+
+    def update_in_loop(self, received_json, scheduler_obj, modbus_reader_obj):
+        """update_configuration in the event loop, waits in the worker thread of apply_configuration for its answer"""
+        async def update():
+            return update_configuration(received_json, scheduler_obj, modbus_reader_obj)
+        return asyncio.run_coroutine_threadsafe(update(), self.loop).result()
+
+    def start(self):
+        self.run_publish = True
+        coroutines = [self.maintain_connection(), self.publish_data(), self.loop_misc()]
+        if telemetry_spool.enabled:
+            coroutines.append(self.drain_spool())
+        for coroutine in coroutines:
+            self.tasks.append(self.loop.create_task(coroutine))
+
+    async def maintain_connection(self):
+        """connects, reconnects with exponential backoff after a disconnect and with a new JWT before it expires"""
+        while self.run_publish:
+            try:
+                self.disconnected.clear()
+                self.connack_received.clear()
+                self.connecting = True
+                await self.loop.run_in_executor(None, self.connect_client, self.client) #DNS, TCP and TLS handshake in a worker thread
+                self.connection_working = True
+                self.last_client_restart = datetime.datetime.utcnow()
+            except Exception as e:
+                self.connection_working = False
+                logger.warning('An error occured during setting up the connection {}'.format(e))
+                await asyncio.sleep(self.backoff_delay())
+                continue
+            finally:
+                self.connecting = False
+
+            while self.run_publish and not self.disconnected.is_set(): #rotations with a new JWT before it expires, as rotate_connections
+                delay = self.rotation_delay()
+                if delay <= JWT_PREPARE_LEAD and jwt_minter.prepared is None:
+                    await self.loop.run_in_executor(None, jwt_minter.prepare) #signing in a worker thread, not in the event loop
+                if delay <= 0 and self.connack_received.is_set() and await self.rotate_client():
+                    continue
+                try:
+                    await asyncio.wait_for(self.disconnected.wait(), timeout=delay - JWT_PREPARE_LEAD if delay > JWT_PREPARE_LEAD else (delay or ROTATION_RETRY_INTERVAL))
+                except asyncio.TimeoutError:
+                    pass
+            await asyncio.sleep(self.backoff_delay())
+
+    async def rotate_client(self):
+        """make-before-break rotation as handle_mqtt.rotate_client, waits for the acknowledgement in the event loop"""
+        connack = self.connack_event()
+        client = self.create_client(connack)
+        self.retiring = self.client
+        try:
+            issued = await self.loop.run_in_executor(None, self.connect_client, client)
+            await asyncio.wait_for(connack.wait(), timeout=ROTATION_CONNACK_TIMEOUT)
+            acknowledged = client.is_connected()
+        except (Exception, asyncio.TimeoutError) as e:
+            logger.warning('An error occured during the rotation of the connection {}'.format(e))
+            acknowledged = False
+
+        if not acknowledged:
+            self.abort_rotation(client)
+            return False
+        self.complete_rotation(client, issued)
+        return True
+
+    async def loop_misc(self):
+        while self.run_publish:
+            if not self.connecting:
+                self.client.loop_misc()
+            await asyncio.sleep(MQTT_MISC_INTERVAL)
+
+    async def publish_data(self):
+        """publishes the messages of the publishing_queue, as handle_mqtt.publish_data"""
+        while self.run_publish:
+            publish_request = await self.publishing_queue.get_async()
+            try:
+                sub_topic = publish_request["sub_topic"]
+                qos = int(publish_request["qos"])
+                mqtt_topic = "/devices/{}/{}".format(DEVICE_ID, sub_topic)
+
+                if not self.connack_received.is_set(): #connection not yet acknowledged, up to 5 seconds
+                    try:
+                        await asyncio.wait_for(self.connack_received.wait(), timeout=5)
+                    except asyncio.TimeoutError:
+                        pass
+                    if qos == 0:
+                        qos = 1
+                if qos == 0 and self.retiring is not None:
+                    qos = 1 #carried over if the old client is disconnected before the rotation completes
+
+                self.publish(mqtt_topic, publish_request["payload"], qos)
+            except Exception as e:
+                logger.error('An error occured during publishing data {}'.format(e))
+            finally:
+                self.publishing_queue.task_done()
+
+    async def drain_spool(self):
+        """publishes the batches of the telemetry_spool, as handle_mqtt.publish_data"""
+        while self.run_publish:
+            try:
+                published = self.publish_spooled()
+            except Exception as e:
+                logger.error('An error occured during publishing spooled data {}'.format(e))
+                published = False
+            await asyncio.sleep(0 if published else SPOOL_POLL_INTERVAL)
+
+    def end_publish(self):
+        self.run_publish = False
+        for task in self.tasks:
+            task.cancel()
+        self.client.disconnect()
+# [End Class AsyncMqtt]
+
+
+async def run_gateway(queue_size=100):
+    """starts the gateway in the running event loop and runs until cancelled"""
+    loop = asyncio.get_event_loop()
+    logger.debug("Starting Application in the asyncio runtime")
+
+    publishing_queue = AsyncPublishLanes(maxsize=100, events_rate=EVENTS_RATE, state_rate=STATE_RATE, reply_rate=REPLY_RATE, loop=loop)
+    modbus_client = AsyncModbusReaders(publishing_queue, queue_size=queue_size)
+    schedule = Scheduler(modbus_client, publishing_queue)
+    schedule.timer_heap = LoopTimers(loop)
+    mqtt_handler = AsyncMqtt(publishing_queue, schedule, modbus_client, loop)
+
+    modbus_client.start()
+    schedule.startup(sleeptime=False)   #one event loop, no concurrent access to setup_modbus.json
+    mqtt_handler.start()
+
+    try:
+        await asyncio.Event().wait() #forever
+    finally:
+        mqtt_handler.end_publish()
+        schedule.stopkill()
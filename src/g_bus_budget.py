@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""
+ IoT Gateway Modbus
+ (C)2020 - Michael Feil 
+ This is distributed under MIT license, see LICENSE
+"""
+
+"""g_bus_budget.py
+
+Function: Estimating the bus utilisation of a setup_modbus.json and admission control of new configurations.
+
+The time of a Modbus RTU transaction is estimated from the request and response frame lengths, the 3.5 character silence 
+after every frame and the turnaround of the slave (observed by the Modbus_reader or "turnaround" of the port_config).
+The utilisation of a serial line is the sum over all periodic operations of transaction time / sampling_interval. 
+It is an upper bound, as merged reads (g_read_plan) share one transaction.
+
+Per port_config and port in "ports" of setup_modbus.json (all optional):
+    "bus_budget": maximum utilisation of the serial line, default 0.8
+    "budget_policy": "report" (default), "reject" the configuration or "stretch" all sampling_intervals to fit the bus_budget
+    "turnaround": assumed seconds between request and response of a slave if not observed, default 0.02
+"""
+
+#[Start includes]
+import copy
+import math
+#[End includes]
+
+#[includes own scripts]
+import g_shared_utils as su
+#[includes own scripts]
+
+#[Start Global Variables]
+DEFAULT_BUS_BUDGET = 0.8
+DEFAULT_TURNAROUND = 0.02   #seconds
+MAX_SAMPLING_INTERVAL = 864001
+#[End Global Variables]
+
+
+# [Start Frame Timing]
+def character_time(port_config):
+    """seconds to transmit one character: start bit, data bits, parity bit and stop bits"""
+    bits = 1 + port_config["databits"] + (0 if port_config["parity"] == "N" else 1) + port_config["stopbits"]
+    return bits / float(port_config["baudrate"])
+
+
+def frame_silence(port_config):
+    """silence of 3.5 characters after every frame, fixed 1.75 ms above 19200 baud (Modbus over serial line specification)"""
+    if port_config["baudrate"] > 19200:
+        return 0.00175
+    return 3.5 * character_time(port_config)
+
+
+def frame_lengths(request):
+    """(request bytes, response bytes) of the RTU frames of a request, including slave id and CRC"""
+    function_code = request["function_code"]
+
+    if function_code in (1, 2):
+        return 8, 5 + int(math.ceil(request["quantity_of_x"] / 8.0))
+    elif function_code in (3, 4):
+        return 8, 5 + 2 * request["quantity_of_x"]
+    elif function_code == 15:
+        return 9 + int(math.ceil(len(request["output_value"]) / 8.0)), 8
+    elif function_code == 16:
+        return 9 + 2 * len(request["output_value"]), 8
+    return 8, 8 #single writes and others
+
+
+def wire_time(port_config, request):
+    """seconds the request and response frames occupy the serial line, without the turnaround of the slave
+    
+    0 for Modbus TCP and RTU over TCP ports, their utilisation is the time waiting for the remote gateway only.
+    """
+    if "baudrate" not in port_config:
+        return 0.0
+    request_bytes, response_bytes = frame_lengths(request)
+    return (request_bytes + response_bytes) * character_time(port_config) + 2 * frame_silence(port_config)
+# [End Frame Timing]
+
+
+# [Start Bus Budget]
+def analyze_bus_budget(config_json, observed_turnaround=None):
+    """estimates the utilisation of every serial line of a setup_modbus.json 
+
+    observed_turnaround: optional dict port name: dict slave_id: seconds, e.g. Modbus_readers.observed_turnaround
+    Returns dict port name: dict with "utilisation", "bus_budget", "transactions_per_second" and "operations": display_name: utilisation
+    """
+    observed_turnaround = observed_turnaround or dict()
+    
+    report = dict()
+    for port_name, port_config in su.port_configs(config_json).items():
+        report[port_name] = {
+            "utilisation": 0.0,
+            "bus_budget": port_config.get("bus_budget", DEFAULT_BUS_BUDGET),
+            "transactions_per_second": 0.0,
+            "operations": dict(),
+        }
+
+    for slave in config_json["slaveconfig"].values():
+        port_name = slave.get("port", su.DEFAULT_PORT)
+        port_config = su.port_configs(config_json)[port_name]
+        port_report = report[port_name]
+        turnaround = observed_turnaround.get(port_name, dict()).get(slave["slave_id"], port_config.get("turnaround", DEFAULT_TURNAROUND))
+        
+        for op in slave["operations"].values():
+            if op["sampling_interval"] == 0: #once occuring
+                continue
+            utilisation = (wire_time(port_config, op) + turnaround) / op["sampling_interval"]
+            port_report["operations"][op["display_name"]] = utilisation
+            port_report["utilisation"] += utilisation
+            port_report["transactions_per_second"] += 1.0 / op["sampling_interval"]
+
+    return report
+
+
+def apply_bus_budget(config_json, observed_turnaround=None):
+    """admission control of a setup_modbus.json according to "budget_policy" of every port
+
+    Returns (accepted, config_json, answer): 
+        accepted is False if the budget of a port with policy "reject" is exceeded
+        config_json has stretched sampling_intervals on the ports with policy "stretch" which exceed their budget
+        answer is a text for the state message
+    """
+    report = analyze_bus_budget(config_json, observed_turnaround)
+    ports = su.port_configs(config_json)
+    accepted = True
+    answer = ""
+    stretch_factors = dict()        #port name: factor for all sampling_intervals
+
+    for port_name in sorted(report):
+        utilisation, bus_budget = report[port_name]["utilisation"], report[port_name]["bus_budget"]
+        policy = ports[port_name].get("budget_policy", "report")
+
+        answer += "\n Estimated bus utilisation of port {} {:.1f}% of budget {:.1f}% ({:.1f} transactions/s)".format(
+                    port_name, 100 * utilisation, 100 * bus_budget, report[port_name]["transactions_per_second"])
+
+        if utilisation <= bus_budget:
+            continue
+        elif policy == "report":
+            answer += ", WARNING bus is overloaded, sampling_intervals will not be met"
+        elif policy == "reject":
+            accepted = False
+            answer += ", REJECTED as bus budget is exceeded"
+        else:
+            stretch_factors[port_name] = utilisation / bus_budget
+            answer += ", STRETCHED all sampling_intervals by factor {:.2f}".format(stretch_factors[port_name])
+
+    if not stretch_factors or not accepted:
+        return accepted, config_json, answer
+
+    #stretch all periodic sampling_intervals of a port by the same factor
+    stretched_json = copy.deepcopy(config_json)
+    for slave in stretched_json["slaveconfig"].values():
+        factor = stretch_factors.get(slave.get("port", su.DEFAULT_PORT))
+        if factor is None:
+            continue
+        for op in slave["operations"].values():
+            if op["sampling_interval"] != 0:
+                op["sampling_interval"] = min(MAX_SAMPLING_INTERVAL, math.ceil(op["sampling_interval"] * factor * 1000) / 1000.0)
+
+    return True, stretched_json, answer
+# [End Bus Budget]
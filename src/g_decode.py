@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""
+ IoT Gateway Modbus
+ (C)2020 - Michael Feil
+ This is distributed under MIT license, see LICENSE
+"""
+
+"""g_decode.py
+
+Function: Decoding of holding and input registers to typed values at the edge, before deadband filter and publishing.
+
+Per operation in setup_modbus.json (all optional, only for function codes 3 and 4):
+    "data_type": "uint16" (default, result as read), "int16", "uint32", "int32", "float32" or "float64"
+    "byte_order": "big" (default, Modbus standard) or "little": order of the two bytes within each register
+    "word_order": "big" (default, most significant register first) or "little": order of the registers within a value
+    "scale", "offset": published value = value * scale + offset, default 1 and 0
+quantity_of_x must be a multiple of the registers per value (2 for 32 bit, 4 for 64 bit types).
+
+The registers of a whole frame of the read plan are packed to bytes once, as read or with the bytes of every register swapped. 
+Every byte and word order is then one of both buffers read as big or little endian: every member is decoded by one precompiled 
+struct.Struct.unpack_from call, or by a NumPy view for many values if NumPy is installed.
+"""
+
+#[Start includes]
+import functools
+import struct
+
+try:
+    import numpy #optional, for operations with many values
+except ImportError:
+    numpy = None
+#[End includes]
+
+#[Start Global Variables]
+DECODE_KEYS = ("data_type", "byte_order", "word_order", "scale", "offset") #keys of an operation copied to the request
+
+DATA_TYPES = {          #data_type: (struct format character, registers per value, NumPy type)
+    "uint16": ("H", 1, "u2"),
+    "int16": ("h", 1, "i2"),
+    "uint32": ("I", 2, "u4"),
+    "int32": ("i", 2, "i4"),
+    "float32": ("f", 2, "f4"),
+    "float64": ("d", 4, "f8"),
+}
+NUMPY_MIN_VALUES = 64   #NumPy is used from this many values per member, below struct is faster
+#[End Global Variables]
+
+#[includes own scripts]
+from g_read_plan import split_frame_result
+#[includes own scripts]
+
+
+# [Start Decoder]
+@functools.lru_cache(maxsize=256)
+def compile_decoder(data_type, quantity, endian):
+    """precompiled struct for quantity registers of data_type, returns (struct.Struct, NumPy dtype, values)"""
+    code, words, numpy_type = DATA_TYPES[data_type]
+    count = quantity // words
+    return struct.Struct("{}{}{}".format(endian, count, code)), endian + numpy_type, count
+
+
+def byte_layout(byte_order, word_order, words):
+    """(bytes of every register swapped, endian of struct) that reads values in byte_order and word_order
+
+    e.g. word_order little and byte_order big: registers CD AB of the value ABCD, swapped DC BA, read as little endian.
+    """
+    if words == 1:
+        return byte_order == "little", ">"
+    return byte_order != word_order, "<" if word_order == "little" else ">"
+
+
+def pack_registers(result, swapped=False):
+    """bytes of a register tuple, big endian or with the bytes of every register swapped"""
+    return struct.pack("{}{}H".format("<" if swapped else ">", len(result)), *result)
+
+
+def decode_registers(request, result, start=0, packed=None):
+    """decodes the quantity_of_x registers of request at start of the register tuple result, returns list of values
+
+    packed: dict swapped: packed bytes of result, shared by all members of a frame
+    """
+    data_type = request.get("data_type", "uint16")
+    swapped, endian = byte_layout(request.get("byte_order", "big"), request.get("word_order", "big"), DATA_TYPES[data_type][1])
+    decoder, dtype, count = compile_decoder(data_type, request["quantity_of_x"], endian)
+
+    if packed is None:
+        packed = dict()
+    if swapped not in packed:
+        packed[swapped] = pack_registers(result, swapped)
+
+    scale = request.get("scale", 1)
+    offset = request.get("offset", 0)
+    if numpy is not None and count >= NUMPY_MIN_VALUES:
+        values = numpy.frombuffer(packed[swapped], dtype=dtype, count=count, offset=2 * start)
+        if scale != 1 or offset != 0:
+            values = values * scale + offset
+        return values.tolist()
+
+    values = decoder.unpack_from(packed[swapped], 2 * start)
+    if scale != 1 or offset != 0:
+        return [value * scale + offset for value in values]
+    return list(values)
+
+
+def decode_result(request, result):
+    """result of a single request with data_type decoded, other results unchanged"""
+    if "data_type" not in request:
+        return result
+    return decode_registers(request, result)
+
+
+def decode_frame(frame, result):
+    """splits the result of a frame into (request, result) of its members, members with data_type are decoded
+
+    The registers of the frame are packed once per byte layout and every member is decoded at its offset.
+    """
+    members = frame["members"]
+    if not any("data_type" in request for request in members):
+        return split_frame_result(frame, result)
+
+    packed = dict()
+    start = frame["startadress"]
+    decoded = list()
+    for request in members:
+        offset = request["startadress"] - start
+        if "data_type" in request:
+            decoded.append((request, decode_registers(request, result, offset, packed)))
+        else:
+            decoded.append((request, tuple(result[offset:offset + request["quantity_of_x"]])))
+    return decoded
+# [End Decoder]
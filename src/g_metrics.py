@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+"""
+ IoT Gateway Modbus
+ (C)2020 - Michael Feil 
+ This is distributed under MIT license, see LICENSE
+"""
+
+"""g_metrics.py
+
+Function: Scheduling jitter and latency instrumentation of the Modbus requests.
+
+Every request is stamped with time.monotonic() when it is scheduled (t_scheduled), taken from the timing_queue (t_dequeued) 
+and when its Modbus transaction starts and ends (t_bus_start, t_bus_end).
+Per operation (display_name) and per slave, streaming histograms of the queue wait, the bus time 
+and the end-to-end lateness (t_bus_end - t_scheduled) are kept and reported periodically on the state topic.
+"""
+
+#[Start includes]
+import math
+import threading
+#[End includes]
+
+#[includes own scripts]
+import g_shared_utils as su
+#[includes own scripts]
+
+
+# [Start Class StreamingHistogram]
+class StreamingHistogram(object):
+    """
+    Histogram with logarithmic buckets, percentiles have a relative error of at most growth - 1.
+    Memory is bounded by the number of buckets between resolution and the largest value, not by the number of values.
+        ...
+
+    Methods
+    -------
+    add(value)
+        Adds a value in seconds
+    percentile(p)
+        Returns the upper bound of the bucket containing the p-th percentile 
+    """
+
+    def __init__(self, resolution=0.0001, growth=1.05):
+        self.resolution = resolution
+        self.log_growth = math.log(growth)
+        self.buckets = dict()       #bucket index: count
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, value):
+        if value <= self.resolution:
+            index = 0
+        else:
+            index = int(math.ceil(math.log(value / self.resolution) / self.log_growth))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        if self.count == 0:
+            return None
+        rank = p / 100.0 * self.count
+        cumulated = 0
+        for index in sorted(self.buckets):
+            cumulated += self.buckets[index]
+            if cumulated >= rank:
+                break
+        return min(self.max, self.resolution * math.exp(index * self.log_growth))
+# [End Class StreamingHistogram]
+
+
+# [Start Class LatencyMetrics]
+class LatencyMetrics(object):
+    """
+    Queue wait, bus time and lateness histograms per operation and per slave, thread safe.
+        ...
+
+    Methods
+    -------
+    record(request, frame)
+        Records the stamps of a served request, bus stamps are taken from frame if request was served by a merged frame
+    report(reset=True)
+        Returns p50/p95/p99 in milliseconds per operation and slave, starts new histograms if reset
+    """
+
+    measures = ("wait", "bus", "late")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = dict()
+
+    def record(self, request, frame):
+        stamped = request if "t_bus_end" in request else frame
+        if "t_scheduled" not in request or "t_bus_end" not in stamped:
+            return
+
+        values = (
+            request.get("t_dequeued", stamped["t_bus_start"]) - request["t_scheduled"],     #queue wait
+            stamped["t_bus_end"] - stamped["t_bus_start"],                                   #bus time
+            stamped["t_bus_end"] - request["t_scheduled"],                                   #end-to-end lateness
+        )
+        with self.lock:
+            slave_name = "slave_{}".format(request["slave_id"])
+            if request.get("port", su.DEFAULT_PORT) != su.DEFAULT_PORT: #slave ids are unique per port
+                slave_name = "{}_{}".format(request["port"], slave_name)
+
+            for name in (request["display_name"], slave_name):
+                if name not in self.histograms:
+                    self.histograms[name] = [StreamingHistogram() for unused in self.measures]
+                for histogram, value in zip(self.histograms[name], values):
+                    histogram.add(max(0.0, value))
+
+    def report(self, reset=True):
+        with self.lock:
+            histograms = self.histograms
+            if reset:
+                self.histograms = dict()
+
+        report = dict()
+        for name, named_histograms in histograms.items():
+            report[name] = {"n": named_histograms[0].count}
+            for measure, histogram in zip(self.measures, named_histograms):
+                report[name][measure] = [round(1000 * histogram.percentile(p), 1) for p in (50, 95, 99)]
+        return report
+# [End Class LatencyMetrics]
+
+latency_metrics = LatencyMetrics() #filled by the Modbus_reader, reported by the Scheduler
@@ -19,6 +19,8 @@ import time
 import queue
 import threading
 import random 
+import heapq
+import itertools
 
 #Modbus Test Kit is licensed under LGPL Licence and available at https://pypi.org/project/modbus_tk/
 from modbus_tk import modbus_rtu
@@ -29,10 +31,55 @@ import serial
 
 
 #[includes own scripts]
-from g_mqtt_client import TOPIC_EVENT, TOPIC_STATE, formatted_publish_message
-from g_schema_check import modbus_json_check, logger, read_setup
+from g_mqtt_client import TOPIC_EVENT, TOPIC_STATE, METRICS_INTERVAL, FAST_START, formatted_publish_message, telemetry_encoder, telemetry_spool, codec_controller, COMPRESSION
+from g_schema_check import modbus_json_check, logger, read_setup, diff_slaveconfig
+from g_read_plan import compile_read_plan, read_back_request, unverified_writes, WRITE_KEYS
+from g_decode import decode_frame, decode_result, DECODE_KEYS
+from g_report_filter import DeadbandFilter, REPORT_FILTER_KEYS
+from g_aggregation import Aggregator, AGGREGATION_KEYS, CLOSE_INTERVAL
+from g_bus_budget import wire_time
+from g_metrics import latency_metrics
+from g_transport import connection_pool
+from g_result_cache import ResultCache, CACHE_KEYS
+from g_slave_health import CircuitBreakers, ResponseTimeouts, is_slave_failure, OPEN, TIMEOUTS_SAVE_INTERVAL
+import g_shared_utils as su
 #[includes own scripts]
 
+REQUEST_NOT_POSSIBLE = (99999,"modbus_request_not_possible") #result published if a request failed
+TRANSPORT_KEYS = ("type", "port", "baudrate", "databits", "parity", "stopbits", "host", "tcp_port")  #port_config keys that require to reopen the connection
+FAST_START_WINDOW = 1.0                                      #with FAST_START, all operations are first due within this many seconds
+GOLDEN_RATIO = (5 ** 0.5 - 1) / 2                            #spreads phase offsets evenly
+DEFAULT_PRIORITY = 5                                         #priority of operations without "priority", lower is more urgent
+WRITE_CLASS, READ_CLASS = 0, 1                               #request classes of the timing queue, writes are served before reads
+WRITE_NOT_VERIFIED = (99998,"modbus_write_not_verified")     #result published if the read back of a write with "verify" differs
+WAKE_UP = {"slave_id": 0, "function_code": 0, "startadress": 0, "display_name": None, "priority": -1} #wakes up read_modbus_event, not executed
+
+
+def is_wake_up(request):
+    """True for WAKE_UP, put by update() and retire() in the timing queue"""
+    return request["function_code"] == 0
+
+
+def needs_read_back(split):
+    """True if a write with "verify" of a frame succeeded"""
+    return any(request.get("verify") and result is not REQUEST_NOT_POSSIBLE for request, result in split)
+
+
+def verified_split(frame, split, read_back):
+    """results of the members of a write frame, WRITE_NOT_VERIFIED for writes with "verify" not found in the read_back result"""
+    unverified = unverified_writes(frame, None if read_back is REQUEST_NOT_POSSIBLE else read_back)
+    return [(request, WRITE_NOT_VERIFIED if id(request) in unverified and result is not REQUEST_NOT_POSSIBLE else result) for request, result in split]
+
+
+def master_arguments(request):
+    """keyword arguments of the modbus_tk master execute() for a request or frame"""
+    arguments = {"slave": request["slave_id"], "function_code": request["function_code"], "starting_address": request["startadress"]}
+    if "quantity_of_x" in request:
+        arguments["quantity_of_x"] = request["quantity_of_x"] #read
+    elif "output_value" in request:
+        arguments["output_value"] = request["output_value"] #write
+    return arguments
+
 
 # [START Scheduling]
 # [START Helper RepeatedFunction]
@@ -89,35 +136,281 @@ class RepeatedFunction(threading.Thread):
 
 # [END Helper RepeatedFunction]
 
+# [START Helper TimerHeap]
+
+class TimerHeap(object):
+    """
+    runs many periodic functions from one thread, ordered by their next deadline in a heap.
+    Replaces one RepeatedFunction thread per function, so thread count stays constant for thousands of functions.
+
+    Limitation:
+    If a function falls more than one interval behind (e.g. long execution of other functions), 
+    the missed runs are skipped instead of run back to back, the phase of the function is kept.
+        ...
+
+    Attributes
+    ----------
+    heap : list
+        heap of [deadline, timer_id], deadline in time.monotonic() seconds
+    timers : dict
+        timer_id: (interval, function, args, kwargs, pass_due) of all scheduled functions
+    condition : threading.Condition
+        protects heap and timers, notified when a new earliest deadline might exist
+
+    Methods
+    -------
+    schedule(interval, function, *args, first_run=None, pass_due=False, **kwargs)
+        Adds function to be run every interval seconds (interval = 0: only once), returns timer_id
+        pass_due: function gets the keyword due, the time.monotonic() the run was due at, however late it runs
+    cancel(timer_id)
+        Removes a scheduled function
+    clear()
+        Removes all scheduled functions
+    run(stop_event)
+        Runs the due functions until stop_event is set
+    """
+
+    def __init__(self):
+        self.heap = list()
+        self.timers = dict()
+        self.condition = threading.Condition()
+        self.timer_ids = itertools.count()
+
+    def __len__(self):
+        return len(self.timers)
+
+    def schedule(self, interval, function, *args, first_run=None, pass_due=False, **kwargs):
+        """schedules function at first_run (time.monotonic(), default now) and then every interval seconds"""
+        if first_run is None:
+            first_run = time.monotonic()
+
+        with self.condition:
+            timer_id = next(self.timer_ids)
+            self.timers[timer_id] = (interval, function, args, kwargs, pass_due)
+            heapq.heappush(self.heap, [first_run, timer_id])
+            self.condition.notify()
+        return timer_id
+
+    def cancel(self, timer_id):
+        """removes timer_id, its heap entry is dropped lazily"""
+        with self.condition:
+            self.timers.pop(timer_id, None)
+
+            if len(self.heap) > 2 * len(self.timers) + 64: #keep memory bounded if many functions are cancelled
+                self.heap = [entry for entry in self.heap if entry[1] in self.timers]
+                heapq.heapify(self.heap)
+            self.condition.notify()
+
+    def clear(self):
+        """removes all scheduled functions"""
+        with self.condition:
+            self.timers.clear()
+            self.heap = list()
+            self.condition.notify()
+
+    def wakeup(self):
+        """wakes up run(), e.g. after stop_event.set()"""
+        with self.condition:
+            self.condition.notify()
+
+    def run(self, stop_event):
+        """runs the due functions until stop_event is set, sleeps until the next deadline otherwise"""
+        while not stop_event.is_set():
+            with self.condition:
+                if not self.heap:
+                    self.condition.wait() #nothing scheduled, wait for schedule() or wakeup()
+                    continue
+
+                deadline, timer_id = self.heap[0]
+                if timer_id not in self.timers: #cancelled
+                    heapq.heappop(self.heap)
+                    continue
+
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(timeout=delay) #until deadline or until earlier deadline is scheduled
+                    continue
+
+                interval, function, args, kwargs, pass_due = self.timers[timer_id]
+                if pass_due:
+                    kwargs = dict(kwargs, due=deadline)
+                if interval == 0:
+                    heapq.heappop(self.heap)
+                    del self.timers[timer_id] #run only once
+                    logger.debug("Repeating function only once: {} {} ".format(args, kwargs))
+                else:
+                    next_deadline = deadline + interval
+                    now = time.monotonic()
+                    if next_deadline <= now: #fallen behind, skip missed runs but keep the phase
+                        next_deadline += (int((now - next_deadline) / interval) + 1) * interval
+                    heapq.heapreplace(self.heap, [next_deadline, timer_id])
+
+            try:
+                function(*args, **kwargs)
+            except Exception as e:
+                logger.error("Error in scheduled function {}: {}".format(function, e))
+        return #end
+
+# [END Helper TimerHeap]
+
+# [START Helper DeadlineQueue]
+
+class DeadlineQueue(queue.Queue):
+    """
+    timing queue serving the most urgent request first: writes (control commands) before reads (telemetry), 
+    then ordered by priority, then by deadline (earliest deadline first).
+
+    A request that is already pending for the same operation is collapsed into the pending one.
+    If the queue is full, the least urgent request (queued or new) is dropped, so the bus degrades predictably under overload.
+    put() does therefore never block nor raise queue.Full.
+        ...
+
+    Attributes
+    ----------
+    heap : list
+        heap of (request class, priority, deadline, sequence number, request), request class WRITE_CLASS or READ_CLASS
+    pending : dict
+        operation key: request of all queued requests
+    stats : dict
+        display_name: counters of queued, served, collapsed and dropped requests and lateness in seconds
+
+    Methods
+    -------
+    put(request)
+        Queues a request with the keys "deadline" (time.monotonic()) and "priority" (lower is more urgent)
+    get(), get(False), task_done()
+        As queue.Queue
+    clear()
+        Removes all queued requests
+    statistics()
+        Returns a copy of the counters per display_name
+    """
+
+    def _init(self, maxsize):
+        self.heap = list()
+        self.pending = dict()
+        self.stats = dict()
+        self.sequence = itertools.count()
+
+    def _qsize(self):
+        return len(self.heap)
+
+    def _put(self, item):
+        heapq.heappush(self.heap, self.urgency(item) + (next(self.sequence), item))
+        self.pending[self.operation_key(item)] = item
+
+    def _get(self):
+        unused_class, unused_priority, deadline, unused_sequence, item = heapq.heappop(self.heap)
+        self.pending.pop(self.operation_key(item), None)
+
+        stats = self.operation_stats(item)
+        stats["served"] += 1
+        lateness = time.monotonic() - deadline
+        if lateness > 0:
+            stats["late"] += 1
+            stats["lateness_sum"] += lateness
+            stats["lateness_max"] = max(stats["lateness_max"], lateness)
+        return item
+
+    @staticmethod
+    def urgency(item):
+        """(request class, priority, deadline) of item, lower is more urgent"""
+        request_class = WRITE_CLASS if "output_value" in item else READ_CLASS
+        return (request_class, item.get("priority", DEFAULT_PRIORITY), item.get("deadline", 0))
+
+    @staticmethod
+    def operation_key(item):
+        return (item["slave_id"], item["function_code"], item["startadress"], item.get("display_name"))
+
+    def operation_stats(self, item):
+        name = item.get("display_name")
+        if name not in self.stats:
+            self.stats[name] = {"queued": 0, "served": 0, "collapsed": 0, "dropped": 0, "late": 0, "lateness_sum": 0.0, "lateness_max": 0.0}
+        return self.stats[name]
+
+    def put(self, item, block=True, timeout=None):
+        """queues item, collapses it into a pending request of the same operation or drops the least urgent request if full"""
+        with self.not_full:
+            stats = self.operation_stats(item)
+            if self.operation_key(item) in self.pending: #the pending request has the earlier deadline
+                stats["collapsed"] += 1
+                return
+
+            if self.maxsize > 0 and self._qsize() >= self.maxsize:
+                worst = max(self.heap)
+                if self.urgency(item) >= worst[:3]: #new request is the least urgent
+                    stats["dropped"] += 1
+                    logger.debug("timing queue full, dropped {}".format(item.get("display_name")))
+                    return
+
+                self.heap.remove(worst)
+                heapq.heapify(self.heap)
+                self.pending.pop(self.operation_key(worst[-1]), None)
+                self.operation_stats(worst[-1])["dropped"] += 1
+                self.unfinished_tasks -= 1
+                logger.debug("timing queue full, dropped {}".format(worst[-1].get("display_name")))
+
+            stats["queued"] += 1
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def clear(self):
+        """removes all queued requests"""
+        with self.mutex:
+            self.unfinished_tasks -= len(self.heap)
+            self.heap = list()
+            self.pending.clear()
+            if self.unfinished_tasks <= 0:
+                self.unfinished_tasks = 0
+                self.all_tasks_done.notify_all()
+
+    def statistics(self):
+        """returns a copy of the counters per display_name"""
+        with self.mutex:
+            return {name: dict(stats) for name, stats in self.stats.items()}
+
+# [END Helper DeadlineQueue]
+
 class Scheduler(threading.Thread):
     """
     A class used to schedule a all functions to be run periodically 
 
     Class Scheduler, class runs in own thread. 
-    Gets the setup_modus.json events and schedules the events with a RepeatedFunction.
-    When a RepeatedFunction executes, the according task&request will be put in the timing queue.
+    Gets the setup_modus.json events and schedules the events in a TimerHeap, which is run by this thread.
+    When a scheduled event is due, the according task&request will be put in the timing queue.
 
-    The Scheduler is stopped in the case the setup_modbus.json is renewed, and then restarted to schedule new events and RepeatedFunction
+    The Scheduler is stopped in the case the setup_modbus.json is renewed, and then restarted to schedule new events
     ...
 
     Attributes
     ----------
-    timing_queue : queue.Queue Object
+    timing_queue : DeadlineQueue or Modbus_readers Object
         queue where new request put to be read from the Modbus Reader Objectates
     publishing_queue : queue.Queue Object
         queue where messages are put to be published by the MQTT Module 
+    timer_heap : TimerHeap Object
+        all scheduled events, ordered by next deadline
 
 
     Methods
     -------
     run()
-        Starts when Thread is started, calles startup()
+        Starts when Thread is started, calles startup() and runs the timer_heap
     startup()
-        Iniitialize Start or Restart scheduling of events / reads from the modbus with RepeatedFunction
+        Iniitialize Start or Restart scheduling of events / reads from the modbus in the timer_heap
+    update()
+        Applies a new slaveconfig: only added, removed or retimed operations are rescheduled
+    phase_offsets()
+        Computes the offsets of the first run of new operations
     query_task()
-        Schedules a new periodic RepeatedFunction to execute function
+        Puts a due request in the timing_queue
+    publish_metrics()
+        Publishes the latency_metrics and timing_queue statistics on the state topic, scheduled every METRICS_INTERVAL
+    schedule_windows(slaveconfig)
+        Closes the due aggregation windows every CLOSE_INTERVAL while an operation has "aggregation"
     stopkill()
-        Called to stop all scheduled RepeatedFunction
+        Called to stop all scheduled events
     """
 
     def __init__(self, timing_queue, publishing_queue):
@@ -127,121 +420,191 @@ class Scheduler(threading.Thread):
         self.timing_queue = timing_queue
         self.publishing_queue = publishing_queue
 
-        self.running_rep_functions = list()        #all running RepeatedFunction 
+        self.timer_heap = TimerHeap()               #all scheduled events
+        self.slaveconfig = dict()                   #scheduled slaveconfig
+        self.operation_timers = dict()              #(slave_name, operation_name): timer_id in timer_heap
+        self.metrics_timer = None                   #timer_id of publish_metrics
+        self.windows_timer = None                   #timer_id closing the due aggregation windows
         #stop
-        self.stop_event = threading.Event()          #ends scheduling RepeatedFunction s
+        self.stop_event = threading.Event()          #ends the thread running the timer_heap
 
         self.timeout_between_functions = 0.27  #time delay between initial start of two reads from the modbus
 
-    def query_task(self, process_request):
-        """When RepeatedFunction executes this function, process_request will be put in timing_queue if queue is not full"""
+    def query_task(self, process_request, interval, due=None):
+        """When a scheduled event is due, process_request will be put in timing_queue, due before the next event of it
+        
+        due: time.monotonic() the timer was due at, the lateness of the timer counts in the latency_metrics
+        """
         
+        request = dict(process_request)
+        request["t_scheduled"] = time.monotonic() if due is None else due
+        request["deadline"] = request["t_scheduled"] + interval #interval 0: due now
         try:
-            self.timing_queue.put(process_request[1], False)
+            self.timing_queue.put(request, False)
         except queue.Full:
             pass
         
+    def publish_metrics(self):
+        """publishes latency percentiles of the last METRICS_INTERVAL, the timing_queue, cache, encoder, codec and spool counters on the state topic"""
+        metrics = {"latency_ms": latency_metrics.report()}
+        if hasattr(self.timing_queue, "statistics"):
+            metrics["timing_queue"] = self.timing_queue.statistics()
+        if hasattr(self.timing_queue, "cache_statistics"):
+            metrics["result_cache"] = self.timing_queue.cache_statistics()
+        metrics["telemetry_encoder"] = telemetry_encoder.statistics()
+        if COMPRESSION == "adaptive":
+            metrics["compression"] = codec_controller.statistics() #chosen codec, achieved ratios
+        if telemetry_spool.enabled:
+            metrics["telemetry_spool"] = telemetry_spool.statistics() #depth and drain progress after an offline period
+        if hasattr(self.publishing_queue, "statistics"):
+            metrics["publish_lanes"] = self.publishing_queue.statistics() #queued, published, dropped and coalesced messages per lane
+        formatted_publish_message(topic=TOPIC_STATE, payload=metrics, c_queue=self.publishing_queue, key="metrics")
+
     def run(self):
         """Start of the Thread"""
         logger.debug("Start the Scheduler ")
         self.startup()
+        self.timer_heap.run(self.stop_event)
 
 
-    def startup(self):
+    def startup(self, sleeptime=None):
         """Start or Restart the Scheduling events"""
+        if sleeptime is None:
+            sleeptime = not FAST_START
 
         #Step 1: Figure out what current setup_modbus.json is and its slaveconfig
-        unused_port_config, slaveconfig = read_setup(self.publishing_queue) #wait to get newest setup
+        unused_port_config, slaveconfig = read_setup(self.publishing_queue, sleeptime=sleeptime) #wait to get newest setup
+
+        #Step 2: Schedule every operation of the slaveconfig
+        self.update(slaveconfig)
+
+        if METRICS_INTERVAL > 0 and self.metrics_timer is None:
+            self.metrics_timer = self.timer_heap.schedule(METRICS_INTERVAL, self.publish_metrics, first_run=time.monotonic() + METRICS_INTERVAL)
 
+    def update(self, slaveconfig):
+        """Schedules the changes between the running and the new slaveconfig, unchanged operations keep their timing. Returns answer text"""
         try:
-            while not self.stop_event.is_set():
-            
-                #Step 2: For every operation in slaveconfig: find out details
-                for slave_name in slaveconfig: #looping through all exisiting slaves
-                    operations = slaveconfig[slave_name]["operations"]
-                    slave_id = slaveconfig[slave_name]["slave_id"]
-                
-                    for operation in operations:    #looping for all operations of a specific slave
-                    
-                        #[Start get Information of Operation]
-                        op = operations[operation]
-                        interval=(op["sampling_interval"]) #interval for Scheduling events
-
-                        process_request = {
-                                            "slave_id": slave_id,
-                                            "startadress": op["startadress"],
-                                            "function_code": op["function_code"],
-                                            "display_name": op["display_name"],
-                                            }
-
-                        if "quantity_of_x" in op:
-                            process_request["quantity_of_x"] = op["quantity_of_x"]
-                        elif "output_value" in op:
-                            process_request["output_value"] = op["output_value"]
-                        else:
-                            logger.error("FATAL ERROR, no output value or quantity_of_x {}".format(process_request))
-                         #[End get Information of Operation]
-
-                        self.stop_event.wait(self.timeout_between_functions) #timeout, so differet request will be executed at different times
-                    
-                        if self.stop_event.is_set():
-                            logger.warning("Error: unwanted break in scheduling new RepeatedFunctions") 
-                            return 
-                        #Step 3: For a specific operation schedule a specific RepeatedFunction every interval seconds
-                        #[Start Schedule new RepeatedFunction]
-                        rf = RepeatedFunction(interval, self.query_task, (self,process_request))
-                        rf.setDaemon = True
-                        rf.start()
-                        self.running_rep_functions.append(rf)
-
-                        logger.debug("scheduleded {} \t at interval {} ".format(process_request, (str(interval)+"s") if interval!=0 else "once occuring"))
-                    
-                        #[End Schedule new RepeatedFunction]
-
-                logger.debug("ending this scheduler thread {}".format(self.running_rep_functions))        
-                return
+            diff = diff_slaveconfig(self.slaveconfig, slaveconfig)
+
+            for key in diff["removed"] + diff["retimed"]:
+                self.timer_heap.cancel(self.operation_timers.pop(key))
+
+            flushed = [self.slaveconfig[slave_name]["operations"][operation]["display_name"] for slave_name, operation in diff["removed"]
+                       if "aggregation" in self.slaveconfig[slave_name]["operations"][operation]] #removed or changed operations
+            if flushed and hasattr(self.timing_queue, "flush_windows"):
+                self.timing_queue.flush_windows(flushed)
+
+            now = time.monotonic()
+            for key in diff["retimed"]: #next sample now, then in the new interval
+                self.schedule_operation(key, slaveconfig, first_run=now)
+
+            for key, offset in zip(diff["added"], self.phase_offsets(diff["added"], slaveconfig)):
+                self.schedule_operation(key, slaveconfig, first_run=now + offset)
+
+            self.slaveconfig = slaveconfig
+            self.schedule_windows(slaveconfig)
+            logger.debug("scheduled {} events".format(len(self.timer_heap)))
+
+            return "\n Scheduler: {} operations added, {} removed, {} changed, {} retimed, {} unchanged".format(
+                len(diff["added"]) - len(diff["changed"]), len(diff["removed"]) - len(diff["changed"]), 
+                len(diff["changed"]), len(diff["retimed"]), len(diff["unchanged"]))
 
         except Exception as e: #should in no case occur
             logger.error("Error scheduling new timing events, consider restarting device: {}".format(e))
-            formatted_publish_message(topic=TOPIC_STATE, payload="Error scheduling new timing events, consider restarting device: {} ".format(e), c_queue=pub_queue)
+            formatted_publish_message(topic=TOPIC_STATE, payload="Error scheduling new timing events, consider restarting device: {} ".format(e), c_queue=self.publishing_queue, reply=True)
+            return "\n Scheduler: ERROR scheduling new timing events {}".format(e)
+
+    def schedule_windows(self, slaveconfig):
+        """closes the aggregation windows without a further sample on a timer, while any operation has "aggregation" """
+        aggregated = any("aggregation" in op for slave in slaveconfig.values() for op in slave["operations"].values())
+        if aggregated and self.windows_timer is None and hasattr(self.timing_queue, "close_windows"):
+            self.windows_timer = self.timer_heap.schedule(CLOSE_INTERVAL, self.timing_queue.close_windows, first_run=time.monotonic() + CLOSE_INTERVAL)
+        elif not aggregated and self.windows_timer is not None:
+            self.timer_heap.cancel(self.windows_timer)
+            self.windows_timer = None
+
+    def phase_offsets(self, keys, slaveconfig):
+        """offsets of the first run of operations, so differet request will be executed at different times
+
+        Default: every operation timeout_between_functions after the previous one.
+        FAST_START: deterministic offsets spread over min(sampling_interval, FAST_START_WINDOW), computed at once.
+        """
+        if not FAST_START:
+            return [(i + 1) * self.timeout_between_functions for i in range(len(keys))]
+
+        offsets = list()
+        for i, (slave_name, operation) in enumerate(keys):
+            interval = slaveconfig[slave_name]["operations"][operation]["sampling_interval"]
+            window = min(interval, FAST_START_WINDOW) if interval > 0 else FAST_START_WINDOW
+            offsets.append(((i * GOLDEN_RATIO) % 1.0) * window)
+        return offsets
+
+    def schedule_operation(self, key, slaveconfig, first_run):
+        """For a specific operation (slave_name, operation_name) schedule an event every interval seconds"""
+        slave_name, operation = key
+        slave_id = slaveconfig[slave_name]["slave_id"]
+        op = slaveconfig[slave_name]["operations"][operation]
+        
+        #[Start get Information of Operation]
+        interval=(op["sampling_interval"]) #interval for Scheduling events
+
+        process_request = {
+                            "port": slaveconfig[slave_name].get("port", su.DEFAULT_PORT),
+                            "slave_id": slave_id,
+                            "startadress": op["startadress"],
+                            "function_code": op["function_code"],
+                            "display_name": op["display_name"],
+                            "priority": op.get("priority", DEFAULT_PRIORITY),
+                            }
+
+        for key_filter in REPORT_FILTER_KEYS + DECODE_KEYS + WRITE_KEYS + CACHE_KEYS + AGGREGATION_KEYS:
+            if key_filter in op:
+                process_request[key_filter] = op[key_filter]
+
+        if "quantity_of_x" in op:
+            process_request["quantity_of_x"] = op["quantity_of_x"]
+        elif "output_value" in op:
+            process_request["output_value"] = op["output_value"]
+        else:
+            logger.error("FATAL ERROR, no output value or quantity_of_x {}".format(process_request))
+        #[End get Information of Operation]
+
+        #[Start Schedule new event]
+        self.operation_timers[key] = self.timer_heap.schedule(interval, self.query_task, process_request, interval, first_run=first_run, pass_due=True)
+
+        logger.debug("scheduleded {} \t at interval {} ".format(process_request, (str(interval)+"s") if interval!=0 else "once occuring"))
+        #[End Schedule new event]
 
     def stopkill(self):
-        """Called to stop all scheduled RepeatedFunctions"""
+        """Called to stop all scheduled events, the thread keeps waiting for startup()"""
         try:
-            self.stop_event.set() #no more scheduling new events
-
-            while len(self.running_rep_functions[:]) != 0:
-            
-                for repfunc_thread in self.running_rep_functions[:]:
-                    repfunc_thread.stop_event.set()     #stop this RepeatedFunction
-
-                for repfunc_thread in self.running_rep_functions[:]:
-                    if not repfunc_thread.is_alive():
-                        self.running_rep_functions.remove(repfunc_thread)
-                        logger.debug("removed {}".format(repfunc_thread))
-
-            # now self.running_rep_functions is empty
-            self.stop_event.clear()
+            self.timer_heap.clear()
+            self.operation_timers = dict()
+            self.slaveconfig = dict()
+            self.metrics_timer = None
+            self.windows_timer = None
             
         except Exception as e:
             logger.error("Unexpected Error, sending to cloud {}".format(e))
-            formatted_publish_message(topic=TOPIC_STATE, payload="Error scheduling old timing events, consider restarting device: {} ".format(e), c_queue=pub_queue)
+            formatted_publish_message(topic=TOPIC_STATE, payload="Error scheduling old timing events, consider restarting device: {} ".format(e), c_queue=self.publishing_queue, reply=True)
 # [END Scheduling]
         
 
 # [START Modbus]
 
-class Modbus_reader(threading.Thread):
+class Modbus_reader(object):
     """
-    
+    Reads the Modbus of one port, run() runs in its own thread started by start()
     ...
 
     Attributes
     ----------
-    timing_queue : queue.Queue Object
-        queue where new request are received from RepeatedFunction / Schedule Object
+    timing_queue : DeadlineQueue Object
+        queue where new request are received from the Schedule Object, most urgent first
     publishing_queue : queue.Queue Object
         queue where new messages are put to be published by the MQTT Module 
+    thread : threading.Thread Object
+        thread running run(), daemon if daemon is True
 
 
     Methods Serial Port Handling
@@ -249,51 +612,81 @@ class Modbus_reader(threading.Thread):
     connect_serial()
         Renews the serial port connection and Modbus RTU_Master object. 
     read_modbus_event()
-        
+        Takes all due requests of the timing_queue, merges them to frames and executes them, 
+        publishes the results which are not suppressed by the report_filter
+    serve_from_cache()
+        Publishes due requests served by fresh values of the result cache without using the bus
+    execute_frame()
+        Executes a merged frame and splits its result back into the results of the single requests
+    execute_request()
+        Executes a single request or frame with the Modbus RTU Master
+    observe_turnaround()
+        Updates observed_turnaround of a slave after a successful transaction
     reconfigure()
-        
+        Reads the port_config of the port from setup_modbus.json and applies it with configure_port()
 
     Methods Serial Port Handling
     -------
+    start()
+        Starts the thread running run()
     run()
-        Called as thread started by Thread.
+        Called in the thread started by start().
         Endless Loop of reconfigure, connect_serial and read_modbus_event, controlled by startup and stopkill.
+    update()
+        Applies a new port_config, reopens the serial port only if needed
     startup()
         Releases run from haltering
     stopkill()
         Called to stop to start haltering run  
+    retire()
+        Called to end run
     """
 
-    def __init__(self, timing_queue, publishing_queue):
-        threading.Thread.__init__(self)
-        
+    def __init__(self, timing_queue, publishing_queue, port_name=su.DEFAULT_PORT):
+        self.thread = None
+        self.daemon = False
 
         self.timing_queue = timing_queue
         self.publishing_queue = publishing_queue
+        self.port_name = port_name                   #name of the port in setup_modbus.json
 
         self.alive = False
+        self.retired = False                         #port was removed from setup_modbus.json, ends run()
         self.serial_connected = False
         
         self.max_master_attemps = int(10)           #maximum attemps to connect master
         self.master_status = self.max_master_attemps #the higher the status, increase the status
 
         self.port_config = dict()
+        self.max_requests_per_plan = 64              #maximum requests taken from the timing_queue and merged at once
+        self.report_filter = DeadbandFilter()        #report by exception
+        self.aggregator = Aggregator()               #window statistics of operations with "aggregation"
+        self.observed_turnaround = dict()            #slave_id: moving average of the turnaround in seconds, for g_bus_budget
+        self.first_sample_time = None                #seconds from the start of the gateway to the first sample
+        self.serial_connects = 0                     #number of successful connections of the serial port
+        self.reopen_requested = False                #update() reopens the port with new settings
         
         self.serial_port = "undefined"
+        self.pooled_master = None                    #TcpMaster of the connection_pool for "type" tcp and rtu_over_tcp
+        self.prefetched = dict()                     #id(frame): (result or ModbusError, bus start) of pipelined frames
+        self.breakers = CircuitBreakers()            #per slave, skips requests to slaves which stopped responding
+        self.timeouts = ResponseTimeouts()           #per slave learned turnaround and response timeout
+        self.cache = ResultCache()                   #read values serving operations with "cache_ttl"
+        self.master_lock = threading.RLock()         #response timeout and transaction on the master, the lock of a pooled TcpMaster shared by ports
+        self.timeouts_saved = time.monotonic()
                
     def connect_serial(self): 
-        "connect the serial port and modbus rtu master over serial port"
+        "connect the serial port and modbus rtu master over serial port, or a Modbus TCP master of the connection_pool"
         logger.debug("calling connect serial")
-        try:
-            if self.serial_port != "undefined": #if initialisized
-                self.serial_port.close()
-                logger.debug("serial port closed successfully")
-        except: 
-            pass
+        self.close_transport()
 
         try:
             self.serial_connected = False
             self.master_status = self.max_master_attemps
+
+            if self.port_config.get("type", "rtu") != "rtu":
+                self.connect_tcp()
+                return
             
             self.serial_port = serial.Serial(
                 port=self.port_config["port"], 
@@ -311,6 +704,7 @@ class Modbus_reader(threading.Thread):
                 )
             self.master.set_timeout(self.port_config["timeout_connection"]) #max waittime for modbus answers
             self.master.set_verbose(False) #if True, log additional modbus info
+            self.master_lock = threading.RLock()
 
             #Successfull, set flags
             logger.debug("connected rtu master")
@@ -318,73 +712,334 @@ class Modbus_reader(threading.Thread):
             self.serial_connected = True
             self.master_status = 0
 
-            with self.timing_queue.mutex: #reset timing events queue
-                self.timing_queue.queue.clear()
+            self.count_connect()
 
         except Exception as e:
             time.sleep(3)
             logger.error("ERROR Serial Port connection not successful{}".format(e))
             self.serial_connected = False
 
+    def connect_tcp(self):
+        """connects a Modbus TCP or RTU over TCP master, shared with other ports using the same remote gateway"""
+        self.pooled_master = connection_pool.acquire(self.port_config)
+        self.master = self.pooled_master
+        self.master_lock = self.pooled_master.lock
+        with self.master_lock:
+            self.master.set_timeout(self.port_config["timeout_connection"])
+            self.master.open()
+        logger.debug("connected {} master {}".format(self.port_config["type"], self.port_config["host"]))
+
+        self.serial_connected = True
+        self.master_status = 0
+        self.count_connect()
+
+    def count_connect(self):
+        """counts a successful connect, clears the timing queue after a reconnect
+        
+        Keeps the first requests after the start and the requests waiting for a reopen with new settings (see update()).
+        """
+        if self.serial_connects > 0 and not self.reopen_requested:
+            self.timing_queue.clear()
+        self.reopen_requested = False
+        self.serial_connects += 1
+
+    def close_transport(self):
+        """closes the serial port or releases the pooled TCP master"""
+        try:
+            if self.serial_port != "undefined": #if initialisized
+                self.serial_port.close()
+                logger.debug("serial port closed successfully")
+        except Exception as ex:
+            logger.error("error closing serial port: {}".format(ex))
+
+        if self.pooled_master is not None:
+            connection_pool.release(self.pooled_master)
+            self.pooled_master = None
+
+    def execute_request(self, request):
+        """executes a single request or frame with the Modbus RTU Master, returns the result"""
+        result =  REQUEST_NOT_POSSIBLE #default
+        if not self.serial_connected: #serial port failed earlier in this batch
+            return result
+
+        bus_start = time.monotonic()
+        try:
+            if id(request) in self.prefetched: #executed pipelined by prefetch_frames
+                result, bus_start = self.prefetched.pop(id(request))
+                if isinstance(result, Exception):
+                    raise result
+            else:
+                with self.master_lock: #no other port sets the timeout of a shared master in between
+                    self.set_request_timeout(request)
+                    result = self.master.execute(**master_arguments(request))
+                self.observe_turnaround(request, time.monotonic() - bus_start)
+            self.request_succeeded(request, result)
+
+        except Exception as ex:
+            result = REQUEST_NOT_POSSIBLE #e.g. the timeout of a pipelined frame is its result
+            self.request_failed(request, ex) #raises ModbusError
+            
+        finally:
+            request["t_bus_start"] = bus_start
+            request["t_bus_end"] = time.monotonic()
+
+        return result
+
+    def request_succeeded(self, request, result):
+        logger.debug("slave no {}, starting_adress {} with name {} and {} ".format(request["slave_id"], request["startadress"], request.get("display_name", "frame"),  str(result)))        
+        self.master_status = 0 #successfull read, reset to 0
+        self.cache.store(request, result, time.monotonic())
+        self.report_breaker(request["slave_id"], self.breakers.success(request["slave_id"], time.monotonic()))
+
+    def request_failed(self, request, ex):
+        """counts a failed request, raises ModbusError of a responding slave again so the caller can split the frame
+
+        A slave which does not respond only trips its own circuit breaker, the port is reopened if all slaves stopped responding.
+        """
+        slave_id = request["slave_id"]
+        if is_slave_failure(ex):
+            logger.warning("slave {} on port {} not responding: {}".format(slave_id, self.port_name, ex))
+            if not isinstance(ex, ModbusError):
+                self.timeouts.timed_out(slave_id)
+            self.report_breaker(slave_id, self.breakers.failure(slave_id, time.monotonic()))
+            if self.breakers.all_open():
+                logger.warning("no slave on port {} is responding, reopening".format(self.port_name))
+                self.serial_connected = False
+            return
+
+        if isinstance(ex, ModbusError): #the slave responded, the port works
+            logger.warning("ModbusError in read_modbus_event {}".format(ex))
+            self.report_breaker(slave_id, self.breakers.success(slave_id, time.monotonic()))
+            raise ex
+
+        #other error, like serial port etc.
+        logger.warning("Unexpected error in read_modbus_event {}".format(ex))
+        self.master_status = self.master_status + 5 #unsuccessfull, increase the status
+        self.serial_connected = False
+
+    def observe_turnaround(self, request, duration):
+        """updates the learned turnaround of the slave: duration of the transaction without the frames on the line"""
+        slave_id = request["slave_id"]
+        self.timeouts.observe(slave_id, max(0.0, duration - wire_time(self.port_config, request)))
+        self.observed_turnaround[slave_id] = self.timeouts.mean(slave_id)
+
+    def response_timeout(self, request):
+        """learned response timeout of the slave of request, at most timeout_connection"""
+        timeout = self.port_config["timeout_connection"]
+        if self.port_config.get("adaptive_timeout", True):
+            timeout = self.timeouts.timeout(request["slave_id"], wire_time(self.port_config, request), timeout)
+        return timeout
+
+    def set_request_timeout(self, request):
+        """sets the response timeout of request in the master before every request, a pooled master may be shared with other ports"""
+        self.master.set_timeout(self.response_timeout(request))
+
+    def load_timeouts(self):
+        """takes the learned timeouts of the last run"""
+        self.timeouts.load(self.port_name)
+        for slave_id in self.timeouts.estimates:
+            self.observed_turnaround[slave_id] = self.timeouts.mean(slave_id)
+
+    def save_timeouts(self, force=False):
+        """saves the learned timeouts every TIMEOUTS_SAVE_INTERVAL"""
+        if force or time.monotonic() - self.timeouts_saved > TIMEOUTS_SAVE_INTERVAL:
+            self.timeouts.save(self.port_name)
+            self.timeouts_saved = time.monotonic()
+
+    def execute_frame(self, frame):
+        """executes a frame of the read plan admitted by its circuit breaker, returns list of (request, result) of its members"""
+        try:
+            result = self.execute_request(frame)
+            if result is REQUEST_NOT_POSSIBLE:
+                return [(request, REQUEST_NOT_POSSIBLE) for request in frame["members"]]
+            split = decode_frame(frame, result)
+
+        except ModbusError:
+            if len(frame["members"]) == 1:
+                return [(frame["members"][0], REQUEST_NOT_POSSIBLE)]
+
+            #e.g. a gap of the merged frame contains illegal adresses, execute the requests one by one
+            logger.debug("merged frame failed, executing {} requests one by one".format(len(frame["members"])))
+            split = list()
+            for request in frame["members"]:
+                try:
+                    result = self.execute_request(request)
+                    split.append((request, result if result is REQUEST_NOT_POSSIBLE else decode_result(request, result)))
+                except ModbusError:
+                    split.append((request, REQUEST_NOT_POSSIBLE))
+
+        if needs_read_back(split):
+            try:
+                read_back = self.execute_request(read_back_request(frame))
+            except ModbusError:
+                read_back = REQUEST_NOT_POSSIBLE
+            split = verified_split(frame, split, read_back)
+        return split
+
     def read_modbus_event(self):
-        """read operations of the timing_queue with the Modbus RTU Master and Execute them with """
+        """read operations of the timing_queue with the Modbus RTU Master and Execute them with 
+        
+        All requests waiting in the timing_queue are merged to as few Modbus frames as possible, see g_read_plan.
+        """
 
         logger.debug("calling read_modbus_event")
         
         while self.serial_connected and self.alive and self.master_status<self.max_master_attemps-1:
 
             request = self.timing_queue.get() #blocking call until new request is received
-            if self.alive == False: #discontinue if function is wished to be stopped
-                self.timing_queue.task_done()    
+            if self.alive == False or self.serial_connected == False: #discontinue if function is wished to be stopped or port reopened
+                self.requeue(request)
                 break
+            if is_wake_up(request): #of an earlier stop or reopen
+                self.timing_queue.task_done()
+                continue
+            requests = [request]
 
-            slave_id = request["slave_id"]
-            startadress = request["startadress"]
-            function_code = request["function_code"]
-            display_name = request["display_name"]   
+            frames = self.admit_frames(self.plan_requests(requests))
+            if self.port_config.get("max_pipeline", 1) > 1:
+                self.prefetch_frames(frames)
 
-            result =  (99999,"modbus_request_not_possible") #default
-            try:
-                if "quantity_of_x" in request:
-                    result = self.master.execute(slave=slave_id, function_code=function_code, starting_address=startadress, quantity_of_x= request["quantity_of_x"] ) #read
-                elif "output_value" in request:
-                    result = self.master.execute(slave=slave_id, function_code=function_code, starting_address=startadress, output_value= request["output_value"] ) #write
-                
-                
-                logger.debug("slave no {}, starting_adress {} with name {} and {} ".format(slave_id, startadress, display_name,  str(result)))        
-                
-                self.master_status = 0 #successfull read, reset to 0
+            for frame in frames:
+                for request, result in self.execute_frame(frame):
+                    self.publish_result(frame, request, result)
 
-                
-            except ModbusError as exc:
-                self.master_status = self.master_status + 1 #unsuccessfull, increase the status
-                logger.warning("ModbusError in read_modbus_event {}".format(ex))
+            self.finish_requests(requests)
 
-            except Exception as ex: #other error, like serial port etc.
-                logger.warning("Unexpected error in read_modbus_event {}".format(ex))
-                self.master_status = self.master_status + 5 #unsuccessfull, increase the status
-                self.serial_connected = False
-
-            payload = {"na": display_name, "res": result, "sl": slave_id, "time": time.time()}
-            formatted_publish_message(topic = TOPIC_EVENT, payload=payload, c_queue = self.publishing_queue)
+        logger.warning("Disconnected the Modbus, restarting")
+        self.close_transport()
 
+    def plan_requests(self, requests):
+        """adds all other due requests of the timing_queue to requests, returns the frames of their read plan"""
+        while len(requests) < self.max_requests_per_plan: #collect all other due requests
+            try:
+                request = self.timing_queue.get(False)
+            except queue.Empty:
+                break
+            if is_wake_up(request): #read_modbus_event checks the flags after this plan
+                self.timing_queue.task_done()
+                continue
+            requests.append(request)
+
+        t_dequeued = time.monotonic()
+        for request in requests:
+            request["t_dequeued"] = t_dequeued
+
+        return compile_read_plan(self.serve_from_cache(requests), gap_tolerance=self.port_config.get("read_gap_tolerance", 0))
+
+    def admit_frames(self, frames):
+        """publishes the requests of frames whose slave has an open circuit breaker as not possible, returns the frames for the bus
+
+        Checked once per frame before any bus traffic, also before the frames are pipelined. A half open breaker admits one probe.
+        """
+        now = time.monotonic()
+        admitted = list()
+        for frame in frames:
+            if self.breakers.allow(frame["slave_id"], now):
+                admitted.append(frame)
+                continue
+            for request in frame["members"]: #slave not responding, wait for the next probe
+                self.publish_result(frame, request, REQUEST_NOT_POSSIBLE)
+        return admitted
+
+    def serve_from_cache(self, requests):
+        """publishes the requests served by fresh cached values (see g_result_cache), returns the requests for the bus"""
+        now = time.monotonic()
+        writing = {request["slave_id"] for request in requests if "output_value" in request} #cached values of these slaves may change
+        remaining = list()
+        for request in requests:
+            result = None if request["slave_id"] in writing else self.cache.lookup(request, now)
+            if result is None:
+                remaining.append(request)
+                continue
+            request["t_bus_start"] = request["t_bus_end"] = now
+            self.publish_result(request, request, decode_result(request, result))
+        return remaining
+
+    def publish_result(self, frame, request, result):
+        """records the latency and publishes the result, unless unchanged within its deadband, or the statistics of its aggregation window"""
+        latency_metrics.record(request, frame)
+        payload = {"na": request["display_name"], "res": result, "sl": request["slave_id"], "time": time.time()}
+        if "aggregation" in request:
+            for sample in self.aggregator.aggregate(request, payload):
+                formatted_publish_message(topic = TOPIC_EVENT, payload=sample, c_queue = self.publishing_queue)
+            return
+        if not self.report_filter.report(request, result, time.monotonic()): #unchanged within deadband
+            return
+        formatted_publish_message(topic = TOPIC_EVENT, payload=payload, c_queue = self.publishing_queue)
+
+    def burst_upload(self, names):
+        """publishes the raw samples kept by the aggregator for names, returns their number"""
+        samples = self.aggregator.take_raw(names)
+        for sample in samples:
+            formatted_publish_message(topic = TOPIC_EVENT, payload=sample, c_queue = self.publishing_queue)
+        return len(samples)
+
+    def close_windows(self):
+        """publishes the statistics of the aggregation windows due without a further sample"""
+        for sample in self.aggregator.close_due(time.time()):
+            formatted_publish_message(topic = TOPIC_EVENT, payload=sample, c_queue = self.publishing_queue)
+
+    def flush_windows(self, names):
+        """publishes the statistics of the open aggregation windows of names, e.g. of removed operations"""
+        for sample in self.aggregator.flush(names):
+            formatted_publish_message(topic = TOPIC_EVENT, payload=sample, c_queue = self.publishing_queue)
+
+    def requeue(self, request):
+        """puts a request taken by a stopping or reopening read_modbus_event back, it is executed after the reopen"""
+        if not is_wake_up(request):
+            self.timing_queue.put(request, False)
+        self.timing_queue.task_done()
+
+    def finish_requests(self, requests):
+        self.prefetched.clear()
+        self.save_timeouts()
+
+        if self.first_sample_time is None and self.serial_connected: 
+            self.report_first_sample()
+
+        for unused_request in requests:
             self.timing_queue.task_done()
 
-        logger.warning("Disconnected the Modbus, restarting")
+    def prefetch_frames(self, frames):
+        """executes the frames pipelined on a Modbus TCP connection, the results are taken by execute_request
+
+        Every frame waits for the learned response timeout of its slave, a timeout is the result of its frame only.
+        """
+        bus_start = time.monotonic()
         try:
-            if self.serial_port != "undefined": #if not just initialisized
-                self.serial_port.close()
-        except Exception as ex:
-            logger.error("error closing serial port: {}".format(ex))
+            with self.master_lock:
+                results = self.master.execute_pipelined(frames, self.port_config["max_pipeline"], [self.response_timeout(frame) for frame in frames])
+        except Exception as ex: #connection failed, execute_request executes the frames one by one
+            logger.warning("pipelined execution failed {}".format(ex))
+            return
+        for frame, result in zip(frames, results):
+            self.prefetched[id(frame)] = (result, bus_start)
 
     def reconfigure(self):
         """called to reassign new port config"""
-        self.port_config, unused_slaveconfig = read_setup(self.publishing_queue, sleeptime=False, send_answer_to_cloud = True)
+        port_configs, unused_slaveconfig = read_setup(self.publishing_queue, sleeptime=False, send_answer_to_cloud = (self.port_name == su.DEFAULT_PORT))
+        self.configure_port(port_configs)
+
+    def configure_port(self, port_configs):
+        """takes the port_config of the port from port_configs, halts if the port is no longer configured"""
+        self.port_config = port_configs.get(self.port_name, dict())
+        self.breakers.configure(self.port_config)
+        self.cache.configure(self.port_config)
+
+        if not self.port_config: #port no longer configured
+            logger.warning("port {} is not configured, haltering".format(self.port_name))
+            self.alive = False
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="modbus_{}".format(self.port_name))
+        self.thread.daemon = self.daemon
+        self.thread.start()
         
     def run(self):
         self.alive = True
+        self.load_timeouts()
         
-        while True:        #Endless Loop of reconfigure, connect_serial and read_modbus_event
+        while not self.retired:        #Endless Loop of reconfigure, connect_serial and read_modbus_event
             logger.debug("RESTART the Modbus reader")
             
             try: 
@@ -395,13 +1050,50 @@ class Modbus_reader(threading.Thread):
                     self.connect_serial() #serial connected
                     self.read_modbus_event()
                 
-                while self.alive == False: # do until startup is callled
+                while self.alive == False and not self.retired: # do until startup is callled
                     logger.debug("Modbus reader haltering")
                     time.sleep(2)
             except Exception as ex:
                 logger.error("Unexpected run modbus error {}".format(ex))
                 time.sleep(1)
 
+        self.save_timeouts(force=True)
+
+    def report_breaker(self, slave_id, state):
+        """publishes a changed circuit breaker state of a slave on the state topic"""
+        if state is None:
+            return
+        breaker = self.breakers.breakers[slave_id]
+        payload = {"breaker": {"port": self.port_name, "sl": slave_id, "state": state, "failures": breaker["failures"]}}
+        if state == OPEN:
+            payload["breaker"]["retry_in"] = round(breaker["backoff"], 1)
+        logger.warning("circuit breaker {}".format(payload["breaker"]))
+        formatted_publish_message(topic=TOPIC_STATE, payload=payload, c_queue=self.publishing_queue,
+                                  key="breaker:{}:{}".format(self.port_name, slave_id)) #the latest state per slave
+
+    def report_first_sample(self):
+        """publishes the time from the start of the gateway to the first read from the modbus"""
+        self.first_sample_time = time.monotonic() - su.process_start
+        logger.info("time to first sample {:.3f}s".format(self.first_sample_time))
+        formatted_publish_message(topic=TOPIC_STATE, payload="time to first sample {:.3f}s on port {}".format(self.first_sample_time, self.port_name), c_queue=self.publishing_queue,
+                                  key="first_sample:{}".format(self.port_name))
+
+    def update(self, port_config):
+        """Applies a new port_config, reopens the serial port only if its serial settings changed. Returns answer text"""
+        reopen = any(self.port_config.get(key) != port_config.get(key) for key in TRANSPORT_KEYS)
+        self.port_config = port_config
+        self.breakers.configure(port_config)
+        self.cache.configure(port_config)
+
+        if reopen:
+            self.cache.clear() #values of another bus
+            self.reopen_requested = True
+            self.serial_connected = False #read_modbus_event ends, run() connects with the new port_config
+            self.timing_queue.put(dict(WAKE_UP), False) #now, not with the next request
+            return "\n Modbus reader: connection settings of port {} changed, reopening {}".format(self.port_name, port_config.get("port", port_config.get("host")))
+
+        return "\n Modbus reader: serial port {} kept open".format(self.port_name)
+
     def startup(self):
         self.alive = True
 
@@ -409,4 +1101,114 @@ class Modbus_reader(threading.Thread):
         self.alive = False
         self.serial_connected = False
 
+    def retire(self):
+        """ends run(), e.g. if the port is removed from the setup_modbus.json"""
+        self.retired = True
+        self.stopkill()
+        self.timing_queue.put(dict(WAKE_UP), False) #wakes up read_modbus_event
+
+# [END Modbus]
+
+# [START Modbus Ports]
+
+class Modbus_readers(object):
+    """
+    One Modbus_reader with its own timing queue per port of the setup_modbus.json, all feeding the same publishing_queue.
+    Used by the Scheduler like a timing queue: put() routes a request to the timing queue of its port.
+    ...
+
+    Attributes
+    ----------
+    readers : dict
+        port name: Modbus_reader Object
+    publishing_queue : queue.Queue Object
+        queue where new messages are put to be published by the MQTT Module 
+
+    Methods
+    -------
+    start()
+        Starts a Modbus_reader for every port of the setup_modbus.json
+    put(request)
+        Puts a request in the timing queue of its port
+    update(port_configs)
+        Applies new port configs, starts readers of new ports and retires readers of removed ports
+    statistics(), observed_turnaround
+        Timing queue counters and observed turnaround per port
+    startup(), stopkill(), close_windows(), flush_windows(names)
+        As Modbus_reader, for all readers
+    """
+
+    reader_class = Modbus_reader
+    queue_class = DeadlineQueue
+
+    def __init__(self, publishing_queue, queue_size=100):
+        self.publishing_queue = publishing_queue
+        self.queue_size = queue_size
+        self.readers = dict()
+        self.daemon = True
+
+    def start_reader(self, port_name):
+        reader = self.reader_class(self.queue_class(maxsize=self.queue_size), self.publishing_queue, port_name)
+        reader.daemon = self.daemon
+        reader.start()
+        self.readers[port_name] = reader
+
+    def start(self):
+        port_configs, unused_slaveconfig = read_setup(self.publishing_queue, sleeptime=False)
+        for port_name in port_configs:
+            self.start_reader(port_name)
+
+    def put(self, request, block=True, timeout=None):
+        reader = self.readers.get(request.get("port", su.DEFAULT_PORT))
+        if reader is None:
+            logger.debug("no reader for port of {}".format(request.get("display_name")))
+            return
+        reader.timing_queue.put(request, block, timeout)
+
+    def update(self, port_configs):
+        """applies new port configs, returns answer text"""
+        answer = ""
+        for port_name in list(self.readers):
+            if port_name not in port_configs:
+                self.readers.pop(port_name).retire()
+                answer += "\n Modbus reader: port {} removed".format(port_name)
+
+        for port_name, port_config in port_configs.items():
+            if port_name in self.readers:
+                answer += self.readers[port_name].update(port_config)
+            else:
+                self.start_reader(port_name)
+                answer += "\n Modbus reader: port {} added".format(port_name)
+        return answer
+
+    def statistics(self):
+        return {port_name: reader.timing_queue.statistics() for port_name, reader in self.readers.items()}
+
+    def cache_statistics(self):
+        return {port_name: reader.cache.statistics() for port_name, reader in self.readers.items()}
+
+    def burst_upload(self, names):
+        """publishes the kept raw samples of names ("all": of every operation) on all ports, returns their number"""
+        return sum(reader.burst_upload(names) for reader in list(self.readers.values()))
+
+    def close_windows(self):
+        for reader in list(self.readers.values()):
+            reader.close_windows()
+
+    def flush_windows(self, names):
+        for reader in list(self.readers.values()):
+            reader.flush_windows(names)
+
+    @property
+    def observed_turnaround(self):
+        return {port_name: dict(reader.observed_turnaround) for port_name, reader in self.readers.items()}
+
+    def startup(self):
+        for reader in self.readers.values():
+            reader.startup()
+
+    def stopkill(self):
+        for reader in self.readers.values():
+            reader.stopkill()
+
 # [END Modbus]
\ No newline at end of file
@@ -25,8 +25,10 @@ import time
 import threading
 import queue
 import json
-import gzip, lzma
+import gzip, lzma, zlib
 import sys
+import base64
+import collections
 
 import jwt
 import paho.mqtt.client as mqtt
@@ -40,16 +42,32 @@ import paho.mqtt.client as mqtt
 from g_schema_check import modbus_json_check, logger, check_configuration_message
 import g_shared_utils as su
 from g_shared_utils import logger
+from g_telemetry_encoder import encode_batch
+from g_spool import TelemetrySpool, DEFAULT_SEGMENT_BYTES
 #[includes own scripts]
 
 # [Start GLOBAL Variables]
-global publish_telemetry_list
-publish_telemetry_list = list()
+ENCODER_QUEUE_SIZE = 10000 #samples waiting for the telemetry_encoder, further samples are dropped
+BYTES_PER_SAMPLE_GAIN = 0.25 #weight of the last batch in the estimate of the compressed bytes per sample
+SPOOL_POLL_INTERVAL = 0.1 #seconds handle_mqtt waits for state messages before checking the telemetry_spool again
+CODECS = [("none", 0), ("gzip", 1), ("gzip", 6), ("gzip", 9), ("lzma", 0), ("lzma", 6), ("lzma", 9)] #choices of "compression": "adaptive", cheapest first
+CODEC_GAIN = 0.25 #weight of the last batch in the estimates of the codec_controller
+CODEC_PROBE_INTERVAL = 50 #batches after which the estimates of the neighbouring codecs are measured again
+DICTIONARY_BATCHES = 10 #batches the preset dictionary of "compression_dictionary" is built from
+DICTIONARY_SIZE = 32768 #bytes of the preset dictionary, the window of deflate
+JWT_REFRESH_MARGIN = 60 #seconds before the expiry of its JWT the connection is rotated
+JWT_PREPARE_LEAD = 30 #seconds before the rotation the next JWT is minted
+ROTATION_CONNACK_TIMEOUT = 10 #seconds the new client of a rotation waits for the acknowledgement of its connection
+ROTATION_RETRY_INTERVAL = 5 #seconds between attempts of a failed rotation, the old JWT is valid until JWT_REFRESH_MARGIN has passed
+UNACKNOWLEDGED_MAX = 1000 #QoS 1 messages kept for a carry over to the new client of a rotation, paho queues 200 at most
 
 with open(su.setup_mqtt_filepath) as file: #open setup_mqtt.json
     global ALGORITHM, CA_CERTS, PRIVATE_KEY_FILE, JWT_EXPIRES_MINUTES
     global CLOUD_REGION, PROJECT_ID, REGISTRY_ID, DEVICE_ID, MQTT_BRIDGE_HOSTNAME, MQTT_BRIDGE_PORT, KEEPALIVE
-    global PUFFER_LENGH, COMPRESSION
+    global PUFFER_LENGH, COMPRESSION, ENCODING, FLUSH_MAX_AGE, FLUSH_MAX_BYTES, METRICS_INTERVAL, FAST_START, RUNTIME
+    global SPOOL_MAX_BYTES, SPOOL_SEGMENT_BYTES, SPOOL_DRAIN_RATE, SPOOL_DIRECTORY
+    global COMPRESSION_TIME_BUDGET, COMPRESSION_BYTES_PER_HOUR, COMPRESSION_DICTIONARY
+    global EVENTS_RATE, STATE_RATE, REPLY_RATE
     global TOPIC_EVENT, TOPIC_STATE
 
     setup_json = json.load(file)
@@ -67,8 +85,24 @@ with open(su.setup_mqtt_filepath) as file: #open setup_mqtt.json
     MQTT_BRIDGE_PORT = int(setup_json["cloud_destination"]["mqtt_bridge_port"])
     KEEPALIVE = int(setup_json["cloud_destination"]["keepalive"])
 
-    COMPRESSION = setup_json["paramteter_settings"]["compression"].lower()
+    COMPRESSION = setup_json["paramteter_settings"]["compression"].lower() #"gzip", "lzma", "none" or "adaptive": chosen per batch by the codec_controller
+    COMPRESSION_TIME_BUDGET = setup_json["paramteter_settings"].get("compression_time_budget", 0.05) #"adaptive": fraction of the time spent compressing at most
+    COMPRESSION_BYTES_PER_HOUR = setup_json["paramteter_settings"].get("compression_bytes_per_hour", 0) #"adaptive": telemetry bytes per hour aimed at, 0: as few as the time budget allows
+    COMPRESSION_DICTIONARY = bool(setup_json["paramteter_settings"].get("compression_dictionary", False)) #"adaptive": zlib with a preset dictionary built from the first batches instead of gzip
     PUFFER_LENGH = setup_json["paramteter_settings"]["puffer_lengh"]
+    ENCODING = setup_json["paramteter_settings"].get("encoding", "json").lower() #"json" or "binary": columnar batches, see g_telemetry_encoder
+    FLUSH_MAX_AGE = setup_json["paramteter_settings"].get("flush_max_age", 60) #seconds a sample waits in a batch at most, 0: no limit
+    FLUSH_MAX_BYTES = setup_json["paramteter_settings"].get("flush_max_bytes", 0) #estimated compressed bytes of a batch at most, 0: no limit
+    METRICS_INTERVAL = setup_json["paramteter_settings"].get("metrics_interval", 600) #seconds between latency reports on the state topic, 0: off
+    FAST_START = bool(setup_json["paramteter_settings"].get("fast_start", False)) #no fixed startup delays, first samples within a second
+    RUNTIME = setup_json["paramteter_settings"].get("runtime", "threads") #"threads" or "asyncio": all modules in one event loop, see g_async_runtime
+    SPOOL_MAX_BYTES = setup_json["paramteter_settings"].get("spool_max_bytes", 0) #disk bytes of the telemetry_spool, 0: telemetry queued in memory, see g_spool
+    SPOOL_SEGMENT_BYTES = setup_json["paramteter_settings"].get("spool_segment_bytes", DEFAULT_SEGMENT_BYTES)
+    SPOOL_DRAIN_RATE = setup_json["paramteter_settings"].get("spool_drain_rate", 0) #bytes per second of spooled telemetry published at most, 0: no limit
+    SPOOL_DIRECTORY = os.path.join(su.directory_path, setup_json["paramteter_settings"].get("spool_directory", "spool"))
+    EVENTS_RATE = setup_json["paramteter_settings"].get("events_rate", 0) #telemetry messages per second published at most, 0: no limit, see g_publish_lanes
+    STATE_RATE = setup_json["paramteter_settings"].get("state_rate", 0.2) #state messages per second published at most, the newest per key
+    REPLY_RATE = setup_json["paramteter_settings"].get("reply_rate", 0.5) #answers to configuration updates and commands per second published at most
 
     TOPIC_EVENT = setup_json["global_topics"]["topic_event"]
     TOPIC_STATE = setup_json["global_topics"]["topic_state"]
@@ -77,80 +111,427 @@ with open(su.setup_mqtt_filepath) as file: #open setup_mqtt.json
 
 
 # [Start helper_functions]
-def formatted_publish_message(topic, payload, c_queue):
-    global publish_telemetry_list
-    global PUFFER_LENGH, COMPRESSION
-    
-    
+def encode_telemetry(samples):
+    """payload of a batch of samples: JSON or binary (ENCODING), compressed with COMPRESSION"""
+    if ENCODING == "binary":
+        data = encode_batch(samples)
+    else:
+        data = json.dumps(samples, indent=0)
+
+    if COMPRESSION == "adaptive":
+        return codec_controller.compress(data if isinstance(data, bytes) else data.encode('utf-8'))
+    if COMPRESSION == "gzip":
+        return gzip.compress(data=data if isinstance(data, bytes) else data.encode('utf-8'), compresslevel=9)
+    elif COMPRESSION == "lzma":
+        return lzma.compress(data=data if isinstance(data, bytes) else data.encode('utf-8'),  preset=9)
+    return data
+
+
+def formatted_publish_message(topic, payload, c_queue, key=None, reply=False):
+    """queues a message for handle_mqtt: telemetry (TOPIC_EVENT) through the telemetry_encoder, state messages directly
+
+    State messages go to the state lane of the PublishLanes, where a newer message of the same key replaces the queued one
+    (default key: the keys of a dict payload). With reply=True, and for other payloads (e.g. error texts) without a key,
+    they go to the reply lane and are never replaced.
+    """
     if topic == TOPIC_EVENT:
-        publish_telemetry_list.append(payload)
-        
-        if len(publish_telemetry_list)>PUFFER_LENGH:
-            accumulated_list = json.dumps(publish_telemetry_list, indent=0)
-            
-            if COMPRESSION == "gzip":
-                accumulated_list = gzip.compress(data=accumulated_list.encode('utf-8'), compresslevel=9)
-            elif COMPRESSION == "lzma":
-                accumulated_list = lzma.compress(data=accumulated_list.encode('utf-8'),  preset=9)
-                
-            #print("size of {}".format(asizeof.asizeof(accumulated_list)))
-            dic = {"sub_topic": TOPIC_EVENT,
-                    "payload": accumulated_list,
-                    "qos":1,
-            }
-            try:
-                c_queue.put(dic, False)
-            except queue.Full:
-                pass
-
-            
-            publish_telemetry_list = list()
+        telemetry_encoder.submit(payload, c_queue)
 
     if topic == TOPIC_STATE:
+        if key is None and not isinstance(payload, dict): #unrelated texts must not replace each other
+            reply = True
+        elif key is None:
+            key = ",".join(sorted(payload))
         payload = json.dumps(payload, indent=0)
         dic = {"sub_topic": TOPIC_STATE,
                 "payload": payload,
                 "qos":0,                    #qos 0 can improve stability of connection, as multiple send of different state messages with period of >1s leads to interval.
                 }
         try:
-            c_queue.put(dic, False)
+            if not hasattr(c_queue, "put_state"): #plain queue.Queue
+                c_queue.put(dic, False)
+            elif reply:
+                c_queue.put_reply(dic)
+            else:
+                c_queue.put_state(dic, key)
         except queue.Full:
             pass
 # [End helper_functions]
 
-# [Start jwt]
-def create_jwt(PROJECT_ID, PRIVATE_KEY_FILE, ALGORITHM):
-    """Creates a JWT (https://jwt.io) to establish an MQTT connection.
-        
-         PROJECT_ID: Cloud Project ID
-         PRIVATE_KEY_FILE: A path to the RSA256 or ES256 private key file.
-         ALGORITHM: Either 'RS256' or 'ES256'
-
-        Returns:
-            A JWT generated from the given PROJECT_ID and private key, which
-            expires after JWT_EXPIRES_MINUTES. After this time, the client will be
-            disconnected.
-        Raises:
-            ValueError: If the PRIVATE_KEY_FILE does not contain a known key.
-        """
 
-    token = {
-            # The time that the token was issued at
-            'iat': datetime.datetime.utcnow(),
-            # The time the token expires.
-            'exp': datetime.datetime.utcnow() + datetime.timedelta(minutes=int(JWT_EXPIRES_MINUTES)),
-            # The audience field should always be set to the GCP project id.
-            'aud': PROJECT_ID
-    }
+# [Start Class CodecController]
+class CodecController(object):
+    """
+    Chooses codec and level of every telemetry batch with "compression": "adaptive", from the measured compression time and ratio.
+
+    Every codec of CODECS is measured (seconds per raw byte, ratio) by compressing a batch with it, again after CODEC_PROBE_INTERVAL batches.
+    Codecs above a codec taking more than COMPRESSION_TIME_BUDGET of the time (e.g. on a busy CPU) are not tried.
+    Of the codecs within the time budget, the fastest one meeting COMPRESSION_BYTES_PER_HOUR is chosen,
+    without target or if none meets it the one with the best ratio.
+    With COMPRESSION_DICTIONARY, gzip is replaced by zlib with a preset dictionary of the first DICTIONARY_BATCHES batches,
+    published once on the state topic (see g_telemetry_decoder.register_dictionary).
+        ...
+
+    Attributes
+    ----------
+    index : int
+        position of the current codec in CODECS
+    estimates : dict
+        (codec, level): {"seconds_per_byte", "ratio": compressed / raw bytes, "batches", "probed": batch number of the last measurement}
+    raw_rate : float
+        moving average of the raw telemetry bytes per second
+    dictionary : bytes
+        preset dictionary of zlib, None until built
+    counters : dict
+        batches, raw_bytes, compressed_bytes, compress_seconds
+
+    Methods
+    -------
+    compress(data)
+        Returns data compressed with the current codec, measures it and chooses the codec of the next batch
+    take_dictionary_message()
+        Returns the state message publishing a new dictionary once, otherwise None
+    return_dictionary_message(message)
+        Returns a taken dictionary message which could not be queued, it is taken again with the next batch
+    statistics()
+        Returns the current codec, achieved ratios and batches per codec
+    """
+
+    def __init__(self):
+        self.index = CODECS.index(("gzip", 9))
+        self.estimates = dict()
+        self.raw_rate = None
+        self.last_batch = None
+        self.samples = list()
+        self.dictionary = None
+        self.dictionary_message = None
+        self.counters = {"batches": 0, "raw_bytes": 0, "compressed_bytes": 0, "compress_seconds": 0.0}
+
+    def compress_with(self, codec, level, data):
+        if codec == "gzip" and self.dictionary is not None:
+            compressor = zlib.compressobj(level, zdict=self.dictionary)
+            return compressor.compress(data) + compressor.flush()
+        if codec == "gzip":
+            return gzip.compress(data, compresslevel=level)
+        if codec == "lzma":
+            return lzma.compress(data, preset=level)
+        return data
+
+    def compress(self, data):
+        codec = CODECS[self.index]
+        start = time.perf_counter()
+        payload = self.compress_with(codec[0], codec[1], data)
+        seconds = time.perf_counter() - start
+
+        now = time.monotonic()
+        if self.last_batch is not None and now > self.last_batch:
+            rate = len(data) / (now - self.last_batch)
+            self.raw_rate = rate if self.raw_rate is None else self.raw_rate + CODEC_GAIN * (rate - self.raw_rate)
+        self.last_batch = now
+
+        self.counters["batches"] += 1
+        self.counters["raw_bytes"] += len(data)
+        self.counters["compressed_bytes"] += len(payload)
+        self.counters["compress_seconds"] += seconds
+        self.update(codec, seconds / max(1, len(data)), len(payload) / float(max(1, len(data))))
+
+        if COMPRESSION_DICTIONARY and self.dictionary is None:
+            self.samples.append(data)
+            if len(self.samples) >= DICTIONARY_BATCHES:
+                self.build_dictionary()
+
+        self.index = self.choose()
+        return payload
+
+    def update(self, codec, seconds_per_byte, ratio):
+        estimate = self.estimates.get(codec)
+        if estimate is None:
+            self.estimates[codec] = {"seconds_per_byte": seconds_per_byte, "ratio": ratio, "batches": 1, "probed": self.counters["batches"]}
+            return
+        estimate["seconds_per_byte"] += CODEC_GAIN * (seconds_per_byte - estimate["seconds_per_byte"])
+        estimate["ratio"] += CODEC_GAIN * (ratio - estimate["ratio"])
+        estimate["batches"] += 1
+        estimate["probed"] = self.counters["batches"]
+
+    def known(self, index):
+        """estimate of CODECS[index], None if not measured within CODEC_PROBE_INTERVAL batches"""
+        estimate = self.estimates.get(CODECS[index])
+        if estimate is None or self.counters["batches"] - estimate["probed"] > CODEC_PROBE_INTERVAL:
+            return None
+        return estimate
+
+    def choose(self):
+        """index of the codec of the next batch"""
+        if self.raw_rate is None:
+            return self.index
+        known = {index: self.known(index) for index in range(len(CODECS)) if self.known(index) is not None}
+        fitting = [index for index, estimate in known.items() if estimate["seconds_per_byte"] * self.raw_rate <= COMPRESSION_TIME_BUDGET]
+
+        limit = min([index for index in known if index not in fitting] or [len(CODECS)]) #slower codecs are not tried
+        unknown = [index for index in range(limit) if index not in known]
+        if unknown: #measure the nearest codec without recent estimate
+            return min(unknown, key=lambda index: (abs(index - self.index), -index))
+
+        if not fitting:
+            return 0
+        if COMPRESSION_BYTES_PER_HOUR > 0:
+            meeting = [index for index in fitting if known[index]["ratio"] * self.raw_rate * 3600 <= COMPRESSION_BYTES_PER_HOUR]
+            if meeting:
+                return min(meeting, key=lambda index: known[index]["seconds_per_byte"])
+        return min(fitting, key=lambda index: (known[index]["ratio"], index))
+
+    def build_dictionary(self):
+        """preset dictionary of the last bytes of the first batches, the most recent (most likely repeated) strings at its end"""
+        self.dictionary = b"".join(self.samples)[-DICTIONARY_SIZE:]
+        self.samples = list()
+        for codec in list(self.estimates): #gzip is replaced by zlib with the dictionary
+            if codec[0] == "gzip":
+                del self.estimates[codec]
+        self.dictionary_message = {"sub_topic": TOPIC_STATE,
+                                   "payload": json.dumps({"compression_dictionary": {"id": zlib.adler32(self.dictionary), "data": base64.b64encode(self.dictionary).decode("ascii")}}),
+                                   "qos": 1}                                   #needed to decode the following batches
+        logger.info("compression dictionary {} of {} bytes built".format(zlib.adler32(self.dictionary), len(self.dictionary)))
+
+    def take_dictionary_message(self):
+        message, self.dictionary_message = self.dictionary_message, None
+        return message
+
+    def return_dictionary_message(self, message):
+        self.dictionary_message = message
+
+    def statistics(self):
+        codec = CODECS[self.index]
+        estimate = self.known(self.index)
+        counters = dict(self.counters)
+        statistics = {
+            "codec": "zlib_dictionary" if codec[0] == "gzip" and self.dictionary is not None else codec[0],
+            "level": codec[1],
+            "ratio": round(counters["compressed_bytes"] / float(counters["raw_bytes"]), 4) if counters["raw_bytes"] else None,
+            "time_fraction": round(estimate["seconds_per_byte"] * self.raw_rate, 5) if self.raw_rate and estimate else None, #of the current codec
+            "bytes_per_hour": round(estimate["ratio"] * self.raw_rate * 3600) if self.raw_rate and estimate else None,
+            "dictionary": zlib.adler32(self.dictionary) if self.dictionary is not None else None,
+            "codecs": {"{}_{}".format(*codec): {"batches": estimate["batches"], "ratio": round(estimate["ratio"], 4), "ms_per_kib": round(1024000 * estimate["seconds_per_byte"], 3)}
+                       for codec, estimate in list(self.estimates.items())},
+        }
+        statistics.update(counters)
+        return statistics
+
+codec_controller = CodecController()
+# [End Class CodecController]
+
+
+# [Start Class TelemetryEncoder]
+class TelemetryEncoder(threading.Thread):
+    """
+    Pipeline stage batching and encoding telemetry, so the Modbus readers never wait for JSON serialisation or compression.
+    Started by the first submitted sample. The batches are appended to the telemetry_spool if enabled, otherwise queued in the publishing queue.
+
+    A batch is flushed by the first of: PUFFER_LENGH + 1 samples, its oldest sample waiting FLUSH_MAX_AGE seconds 
+    (timer, also without further samples) or its compressed size estimated to reach FLUSH_MAX_BYTES.
+    The compressed size is estimated from the compressed bytes per sample of the previous batches.
+        ...
+
+    Attributes
+    ----------
+    samples : queue.Queue
+        bounded queue of (sample, publishing queue) from formatted_publish_message
+    counters : dict
+        submitted, dropped (samples queue full), batches and discarded (publishing queue full) batches, spool_errors (batches queued in memory instead),
+        dictionary_retries (dictionary message not queued, publishing queue full), encode_ms_max: longest encoding of a batch, flushed_samples, flushed_age, flushed_bytes: batches per flush trigger
+    bytes_per_sample : float
+        moving average of the compressed bytes per sample, None before the first batch
+
+    Methods
+    -------
+    submit(sample, c_queue)
+        Queues a sample without blocking, called by the Modbus readers
+    run()
+        Collects samples until a flush trigger, encodes them with encode_telemetry and spools the batch or queues it in c_queue
+    statistics()
+        Returns a copy of the counters and the number of queued samples
+    """
+
+    def __init__(self, maxsize=ENCODER_QUEUE_SIZE):
+        threading.Thread.__init__(self, name="telemetry_encoder")
+        self.daemon = True
+        self.samples = queue.Queue(maxsize=maxsize)
+        self.start_lock = threading.Lock()
+        self.counters = {"submitted": 0, "dropped": 0, "batches": 0, "discarded": 0, "encode_ms_max": 0.0,
+                         "flushed_samples": 0, "flushed_age": 0, "flushed_bytes": 0, "spool_errors": 0, "dictionary_retries": 0}
+        self.bytes_per_sample = None
+
+    def submit(self, sample, c_queue):
+        if self.ident is None:
+            with self.start_lock:
+                if self.ident is None:
+                    self.start()
+
+        self.counters["submitted"] += 1
+        try:
+            self.samples.put((sample, c_queue), False)
+        except queue.Full:
+            self.counters["dropped"] += 1
+
+    def run(self):
+        batch = list()
+        batch_start = None
+        c_queue = None
+        while True:
+            timeout = None
+            if batch and FLUSH_MAX_AGE > 0:
+                timeout = max(0.0, batch_start + FLUSH_MAX_AGE - time.monotonic())
+            try:
+                sample, c_queue = self.samples.get(timeout=timeout)
+            except queue.Empty: #oldest sample reached FLUSH_MAX_AGE
+                self.flush(batch, c_queue, "flushed_age")
+                batch = list()
+                continue
+
+            if not batch:
+                batch_start = time.monotonic()
+            batch.append(sample)
+
+            trigger = self.flush_trigger(batch, batch_start)
+            if trigger is not None:
+                self.flush(batch, c_queue, trigger)
+                batch = list()
+
+    def flush_trigger(self, batch, batch_start):
+        """counter name of the trigger flushing the batch now, None if it keeps collecting"""
+        if len(batch) > PUFFER_LENGH:
+            return "flushed_samples"
+        if FLUSH_MAX_AGE > 0 and time.monotonic() - batch_start >= FLUSH_MAX_AGE:
+            return "flushed_age"
+        if FLUSH_MAX_BYTES > 0 and self.bytes_per_sample is not None and len(batch) * self.bytes_per_sample >= FLUSH_MAX_BYTES:
+            return "flushed_bytes"
+        return None
+
+    def flush(self, batch, c_queue, trigger):
+        start = time.perf_counter()
+        payload = encode_telemetry(batch)
+        dic = {"sub_topic": TOPIC_EVENT,
+                "payload": payload,
+                "qos":1,
+        }
+        self.counters["encode_ms_max"] = max(self.counters["encode_ms_max"], 1000 * (time.perf_counter() - start))
+        self.counters["batches"] += 1
+        self.counters[trigger] += 1
+
+        if COMPRESSION == "adaptive":
+            dictionary_message = codec_controller.take_dictionary_message()
+            if dictionary_message is not None: #before the first batch using the dictionary, not dropped
+                if telemetry_spool.enabled:
+                    telemetry_spool.append(dictionary_message)
+                else:
+                    try:
+                        if hasattr(c_queue, "put_reply"): #reply lane: never replaced, served before the events lane
+                            c_queue.put_reply(dictionary_message)
+                        else:
+                            c_queue.put(dictionary_message, False)
+                    except queue.Full: #never blocks the encoder, queued again with the next batch
+                        codec_controller.return_dictionary_message(dictionary_message)
+                        self.counters["dictionary_retries"] += 1
+
+        bytes_per_sample = len(payload) / float(len(batch))
+        if self.bytes_per_sample is None:
+            self.bytes_per_sample = bytes_per_sample
+        else:
+            self.bytes_per_sample += BYTES_PER_SAMPLE_GAIN * (bytes_per_sample - self.bytes_per_sample)
+
+        if telemetry_spool.enabled:
+            try:
+                telemetry_spool.append(dic)
+                return
+            except (OSError, ValueError) as e:
+                logger.warning("telemetry spool not writable, batch queued in memory: {}".format(e))
+                self.counters["spool_errors"] += 1
+        try:
+            c_queue.put(dic, False)
+        except queue.Full:
+            self.counters["discarded"] += 1
 
-    # Read the private key file.
-    with open(PRIVATE_KEY_FILE, 'r') as f:
-        private_key = f.read()
+    def statistics(self):
+        statistics = dict(self.counters)
+        statistics["queued"] = self.samples.qsize()
+        return statistics
 
-    logger.info('Creating JWT using {} from private key file {}'.format(
-            ALGORITHM, PRIVATE_KEY_FILE))
+telemetry_encoder = TelemetryEncoder()
+telemetry_spool = TelemetrySpool(SPOOL_DIRECTORY, SPOOL_MAX_BYTES, SPOOL_SEGMENT_BYTES, SPOOL_DRAIN_RATE)
+# [End Class TelemetryEncoder]
 
-    return jwt.encode(token, private_key, algorithm=ALGORITHM)
+# [Start jwt]
+class JwtMinter(object):
+    """
+    Creates the JWTs (https://jwt.io) to establish the MQTT connection, the private key file is read and parsed once
+        ...
+
+    Attributes
+    ----------
+    key : object
+        private key parsed by PyJWT (e.g. RSA key of cryptography), read from private_key_file with the first JWT
+    prepared : tuple
+        (JWT, datetime issued at) minted ahead of the next connection by prepare(), None if there is none
+
+    Methods
+    -------
+    create()
+        Returns (JWT, issued at) of a new JWT, expires after JWT_EXPIRES_MINUTES
+    prepare()
+        Mints the next JWT ahead of time, outside of the publishing path (RSA signing takes milliseconds on a Raspberry Pi)
+    take()
+        Returns the prepared JWT, a new one if none was prepared within the last 2 * JWT_PREPARE_LEAD seconds
+    """
+
+    def __init__(self, project_id, private_key_file, algorithm):
+        self.project_id = project_id
+        self.private_key_file = private_key_file
+        self.algorithm = algorithm
+        self.key = None
+        self.prepared = None
+        self.lock = threading.Lock()
+
+    def load_key(self):
+        """reads the private key file. Raises ValueError if the file does not contain a known key."""
+        with open(self.private_key_file, 'r') as f:
+            private_key = f.read()
+        logger.info('Loading private key file {} for {}'.format(self.private_key_file, self.algorithm))
+
+        algorithms = jwt.algorithms.get_default_algorithms()
+        if self.algorithm in algorithms: #parsed once instead of on every jwt.encode
+            return algorithms[self.algorithm].prepare_key(private_key)
+        return private_key
+
+    def create(self):
+        with self.lock:
+            if self.key is None:
+                self.key = self.load_key()
+
+        issued = datetime.datetime.utcnow()
+        token = {
+                # The time that the token was issued at
+                'iat': issued,
+                # The time the token expires.
+                'exp': issued + datetime.timedelta(minutes=int(JWT_EXPIRES_MINUTES)),
+                # The audience field should always be set to the GCP project id.
+                'aud': self.project_id
+        }
+        logger.info('Creating JWT using {}'.format(self.algorithm))
+        return jwt.encode(token, self.key, algorithm=self.algorithm), issued
+
+    def prepare(self):
+        prepared = self.create()
+        with self.lock:
+            self.prepared = prepared
+
+    def take(self):
+        with self.lock:
+            prepared, self.prepared = self.prepared, None
+        if prepared is not None and (datetime.datetime.utcnow() - prepared[1]).total_seconds() < 2 * JWT_PREPARE_LEAD:
+            return prepared
+        return self.create()
+
+
+jwt_minter = JwtMinter(PROJECT_ID, PRIVATE_KEY_FILE, ALGORITHM)
 # [End jwt]
         
 # [Start Class handle_mqtt]
@@ -175,7 +556,12 @@ class handle_mqtt(threading.Thread):
         self.modbus_reader_obj = modbus_reader_obj
 
         self.last_messages_payloads = list() #last received messages of config subscription
-        self.last_state_message_queued = datetime.datetime.utcnow()
+        self.connack_received = self.connack_event()  #set by on_connect of self.client
+        self.client_lock = threading.RLock()        #publish on self.client, replaced by a rotation
+        self.connection_lock = threading.RLock()    #reconnects and rotations one after the other
+        self.retiring = None                        #old client during a rotation, its disconnect does not trigger a reconnect
+        self.jwt_iat = datetime.datetime.utcnow()   #issue time of the JWT of self.client
+        self.unacknowledged = collections.deque(maxlen=UNACKNOWLEDGED_MAX) #(MQTTMessageInfo, topic, payload, qos) published on self.client, see publish
 
         self.initial_start_client()
     
@@ -183,16 +569,9 @@ class handle_mqtt(threading.Thread):
         #set up client
 
         #create unique client identifier in google cloud
-        client_id = 'projects/{}/locations/{}/registries/{}/devices/{}'.format(
+        self.client_id = 'projects/{}/locations/{}/registries/{}/devices/{}'.format(
                 PROJECT_ID, CLOUD_REGION, REGISTRY_ID, DEVICE_ID)
-        logger.info('Device client_id is \'{}\''.format(client_id))
-        self.client = mqtt.Client(client_id=client_id, clean_session=False) #broker remembers subscriptions, once connected
-
-        # Enable SSL/TLS support.
-        self.client.tls_set(ca_certs=CA_CERTS, tls_version=ssl.PROTOCOL_TLSv1_2)
-
-        # enables maximum messages for publishing queued, further messages dropped
-        self.client.max_queued_messages_set(queue_size=200)
+        logger.info('Device client_id is \'{}\''.format(self.client_id))
 
         # This is the topic that the device will receive configuration updates on.
         self.mqtt_config_topic = '/devices/{}/config'.format(DEVICE_ID)
@@ -200,31 +579,62 @@ class handle_mqtt(threading.Thread):
         # The topic that the device will receive commands on.
         self.mqtt_command_topic = '/devices/{}/commands/#'.format(DEVICE_ID)
 
+        self.client = self.create_client(self.connack_received)
+
+    def create_client(self, connack):
+        """paho client of the device with the callbacks of handle_mqtt, not connected. connack is set by its on_connect"""
+        client = mqtt.Client(client_id=self.client_id, clean_session=False, userdata={"connack": connack}) #broker remembers subscriptions, once connected
+
+        # Enable SSL/TLS support.
+        client.tls_set(ca_certs=CA_CERTS, tls_version=ssl.PROTOCOL_TLSv1_2)
+
+        # enables maximum messages for publishing queued, further messages dropped
+        client.max_queued_messages_set(queue_size=200)
+
+        self.register_callbacks(client)
+        return client
+
+    def register_callbacks(self, client):
+        # Register message callbacks. https://eclipse.org/paho/clients/python/docs/
+        client.on_connect = self.on_connect
+        client.on_publish = self.on_publish
+        client.on_disconnect = self.on_disconnect
+        client.on_message = self.on_message
+        client.on_log = self.on_log
+        client.message_callback_add(self.mqtt_config_topic, self.config_on_message)
+
         
      # [Start Paho MQTT CALLBACKS]
-    def on_connect(self, unused_client, unused_userdata, unused_flags, rc):
+    def on_connect(self, client, userdata, unused_flags, rc):
         try:
             """Callback for when a device connects."""
             logger.info('on_connect:{}'.format( mqtt.connack_string(rc)))
 
             # After a successful connect, reset backoff time and stop backing off.
-            self.should_backoff = False
-            self.minimum_backoff_time = 2
+            userdata["connack"].set() #connack_received, or the new client of a rotation
+            if client is self.client:
+                self.should_backoff = False
+                self.minimum_backoff_time = 2
+                if telemetry_spool.enabled:
+                    telemetry_spool.mark_backlog() #batches of the offline period are drained at spool_drain_rate
             logger.info('Subscribing to {} and {}'.format(self.mqtt_command_topic, self.mqtt_config_topic))
 
             # Subscribe to the config topic, QoS 1 enables message acknowledgement.
-            self.client.subscribe(self.mqtt_config_topic, qos=1)          
+            client.subscribe(self.mqtt_config_topic, qos=1)          
 
             # Subscribe to the commands topic, QoS not used
-            self.client.subscribe(self.mqtt_command_topic, qos=0)
+            client.subscribe(self.mqtt_command_topic, qos=0)
             
         except Exception as e:
             logger.error("Error in Paho Callback on_connect{}",format(e))
 
 
-    def on_disconnect(self, unused_client, unused_userdata, rc):
+    def on_disconnect(self, client, unused_userdata, rc):
         """Paho callback for when a device disconnects."""
         try:
+            if self.retired(client): #replaced by the new client of a rotation
+                logger.info('on_disconnect of the old client after a rotation: {}'.format(mqtt.error_string(rc)))
+                return
             logger.warning('on_disconnect callback reason:  {}: {}'.format(rc, mqtt.error_string(rc)))
 
             # Since a disconnect occurred, the next loop iteration will wait with
@@ -255,6 +665,12 @@ class handle_mqtt(threading.Thread):
             logger.info(' Received message \'{}\' on topic \'{}\' with Qos {}'.format(
                     payload, message.topic, str(message.qos)))
 
+            if payload.startswith("{"):
+                command = json.loads(payload)
+                if "burst_upload" in command: #raw samples kept by the aggregation, see g_aggregation
+                    uploaded = self.modbus_reader_obj.burst_upload(command["burst_upload"])
+                    formatted_publish_message(topic=TOPIC_STATE, payload="burst upload of {} raw samples".format(uploaded), c_queue=self.publishing_queue, reply=True)
+
         except Exception as e:
             logger.error("Error in Paho Callback on_message {}",format(e))
 
@@ -271,13 +687,7 @@ class handle_mqtt(threading.Thread):
                 
                 self.last_messages_payloads = self.last_messages_payloads[-5:] #keep only most recent messages
             
-                #[Start Config Update]
-                #check_configuration_message(config_payload, self.scheduler_obj, self.modbus_reader_obj, self.publishing_queue) #gets final result update implemented [True/False] and log
-                #[End Config Update]
-                
-                t = threading.Thread(target=check_configuration_message, args=(config_payload, self.scheduler_obj, self.modbus_reader_obj, self.publishing_queue,) )
-                t.setDaemon = True
-                t.start()
+                self.apply_configuration(config_payload)
 
             else:
                 """if config message received that was received earlier, e.g. through QoS1 MQTT Subscription"""
@@ -288,10 +698,24 @@ class handle_mqtt(threading.Thread):
     
     # [END Paho MQTT CALLBACKS]
 
+    def apply_configuration(self, config_payload):
+        """checks and applies a new config message in its own thread"""
+        #[Start Config Update]
+        #check_configuration_message(config_payload, self.scheduler_obj, self.modbus_reader_obj, self.publishing_queue) #gets final result update implemented [True/False] and log
+        #[End Config Update]
+        
+        t = threading.Thread(target=check_configuration_message, args=(config_payload, self.scheduler_obj, self.modbus_reader_obj, self.publishing_queue,) )
+        t.setDaemon = True
+        t.start()
+
 
 
     # [START iot_mqtt_connection]          
     def do_exponential_backoff(self):
+        """Wait with exponential backoff before publishing, when backoff"""
+        time.sleep(self.backoff_delay())
+
+    def backoff_delay(self):
         """How long to wait with exponential backoff before publishing, when backoff"""
         if self.minimum_backoff_time <= 1 or self.maximum_backoff_time < self.minimum_backoff_time: #no exponential backoff possible
             self.minimum_backoff_time = 2
@@ -305,10 +729,27 @@ class handle_mqtt(threading.Thread):
         # Otherwise, wait and connect again.
         delay = self.minimum_backoff_time + random.randint(0, 1000) / 1000.0
         logger.info('Waiting for {} seconds before reconnecting.'.format(delay))
-        time.sleep(max(0,delay)) 
         self.minimum_backoff_time *= 2
+        return max(0, delay)
         
 
+    def connect_client(self, client=None):
+        """connects the client (default: self.client) with the next JWT of the jwt_minter, returns the time the JWT was issued"""
+        if client is None:
+            client = self.client
+            self.connack_received.clear()
+
+        # With Google Cloud IoT Core, the username field is ignored, and the
+        # password field is used to transmit a JWT to authorize the device.
+        password, issued = jwt_minter.take()
+        client.username_pw_set(username='unused', password=password)
+        if client is self.client:
+            self.jwt_iat = issued
+
+        # Connect to the Google MQTT bridge.
+        client.connect(MQTT_BRIDGE_HOSTNAME, MQTT_BRIDGE_PORT, KEEPALIVE)
+        return issued
+
     def start_new_connection(self):
         """restarts the connection"""
 
@@ -318,27 +759,8 @@ class handle_mqtt(threading.Thread):
 
         while self.connection_working == False:
             try:
-                # Register message callbacks. https://eclipse.org/paho/clients/python/docs/
-
-                self.client.on_connect = self.on_connect
-                self.client.on_publish = self.on_publish
-                self.client.on_disconnect = self.on_disconnect
-                self.client.on_message = self.on_message
-                self.client.on_log = self.on_log
-                self.client.message_callback_add(self.mqtt_config_topic, self.config_on_message)
-
-
-                self.jwt_iat = datetime.datetime.utcnow()
-                # With Google Cloud IoT Core, the username field is ignored, and the
-                # password field is used to transmit a JWT to authorize the device.
-                self.client.username_pw_set(
-                        username='unused',
-                        password=create_jwt(
-                                PROJECT_ID, PRIVATE_KEY_FILE, ALGORITHM))
-
-                # Connect to the Google MQTT bridge.
-                self.client.connect(MQTT_BRIDGE_HOSTNAME, MQTT_BRIDGE_PORT, KEEPALIVE)
-
+                with self.connection_lock:
+                    self.connect_client()
                 
                 #runs a thread in the background to call loop() for paho mqtt client automatically
                 self.client.loop_start() #should ignore if running
@@ -351,8 +773,6 @@ class handle_mqtt(threading.Thread):
                 self.should_backoff = False
                 self.last_client_restart = datetime.datetime.utcnow()  #logging startup time, so in the next seconds, don't publish to many messages
 
-                time.sleep(2)
-
 
             except Exception as e:
                 self.connection_working = False
@@ -383,7 +803,13 @@ class handle_mqtt(threading.Thread):
                     
                         #[End Do Exponential Backoff and Reconnect]
 
-                        publish_request = self.publishing_queue.get(timeout=1) #wait for newest message from publishing_queue that is queued to be puplished
+                        #the JWT is refreshed by the jwt_rotation thread, see rotate_connections
+
+                        if telemetry_spool.enabled: #telemetry from the spool in turns with the messages of the publishing_queue
+                            published = self.publish_spooled()
+                            publish_request = self.publishing_queue.get(timeout=0 if published else SPOOL_POLL_INTERVAL)
+                        else:
+                            publish_request = self.publishing_queue.get(timeout=1) #wait for newest message from publishing_queue that is queued to be puplished
                         break #if element was in queue 
                     
                     except queue.Empty:
@@ -396,37 +822,19 @@ class handle_mqtt(threading.Thread):
                 mqtt_topic = "/devices/{}/{}".format(DEVICE_ID, sub_topic) #where message is published
                 # [End message from queue]
 
-                # [START jwt_refresh]
-                seconds_since_issue = (datetime.datetime.utcnow() - self.jwt_iat).seconds 
-                if seconds_since_issue + 60 >= int(60 * JWT_EXPIRES_MINUTES):
-                    logger.info("Refreshing JWT token and connection after {}s".format(seconds_since_issue))
-                    self.start_new_connection()
-                # [END jwt_refresh]
-
                 # [START Precaution before publish on recent opened connection]
                 elapsed_seconds_since_restart = (datetime.datetime.utcnow() - self.last_client_restart).seconds
                 if elapsed_seconds_since_restart < 20: #if paho mqtt not ready
-                    if elapsed_seconds_since_restart < 5:
-                        logger.debug("MQTT just after connection restart, pausing message send for 5 seconds")
-                        time.sleep(max(0, 5-elapsed_seconds_since_restart)) #up to 5 seconds sleep
+                    self.connack_received.wait(timeout=max(0, 5-elapsed_seconds_since_restart)) #only until connection is acknowledged, up to 5 seconds
                     if qos == 0:
                         logger.debug("Set message from qos 0 to qos 1")
                         qos = 1 #set to qos 1 until stable connection and fully set up
                 # [END Precaution before publish on recent opened connection]
-                
-                # [Start State messages delay]
-                if sub_topic == TOPIC_STATE:
-                    #TOPIC_STATE can be refreshed no more than once per second & 6000 times per minute per project in the Google Cloud, optimum once each 5 or 10 seconds max.
-                    time_difference_state = (datetime.datetime.utcnow() - self.last_state_message_queued).seconds
+                #state messages are paced by the state lane of the publishing_queue (PublishLanes), not here
 
-                    if 0 <= time_difference_state < 5:
-                        logger.info("State message, Sleeping for {}".format(5-time_difference_state))
-                        time.sleep(max(0, 5-time_difference_state))            
-
-                    self.last_state_message_queued = datetime.datetime.utcnow()
-                # [End State messages delay]
-
-                self.client.publish(mqtt_topic, payload, qos=qos, retain=True) # Publish payload to the MQTT topic. 
+                if qos == 0 and self.retiring is not None:
+                    qos = 1 #the old client may be disconnected by the broker before the rotation completes, carried over with qos 1
+                self.publish(mqtt_topic, payload, qos) # Publish payload to the MQTT topic. 
                 
                 self.publishing_queue.task_done()    
 
@@ -434,12 +842,122 @@ class handle_mqtt(threading.Thread):
             logger.error('An error occured during publishing data {}'.format(e))
             self.connection_working == False            
 
+    def publish_spooled(self):
+        """publishes the next batch of the telemetry_spool on an acknowledged connection, returns True if a batch was published"""
+        now = time.monotonic()
+        telemetry_spool.update(now)
+        if self.should_backoff or not self.connack_received.is_set():
+            return False
+        spooled = telemetry_spool.take(now)
+        if spooled is None:
+            return False
+
+        publish_request, start, end = spooled
+        mqtt_topic = "/devices/{}/{}".format(DEVICE_ID, publish_request["sub_topic"])
+        info = self.publish(mqtt_topic, publish_request["payload"], publish_request["qos"])
+        telemetry_spool.sent(info, start, end, now)
+        return True
+
+    def publish(self, mqtt_topic, payload, qos):
+        """publishes on self.client with retain, keeps QoS 1 messages until acknowledged for a rotation, returns paho's MQTTMessageInfo"""
+        with self.client_lock:
+            info = self.client.publish(mqtt_topic, payload, qos=qos, retain=True)
+            if qos > 0 and info.rc in (0, 4): #MQTT_ERR_SUCCESS, MQTT_ERR_NO_CONN: queued by paho
+                while self.unacknowledged and self.unacknowledged[0][0].is_published():
+                    self.unacknowledged.popleft()
+                self.unacknowledged.append((info, mqtt_topic, payload, qos))
+        return info
+
+    # [START jwt_rotation]
+    def rotation_delay(self):
+        """seconds until the connection is rotated with a new JWT, JWT_REFRESH_MARGIN before the expiry of the current one"""
+        lifetime = 60 * JWT_EXPIRES_MINUTES
+        due = max(lifetime - JWT_REFRESH_MARGIN, lifetime / 2.0)
+        return max(0, due - (datetime.datetime.utcnow() - self.jwt_iat).total_seconds())
+
+    def connack_event(self):
+        return threading.Event()
+
+    def retired(self, client):
+        """True if client is not (or no longer) the client used for publishing"""
+        return client is not self.client or client is self.retiring
+
+    def rotate_connections(self):
+        """jwt_rotation thread: mints the next JWT ahead of time and rotates the connection before the JWT expires"""
+        while self.run_publish:
+            try:
+                delay = self.rotation_delay()
+                if delay <= JWT_PREPARE_LEAD and jwt_minter.prepared is None:
+                    jwt_minter.prepare()
+                if delay <= 0 and self.connack_received.is_set() and not self.should_backoff and self.rotate_client():
+                    continue
+                time.sleep(delay - JWT_PREPARE_LEAD if delay > JWT_PREPARE_LEAD else (delay or ROTATION_RETRY_INTERVAL))
+            except Exception as e:
+                logger.error('An error occured during the rotation of the connection {}'.format(e))
+                time.sleep(ROTATION_RETRY_INTERVAL)
+
+    def rotate_client(self):
+        """
+        make-before-break: connects a new client with the prepared JWT, publishing is switched to it once the connection is acknowledged.
+        The broker may close the old connection of the same client id at once, publishes in between are queued by the old client with qos 1
+        and carried over. Returns True if rotated.
+        """
+        with self.connection_lock:
+            connack = self.connack_event()
+            client = self.create_client(connack)
+            self.retiring = self.client
+            try:
+                issued = self.connect_client(client)
+                client.loop_start()
+                acknowledged = connack.wait(timeout=ROTATION_CONNACK_TIMEOUT) and client.is_connected()
+            except Exception as e:
+                logger.warning('An error occured during the rotation of the connection {}'.format(e))
+                acknowledged = False
+
+            if not acknowledged:
+                self.abort_rotation(client)
+                return False
+            self.complete_rotation(client, issued)
+            return True
+
+    def complete_rotation(self, client, issued):
+        """switches publishing to the new client and publishes the unacknowledged QoS 1 messages of the old client again"""
+        with self.client_lock:
+            old_client, self.client = self.client, client
+            client.user_data_set({"connack": self.connack_received}) #set again by the next reconnect of this client
+            self.jwt_iat = issued
+            self.retiring = None
+            published, self.unacknowledged = self.unacknowledged, collections.deque(maxlen=UNACKNOWLEDGED_MAX)
+        self.connack_received.set()
+        self.should_backoff = False
+        self.stop_client(old_client)
+
+        carried = [message for message in published if not message[0].is_published()]
+        for info, mqtt_topic, payload, qos in carried:
+            telemetry_spool.carry_over(info, self.publish(mqtt_topic, payload, qos))
+        logger.info("Rotated the connection with a new JWT, {} unacknowledged messages carried over".format(len(carried)))
+
+    def abort_rotation(self, client):
+        """drops the new client of a failed rotation, the old client keeps publishing or reconnects if it was disconnected"""
+        self.stop_client(client)
+        self.retiring = None
+        if not self.client.is_connected():
+            self.should_backoff = True
+
+    def stop_client(self, client):
+        client.disconnect()
+        client.loop_stop()
+    # [END jwt_rotation]
+
     def run(self):
         self.start_publish()
 
     def start_publish(self):
         logger.debug("Start the MQTT CLIENT")
         self.run_publish = True
+        rotation = threading.Thread(target=self.rotate_connections, name="jwt_rotation")
+        rotation.daemon = True
+        rotation.start()
         while self.run_publish == True:
             self.start_new_connection()
             self.publish_data()
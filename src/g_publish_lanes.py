@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+"""
+ IoT Gateway Modbus
+ (C)2020 - Michael Feil
+ This is distributed under MIT license, see LICENSE
+"""
+
+"""g_publish_lanes.py
+
+Function: The publishing queue of handle_mqtt as three lanes, each paced by its own token bucket,
+so the pacing of state messages never holds back telemetry.
+
+    events: telemetry batches, first in first out, bounded
+    state: state messages, coalesced per key: a newer message replaces the queued one of the same key (e.g. the metrics),
+           only the latest value matters
+    reply: answers to configuration updates and commands, first in first out, bounded, never coalesced
+
+get() returns the next message of a lane with a token, reply before events before state, and waits until a token is due.
+Per paramteter_settings in setup_mqtt.json (optional), messages per second of each lane:
+    "events_rate": default 0, no limit
+    "state_rate": default 0.2, the state topic is limited to 1 message per second by Google Cloud IoT Core
+    "reply_rate": default 0.5
+"""
+
+#[Start includes]
+import collections
+import queue
+import threading
+import time
+#[End includes]
+
+#[Start Global Variables]
+LANES = ("reply", "events", "state") #order of service if several lanes have a token
+#[End Global Variables]
+
+
+# [Start Class TokenBucket]
+class TokenBucket(object):
+    """rate tokens per second up to burst, rate 0: no limit"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.time = None
+
+    def refill(self, now):
+        if self.time is not None:
+            self.tokens = min(self.burst, self.tokens + self.rate * (now - self.time))
+        self.time = now
+
+    def wait(self, now):
+        """seconds until a token is available, 0 if available now"""
+        if self.rate <= 0:
+            return 0
+        self.refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        if self.rate > 0:
+            self.refill(now)
+            self.tokens -= 1
+# [End Class TokenBucket]
+
+
+# [Start Class PublishLanes]
+class PublishLanes(object):
+    """
+    Publishing queue of handle_mqtt with an events, a state and a reply lane, shared by all threads
+        ...
+
+    Attributes
+    ----------
+    events, replies : collections.deque
+        queued messages {"sub_topic", "payload", "qos"} of the events and the reply lane
+    states : collections.OrderedDict
+        key: latest queued state message of the key, in the order of the first queued message
+    buckets : dict
+        lane: TokenBucket
+    counters : dict
+        lane: {"published", "dropped" (lane full), "coalesced" (replaced by a newer state message)}
+
+    Methods
+    -------
+    put(message, block=True, timeout=None)
+        Queues a telemetry message in the events lane, raises queue.Full as queue.Queue
+    put_state(message, key)
+        Queues a state message, replaces the queued state message of the same key
+    put_reply(message)
+        Queues an answer in the reply lane, raises queue.Full if full
+    get(block=True, timeout=None)
+        Returns the next message whose lane has a token, raises queue.Empty as queue.Queue
+    statistics()
+        Returns queued messages and counters per lane
+    """
+
+    def __init__(self, maxsize=100, events_rate=0, state_rate=0.2, reply_rate=0.5):
+        self.maxsize = maxsize
+        self.events = collections.deque()
+        self.replies = collections.deque()
+        self.states = collections.OrderedDict()
+        self.buckets = {"events": TokenBucket(events_rate, burst=events_rate), "state": TokenBucket(state_rate), "reply": TokenBucket(reply_rate)}
+        self.counters = {lane: {"published": 0, "dropped": 0, "coalesced": 0} for lane in LANES}
+        self.condition = threading.Condition()
+
+    def notify(self):
+        """wakes up a waiting get(), called with the condition held"""
+        self.condition.notify_all()
+
+    def put(self, message, block=True, timeout=None):
+        with self.condition:
+            if len(self.events) >= self.maxsize and not (block and self.condition.wait_for(lambda: len(self.events) < self.maxsize, timeout)):
+                self.counters["events"]["dropped"] += 1
+                raise queue.Full
+            self.events.append(message)
+            self.notify()
+
+    def put_state(self, message, key):
+        with self.condition:
+            if key in self.states:
+                self.counters["state"]["coalesced"] += 1
+            elif len(self.states) >= self.maxsize:
+                self.counters["state"]["dropped"] += 1
+                raise queue.Full
+            self.states[key] = message
+            self.notify()
+
+    def put_reply(self, message):
+        with self.condition:
+            if len(self.replies) >= self.maxsize:
+                self.counters["reply"]["dropped"] += 1
+                raise queue.Full
+            self.replies.append(message)
+            self.notify()
+
+    def poll(self, now):
+        """(message, None) of the next lane with a token, otherwise (None, seconds until a token of a non empty lane or None)"""
+        wait = None
+        for lane in LANES:
+            if lane == "reply":
+                waiting = self.replies
+            elif lane == "events":
+                waiting = self.events
+            else:
+                waiting = self.states
+            if not waiting:
+                continue
+            lane_wait = self.buckets[lane].wait(now)
+            if lane_wait > 0:
+                wait = lane_wait if wait is None else min(wait, lane_wait)
+                continue
+
+            self.buckets[lane].take(now)
+            self.counters[lane]["published"] += 1
+            if lane == "state":
+                return self.states.popitem(last=False)[1], None
+            message = waiting.popleft()
+            if lane == "events":
+                self.condition.notify_all() #a blocked put
+            return message, None
+        return None, wait
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                message, wait = self.poll(now)
+                if message is not None:
+                    return message
+                if not block or (deadline is not None and now >= deadline):
+                    raise queue.Empty
+                if deadline is not None:
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+                self.condition.wait(wait)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def task_done(self):
+        pass
+
+    def empty(self):
+        return not (self.events or self.states or self.replies)
+
+    def qsize(self):
+        return len(self.events) + len(self.states) + len(self.replies)
+
+    def statistics(self):
+        with self.condition:
+            statistics = {lane: dict(counters) for lane, counters in self.counters.items()}
+            statistics["events"]["queued"] = len(self.events)
+            statistics["state"]["queued"] = len(self.states)
+            statistics["reply"]["queued"] = len(self.replies)
+        return statistics
+# [End Class PublishLanes]
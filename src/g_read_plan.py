@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+"""
+ IoT Gateway Modbus
+ (C)2020 - Michael Feil 
+ This is distributed under MIT license, see LICENSE
+"""
+
+"""g_read_plan.py
+
+Function: Compiling due Modbus requests into as few Modbus frames as possible.
+
+Read requests on the same slave_id and function_code with adjacent, overlapping or nearby (gap_tolerance) startadress ranges
+are merged into one frame, limited by the protocol maximum of 125 registers or 2000 coils / discrete inputs per frame.
+The result of a merged frame is split back into the results of the single requests.
+
+Write requests (output_value) on contiguous startadress of the same slave_id are merged into one Write Multiple Coils (15)
+or Write Multiple Registers (16) frame. Reads are not moved across writes, writes to the same address keep their order.
+With "verify" set on a write operation, the written values are read back after the frame (function code 1 or 3).
+"""
+
+#[Start Global Variables]
+MAX_QUANTITY_PER_FRAME = {
+    1: 2000,    #read coils
+    2: 2000,    #read discrete inputs
+    3: 125,     #read holding registers
+    4: 125,     #read input registers
+}               #function codes that can be merged and their maximum quantity_of_x per frame
+WRITE_MULTIPLE = {
+    5: (15, 1968),  #write single coil
+    15: (15, 1968), #write multiple coils
+    6: (16, 123),   #write single register
+    16: (16, 123),  #write multiple registers
+}               #write function codes: function code of a merged frame and its maximum values per frame
+READ_BACK_FUNCTION_CODE = {15: 1, 16: 3} #function code reading the values written by a merged write function code
+WRITE_KEYS = ("verify",) #keys of an operation copied to the request
+#[End Global Variables]
+
+
+# [Start Read Plan]
+def compile_read_plan(requests, gap_tolerance=0):
+    """merges requests into frames, returns list of frames
+    
+    A frame is a request dict (slave_id, function_code, startadress, quantity_of_x or output_value) 
+    with the additional key "members": list of the requests served by this frame.
+    Reads and writes are not merged across each other, so a read queued after a write still reads the written value.
+    Requests which can not be merged become a frame of their own.
+    """
+    frames = list()
+    reads = list()                  #mergeable reads since the last write
+    writes = list()                 #mergeable writes since the last read
+    written = set()                 #(slave_id, function code of a merged frame, address) of writes
+
+    for request in requests:
+        function_code = request["function_code"]
+        if function_code in MAX_QUANTITY_PER_FRAME and "quantity_of_x" in request:
+            frames.extend(merge_writes(writes))
+            writes, written = list(), set()
+            reads.append(request)
+            continue
+
+        frames.extend(merge_reads(reads, gap_tolerance))
+        reads = list()
+        if function_code in WRITE_MULTIPLE and "output_value" in request:
+            addresses = write_addresses(request)
+            if not written.isdisjoint(addresses): #second write to an address, keep the order
+                frames.extend(merge_writes(writes))
+                writes, written = list(), set()
+            writes.append(request)
+            written.update(addresses)
+            continue
+
+        frames.extend(merge_writes(writes))
+        writes, written = list(), set()
+        frame = dict(request)
+        frame["members"] = [request]
+        frames.append(frame)
+
+    frames.extend(merge_reads(reads, gap_tolerance))
+    frames.extend(merge_writes(writes))
+    return frames
+
+
+def merge_reads(requests, gap_tolerance):
+    """merges read requests of the same slave_id and function_code, returns list of frames in order of their first request"""
+    frames = list()
+    open_frames = dict()            #(slave_id, function_code): frame that can still be extended
+
+    for position, request in sorted(enumerate(requests), key=lambda r: (r[1]["slave_id"], r[1]["function_code"], r[1]["startadress"], r[0])):
+        function_code = request["function_code"]
+        key = (request["slave_id"], function_code)
+        start = request["startadress"]
+        end = start + request["quantity_of_x"]
+        frame = open_frames.get(key)
+
+        if frame is not None:
+            frame_end = frame["startadress"] + frame["quantity_of_x"]
+            if start <= frame_end + gap_tolerance and max(end, frame_end) - frame["startadress"] <= MAX_QUANTITY_PER_FRAME[function_code]:
+                frame["quantity_of_x"] = max(end, frame_end) - frame["startadress"]
+                frame["members"].append(request)
+                continue
+
+        frame = {
+            "slave_id": request["slave_id"],
+            "function_code": function_code,
+            "startadress": start,
+            "quantity_of_x": request["quantity_of_x"],
+            "members": [request],
+        }
+        open_frames[key] = frame
+        frames.append((position, frame))
+
+    frames.sort(key=lambda f: f[0])
+    return [frame for unused_position, frame in frames]
+
+
+def write_values(request):
+    """list of the values written by a write request, coils as 0 or 1"""
+    values = request["output_value"]
+    if not isinstance(values, (list, tuple)):
+        values = [values]
+    if WRITE_MULTIPLE[request["function_code"]][0] == 15:
+        return [1 if value else 0 for value in values]
+    return list(values)
+
+
+def write_addresses(request):
+    """set of (slave_id, function code of a merged frame, address) written by a write request"""
+    function_code = WRITE_MULTIPLE[request["function_code"]][0]
+    start = request["startadress"]
+    return {(request["slave_id"], function_code, address) for address in range(start, start + len(write_values(request)))}
+
+
+def merge_writes(requests):
+    """merges write requests on contiguous addresses of the same slave_id, returns list of frames in order of their first request
+
+    The requests must not write the same address twice, their order is then irrelevant.
+    """
+    frames = list()
+    open_frames = dict()            #(slave_id, merged function code): frame that can still be extended
+
+    for position, request in sorted(enumerate(requests), key=lambda r: (r[1]["slave_id"], WRITE_MULTIPLE[r[1]["function_code"]][0], r[1]["startadress"], r[0])):
+        function_code, max_values = WRITE_MULTIPLE[request["function_code"]]
+        key = (request["slave_id"], function_code)
+        values = write_values(request)
+        frame = open_frames.get(key)
+
+        if frame is not None:
+            frame_values = frame["output_value"]
+            if request["startadress"] == frame["startadress"] + len(frame_values) and len(frame_values) + len(values) <= max_values:
+                frame_values.extend(values)
+                frame["function_code"] = function_code
+                frame["members"].append(request)
+                continue
+
+        frame = {
+            "slave_id": request["slave_id"],
+            "function_code": function_code,
+            "startadress": request["startadress"],
+            "output_value": values,
+            "members": [request],
+        }
+        open_frames[key] = frame
+        frames.append((position, frame))
+
+    frames.sort(key=lambda f: f[0])
+    merged = list()
+    for unused_position, frame in frames:
+        if len(frame["members"]) == 1: #single write, sent with its own function code and output_value
+            request = frame["members"][0]
+            frame = dict(request)
+            frame["members"] = [request]
+        merged.append(frame)
+    return merged
+
+
+def write_result(request):
+    """result of a single write request served by a merged frame, as the response of the slave to the request alone"""
+    function_code = request["function_code"]
+    if function_code == 5:
+        return (request["startadress"], 0xff00 if request["output_value"] else 0)
+    elif function_code == 6:
+        return (request["startadress"], request["output_value"])
+    return (request["startadress"], len(write_values(request)))
+
+
+def read_back_request(frame):
+    """read request of the values written by a write frame"""
+    function_code = READ_BACK_FUNCTION_CODE[WRITE_MULTIPLE[frame["function_code"]][0]]
+    return {"slave_id": frame["slave_id"], "function_code": function_code, "startadress": frame["startadress"], "quantity_of_x": len(write_values(frame))}
+
+
+def unverified_writes(frame, read_back):
+    """ids of the members with "verify" whose written values differ from the read_back result, all of them if read_back is None"""
+    unverified = set()
+    for request in frame["members"]:
+        if not request.get("verify"):
+            continue
+        values = write_values(request)
+        offset = request["startadress"] - frame["startadress"]
+        if read_back is None or list(read_back[offset:offset + len(values)]) != values:
+            unverified.add(id(request))
+    return unverified
+
+
+def split_frame_result(frame, result):
+    """splits the result tuple of a frame into (request, result) of its members"""
+    if len(frame["members"]) == 1 and frame["members"][0].get("startadress") == frame["startadress"]:
+        return [(frame["members"][0], result)]
+
+    if "output_value" in frame:
+        return [(request, write_result(request)) for request in frame["members"]]
+
+    split = list()
+    for request in frame["members"]:
+        offset = request["startadress"] - frame["startadress"]
+        split.append((request, tuple(result[offset:offset + request["quantity_of_x"]])))
+    return split
+# [End Read Plan]
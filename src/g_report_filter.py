@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""
+ IoT Gateway Modbus
+ (C)2020 - Michael Feil 
+ This is distributed under MIT license, see LICENSE
+"""
+
+"""g_report_filter.py
+
+Function: Report by exception. Suppresses read results which did not change by more than the deadband of their operation 
+since the last reported result, before they are batched and published. 
+
+Per operation in setup_modbus.json (all optional):
+    "deadband": change needed to report, default 0 (every change is reported)
+    "deadband_mode": "absolute" (default) or "percent" of the last reported value 
+    "max_silence": seconds after which a result is reported even if unchanged (heartbeat)
+Operations without "deadband" and "max_silence" report every result.
+"""
+
+#[Start Global Variables]
+REPORT_FILTER_KEYS = ("deadband", "deadband_mode", "max_silence") #keys of an operation copied to the request
+#[End Global Variables]
+
+
+# [Start Class DeadbandFilter]
+class DeadbandFilter(object):
+    """
+    Decides per read result whether it is reported, according to the deadband settings of its request
+        ...
+
+    Attributes
+    ----------
+    last_reported : dict
+        display_name: (time.monotonic() of the last report, last reported result)
+    suppressed : dict
+        display_name: number of suppressed results
+
+    Methods
+    -------
+    report(request, result, now)
+        Returns True if the result has to be published 
+    statistics()
+        Returns reported and suppressed counts per display_name
+    """
+
+    def __init__(self):
+        self.last_reported = dict()
+        self.suppressed = dict()
+        self.reported = dict()
+
+    def report(self, request, result, now):
+        """True if result of request has to be published at now (time.monotonic())"""
+        name = request["display_name"]
+
+        if "deadband" in request or "max_silence" in request:
+            last = self.last_reported.get(name)
+            if last is not None and not self.changed(request, last[1], result):
+                max_silence = request.get("max_silence")
+                if max_silence is None or now - last[0] < max_silence:
+                    self.suppressed[name] = self.suppressed.get(name, 0) + 1
+                    return False
+            self.last_reported[name] = (now, result)
+
+        self.reported[name] = self.reported.get(name, 0) + 1
+        return True
+
+    @staticmethod
+    def changed(request, last_result, result):
+        """True if any value of result differs by more than the deadband from last_result"""
+        if len(last_result) != len(result):
+            return True
+
+        deadband = request.get("deadband", 0)
+        percent = request.get("deadband_mode", "absolute") == "percent"
+
+        for last_value, value in zip(last_result, result):
+            if not (isinstance(value, (int, float)) and isinstance(last_value, (int, float))):
+                if value != last_value: #e.g. error results
+                    return True
+                continue
+
+            band = deadband * abs(last_value) / 100.0 if percent else deadband
+            if abs(value - last_value) > band:
+                return True
+        return False
+
+    def statistics(self):
+        """returns reported and suppressed counts per display_name"""
+        reported, suppressed = dict(self.reported), dict(self.suppressed) #copies, filled by the Modbus_reader thread
+        return {name: {"reported": reported.get(name, 0), "suppressed": suppressed.get(name, 0)} 
+                for name in set(reported) | set(suppressed)}
+# [End Class DeadbandFilter]
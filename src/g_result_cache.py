@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+"""
+ IoT Gateway Modbus
+ (C)2020 - Michael Feil
+ This is distributed under MIT license, see LICENSE
+"""
+
+"""g_result_cache.py
+
+Function: Result cache of the registers, coils and inputs read on a port, shared by all operations of the port.
+
+Every successful read stores its values per (slave_id, function_code, address) with the time it was read.
+A due operation with "cache_ttl" is served from the cache without using the bus if every one of its addresses
+was read within the last cache_ttl seconds, e.g. a slow energy block that contains a fast power reading.
+Writes remove the written addresses from the cache. If the cache is full, the least recently used addresses are evicted.
+
+Per operation in setup_modbus.json (optional):
+    "cache_ttl": maximum age in seconds of cached values serving this operation, default: always read from the bus
+Per port_config and port in "ports" (optional):
+    "cache_size": addresses kept per port, default 4096, 0 disables the cache
+"""
+
+#[Start includes]
+import collections
+#[End includes]
+
+#[includes own scripts]
+from g_read_plan import MAX_QUANTITY_PER_FRAME, WRITE_MULTIPLE, READ_BACK_FUNCTION_CODE, write_values
+#[includes own scripts]
+
+#[Start Global Variables]
+DEFAULT_CACHE_SIZE = 4096
+CACHE_KEYS = ("cache_ttl",) #keys of an operation copied to the request
+#[End Global Variables]
+
+
+# [Start Class ResultCache]
+class ResultCache(object):
+    """
+    Least recently used cache of read values of one port, used by one Modbus_reader
+        ...
+
+    Attributes
+    ----------
+    values : collections.OrderedDict
+        (slave_id, function_code, address): (time.monotonic() of the read, value), least recently used first
+    hits, misses : dict
+        display_name: number of due requests served from the cache or from the bus
+
+    Methods
+    -------
+    configure(port_config)
+        Takes cache_size of the port_config
+    clear()
+        Removes all cached values
+    store(request, result, now)
+        Stores the result of a read request or frame, removes the addresses of a write request
+    lookup(request, now)
+        Returns the result of a request with "cache_ttl" from fresh cached values, otherwise None
+    statistics()
+        Returns hits, misses and hit_rate per display_name
+    """
+
+    def __init__(self):
+        self.values = collections.OrderedDict()
+        self.size = DEFAULT_CACHE_SIZE
+        self.hits = dict()
+        self.misses = dict()
+
+    def configure(self, port_config):
+        self.size = port_config.get("cache_size", DEFAULT_CACHE_SIZE)
+        self.evict()
+
+    def clear(self):
+        self.values.clear()
+
+    def evict(self):
+        while len(self.values) > self.size:
+            self.values.popitem(last=False)
+
+    def store(self, request, result, now):
+        slave_id = request["slave_id"]
+        function_code = request["function_code"]
+        start = request["startadress"]
+
+        if function_code in MAX_QUANTITY_PER_FRAME and "quantity_of_x" in request:
+            if self.size <= 0:
+                return
+            for address, value in enumerate(result, start):
+                key = (slave_id, function_code, address)
+                self.values[key] = (now, value)
+                self.values.move_to_end(key)
+            self.evict()
+
+        elif function_code in WRITE_MULTIPLE and "output_value" in request:
+            read_function_code = READ_BACK_FUNCTION_CODE[WRITE_MULTIPLE[function_code][0]]
+            for address in range(start, start + len(write_values(request))):
+                self.values.pop((slave_id, read_function_code, address), None)
+
+    def lookup(self, request, now):
+        ttl = request.get("cache_ttl")
+        if ttl is None or "quantity_of_x" not in request:
+            return None
+
+        name = request.get("display_name")
+        keys = [(request["slave_id"], request["function_code"], address)
+                for address in range(request["startadress"], request["startadress"] + request["quantity_of_x"])]
+        result = list()
+        for key in keys:
+            cached = self.values.get(key)
+            if cached is None or now - cached[0] > ttl:
+                self.misses[name] = self.misses.get(name, 0) + 1
+                return None
+            result.append(cached[1])
+
+        for key in keys:
+            self.values.move_to_end(key)
+        self.hits[name] = self.hits.get(name, 0) + 1
+        return tuple(result)
+
+    def statistics(self):
+        hits, misses = dict(self.hits), dict(self.misses) #copies, filled by the Modbus_reader thread
+        statistics = dict()
+        for name in set(hits) | set(misses):
+            hit, miss = hits.get(name, 0), misses.get(name, 0)
+            statistics[name] = {"hits": hit, "misses": miss, "hit_rate": round(hit / float(hit + miss), 3)}
+        return statistics
+# [End Class ResultCache]
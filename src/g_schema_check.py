@@ -32,6 +32,9 @@ from schema import Schema, Or, And, Use, Optional, SchemaError
 import g_mqtt_client as gmc
 import g_shared_utils as su
 from g_shared_utils import logger
+from g_bus_budget import apply_bus_budget
+from g_decode import DATA_TYPES
+from g_read_plan import WRITE_MULTIPLE
 #[includes own scripts]
 
 #[Start Global Variables]
@@ -49,25 +52,71 @@ operation_schema = Schema({
     "function_code": And(lambda n: (0 <= n <= 30), int),
     "display_name": str,
     "sampling_interval": Or( And(lambda n: (0.05 <= n <= 864001), (Or(int, float))), 0),
+    Optional("priority"): And(lambda n: (0 <= n <= 9), int),  #lower is more urgent, default 5
+    Optional("deadband"): And(lambda n: (0 <= n), (Or(int, float))),   #report by exception, see g_report_filter
+    Optional("deadband_mode"): And(lambda n: n in ["absolute", "percent"], str),
+    Optional("max_silence"): And(lambda n: (0 <= n <= 864001), (Or(int, float))),
+    Optional("data_type"): And(lambda n: n in DATA_TYPES, str),           #registers decoded to typed values, see g_decode
+    Optional("byte_order"): And(lambda n: n in ["big", "little"], str),
+    Optional("word_order"): And(lambda n: n in ["big", "little"], str),
+    Optional("scale"): Or(int, float),
+    Optional("offset"): Or(int, float),
+    Optional("cache_ttl"): And(lambda n: (0 < n <= 864001), (Or(int, float))),   #served from cached values of this age, see g_result_cache
+    Optional("verify"): bool,                                             #read back the written output_value, see g_read_plan
+    Optional("aggregation"): {                                            #window statistics instead of every result, see g_aggregation
+        "window": And(lambda n: (0.1 <= n <= 864001), (Or(int, float))),
+        Optional("mode"): And(lambda n: n in ["tumbling", "sliding"], str),
+        Optional("step"): And(lambda n: (0.1 <= n <= 864001), (Or(int, float))),
+        Optional("keep_raw"): And(lambda n: (0 <= n <= 100000), int),
+    },
     And(lambda n: bool("quantity_of_x" == n)^bool("output_value" == n), str) : And(lambda n: (0 <= n <= 500), int),  #Xor: A string: (quantity_of_x Xor output_value) is == integer
 }, name="operation_schema", as_reference=True)
 
 slave_schema = Schema({
     "slave_id":And(lambda n: (0 <= n <= 256), int),
+    Optional("port"): str,                              #name of a port in "ports", default "port_config"
     "operations": {
         str: operation_schema,
     }
 }, name="Slave_schema", as_reference=True)
 
-conf_Schema = Schema({
-  "port_config": {
+common_port_keys = {
+    "timeout_connection": And(lambda n: (0.02 <= n <= 99.9), (Or(int, float))),
+    Optional("read_gap_tolerance"): And(lambda n: (0 <= n <= 124), int),   #unused registers allowed between merged reads, default 0
+    Optional("bus_budget"): And(lambda n: (0.05 <= n <= 1), (Or(int, float))),   #maximum utilisation of the serial line, see g_bus_budget
+    Optional("budget_policy"): And(lambda n: n in ["report", "reject", "stretch"], str),
+    Optional("turnaround"): And(lambda n: (0 <= n <= 10), (Or(int, float))),
+    Optional("breaker_failures"): And(lambda n: (1 <= n <= 100), int),     #consecutive failures of a slave until it is only probed, see g_slave_health
+    Optional("breaker_backoff"): And(lambda n: (0.1 <= n <= 3600), (Or(int, float))),   #seconds until the first probe
+    Optional("cache_size"): And(lambda n: (0 <= n <= 100000), int),     #addresses in the result cache, default 4096, 0: off
+    Optional("adaptive_timeout"): bool,                 #learned response timeout per slave, at most timeout_connection, default true
+}
+
+serial_port_keys = {
+    Optional("type"): "rtu",                            #Modbus RTU over a serial port, default
     "port": And(lambda n: Or(("/dev/tty" in n),("COM" in n)), str), 
     "baudrate": And(lambda n: n in supported_baudrates, int),   
     "databits": And(lambda n: n in [5, 6, 7, 8], int),    
     "parity": And(lambda n: n in ['N', 'E', 'O', 'M', 'S'], str), 
     "stopbits": And(lambda n: n in (1, 1.5, 2), (Or(int, float))), 
-    "timeout_connection": And(lambda n: (0.02 <= n <= 99.9), (Or(int, float))),
-  },
+}
+
+tcp_port_keys = {
+    "type": And(lambda n: n in ["tcp", "rtu_over_tcp"], str),   #Modbus TCP or Modbus RTU over TCP, see g_transport
+    "host": str,
+    Optional("tcp_port"): And(lambda n: (1 <= n <= 65535), int),   #default 502
+    Optional("max_pipeline"): And(lambda n: (1 <= n <= 16), int),  #Modbus TCP requests in flight, default 1
+}
+
+port_schema = Schema(
+    Or({**serial_port_keys, **common_port_keys}, {**tcp_port_keys, **common_port_keys}),
+    name="port_schema", as_reference=True)
+
+conf_Schema = Schema({
+  "port_config": port_schema,
+  Optional("ports"): {                                  #additional named serial ports, each read by its own Modbus_reader
+      And(lambda n: n != su.DEFAULT_PORT, str): port_schema,
+      },
   "slaveconfig": {
       str: slave_schema,
       }
@@ -127,6 +176,21 @@ def modbus_json_check(file=str(), dictio=dict(), autolock_file=True):
         #[Start Validate Schema]   
         try:
             conf_Schema.validate(data_json)
+
+            for slave_name, slave in data_json["slaveconfig"].items():
+                if slave.get("port", su.DEFAULT_PORT) not in su.port_configs(data_json):
+                    raise SchemaError("port {} of slave {} is not defined in ports".format(slave["port"], slave_name))
+
+                for operation_name, operation in slave["operations"].items():
+                    if "data_type" in operation:
+                        if operation["function_code"] not in (3, 4) or "quantity_of_x" not in operation:
+                            raise SchemaError("data_type of {} requires reading registers with function code 3 or 4".format(operation_name))
+                        if operation["quantity_of_x"] % DATA_TYPES[operation["data_type"]][1]:
+                            raise SchemaError("quantity_of_x of {} is no multiple of the registers of {}".format(operation_name, operation["data_type"]))
+                    if operation.get("verify") and (operation["function_code"] not in WRITE_MULTIPLE or "output_value" not in operation):
+                        raise SchemaError("verify of {} requires writing with function code 5, 6, 15 or 16".format(operation_name))
+                    if "aggregation" in operation and ("quantity_of_x" not in operation or "deadband" in operation or "max_silence" in operation):
+                        raise SchemaError("aggregation of {} requires a read operation without deadband and max_silence".format(operation_name))
         
             response = response+" \n FINAL RESPONSE: Schema correct"
             checkresult = True
@@ -144,11 +208,13 @@ def modbus_json_check(file=str(), dictio=dict(), autolock_file=True):
 
 # [Start Read JSON]
 def read_setup(pub_queue, sleeptime=True, send_answer_to_cloud = False):
+    """reads setup_modbus.json, returns dict port name: port config (see g_shared_utils.port_configs) and the slaveconfig"""
     
     port_config = dict()
     slave_config = dict()
     checkresult = False
-    time.sleep(random.randint(5,15)/10)
+    if sleeptime:
+        time.sleep(random.randint(5,15)/10)
     read_complete = 0
 
     logger.debug("check the setup_modbus.json")
@@ -162,34 +228,78 @@ def read_setup(pub_queue, sleeptime=True, send_answer_to_cloud = False):
             
             if send_answer_to_cloud: logger.debug("setup_modbus.json response:"+str( response))
 
-            port_config = data_json["port_config"]
+            port_config = su.port_configs(data_json)
             slave_config = data_json["slaveconfig"]
             read_complete = 5
 
 
             if send_answer_to_cloud:
-                gmc.formatted_publish_message(topic=gmc.TOPIC_STATE, payload="Start up with modbus config: {}       JSON CHECKUP {}".format(data_json, response), c_queue=pub_queue)     
+                gmc.formatted_publish_message(topic=gmc.TOPIC_STATE, payload="Start up with modbus config: {}       JSON CHECKUP {}".format(data_json, response), c_queue=pub_queue, key="setup")     
 
         except Exception as e:
             try:
                 if read_complete>1:
-                    gmc.formatted_publish_message(topic=gmc.TOPIC_STATE, payload="ERROR reading setup_modbus:"+str(e), c_queue=pub_queue)
+                    gmc.formatted_publish_message(topic=gmc.TOPIC_STATE, payload="ERROR reading setup_modbus:"+str(e), c_queue=pub_queue, reply=True)
             finally:
-                time.sleep(3+random.randint(0,10)) #randomized access if multiple read at the same time
+                if sleeptime:
+                    time.sleep(3+random.randint(0,10)) #randomized access if multiple read at the same time
+                else:
+                    time.sleep(random.randint(1,5)/10)
                 read_complete = read_complete+1
     if not checkresult: #unsuccessful, default
-        port_config = {"port": "COM6", "baudrate": 9600, "databits": 8, "parity": "N", "stopbits": 1, "timeout_connection": 10 }
+        port_config = {su.DEFAULT_PORT: {"port": "COM6", "baudrate": 9600, "databits": 8, "parity": "N", "stopbits": 1, "timeout_connection": 10 }}
         
         slave_config = {}
     return port_config, slave_config
 # [End Read JSON]
 
+# [Start Config Diff]
+def diff_slaveconfig(old_slaveconfig, new_slaveconfig):
+    """compares the operations of two slaveconfigs, identified by (slave_name, operation_name)
+
+    Returns dict of lists of operation keys:
+        "added": new or changed, "removed": removed or changed, "changed": changed other than sampling_interval,
+        "retimed": only sampling_interval changed, "unchanged": identical
+    """
+    def flatten(slaveconfig):
+        return {(slave_name, operation_name): dict(op, slave_id=slave["slave_id"], port=slave.get("port", su.DEFAULT_PORT)) 
+                for slave_name, slave in slaveconfig.items() for operation_name, op in slave["operations"].items()}
+
+    old_ops, new_ops = flatten(old_slaveconfig), flatten(new_slaveconfig)
+    diff = {"added": [], "removed": [], "changed": [], "retimed": [], "unchanged": []}
+
+    for key in old_ops:
+        if key not in new_ops:
+            diff["removed"].append(key)
+
+    for key, op in new_ops.items():
+        if key not in old_ops:
+            diff["added"].append(key)
+        elif old_ops[key] == op:
+            diff["unchanged"].append(key)
+        elif dict(old_ops[key], sampling_interval=0) == dict(op, sampling_interval=0):
+            diff["retimed"].append(key)
+        else:
+            diff["changed"].append(key)
+            diff["removed"].append(key)
+            diff["added"].append(key)
+    return diff
+# [End Config Diff]
+
 # [Start manuipulate existing JSON ]
 
 # [Start check Configuration Updates]
-def check_configuration_message(config_payload, scheduler_obj, modbus_reader_obj, publising_queue):
+def update_configuration(received_json, scheduler_obj, modbus_reader_obj):
+    """applies a checked configuration to the running Modbus readers and scheduler. Returns answer text"""
+    #readers and ports first, so the rescheduled operations find their port
+    #only changed operations are rescheduled, serial port is only reopened if its settings changed
+    answer = modbus_reader_obj.update(su.port_configs(received_json))
+    return answer + scheduler_obj.update(received_json["slaveconfig"])
+
+
+def check_configuration_message(config_payload, scheduler_obj, modbus_reader_obj, publising_queue, apply_update=update_configuration):
     logger.info("check new message on content")
-    """checks for the Configuration Messages and applies them when the new and deployment formally correct"""
+    """checks for the Configuration Messages and applies them with apply_update when the new and deployment formally correct"""
 
     answer_config_update = " /Config Subscription Message received"
         
@@ -212,6 +322,15 @@ def check_configuration_message(config_payload, scheduler_obj, modbus_reader_obj
 
             received_json_checkresult, received_json_response, unused_json = modbus_json_check(dictio = received_json)
 
+            if received_json_checkresult == True:
+                #[Start Bus Budget]
+                budget_accepted, received_json, budget_answer = apply_bus_budget(received_json, getattr(modbus_reader_obj, "observed_turnaround", None))
+                answer_config_update = answer_config_update + budget_answer
+                if not budget_accepted:
+                    received_json_checkresult = False
+                    received_json_response = "bus budget exceeded"
+                #[End Bus Budget]
+
             if received_json_checkresult == True:
                 
 
@@ -244,14 +363,7 @@ def check_configuration_message(config_payload, scheduler_obj, modbus_reader_obj
         try:
             logger.debug("config about to be implemented ") 
             
-            scheduler_obj.stopkill()
-            modbus_reader_obj.stopkill()
-            logger.debug("stopped all, wait before starting up")
-            time.sleep(3)
-            logger.debug("starting modbus and scheduler back up")
-
-            scheduler_obj.startup()
-            modbus_reader_obj.startup()
+            answer_config_update = answer_config_update + apply_update(received_json, scheduler_obj, modbus_reader_obj)
             absolute_success_update = True
         except Exception as e:
             absolute_success_update = False
@@ -280,7 +392,7 @@ def check_configuration_message(config_payload, scheduler_obj, modbus_reader_obj
 
     answer_config_update = answer_config_update + "\n  RESULT: {} \n".format(result)
     logger.info(answer_config_update)
-    gmc.formatted_publish_message(topic=gmc.TOPIC_STATE, payload=answer_config_update, c_queue=publising_queue)     
+    gmc.formatted_publish_message(topic=gmc.TOPIC_STATE, payload=answer_config_update, c_queue=publising_queue, reply=True)     
     
     return  
 # [End check Configuration Updates]
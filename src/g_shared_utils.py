@@ -1,5 +1,8 @@
 import logging
 import os
+import time
+
+process_start = time.monotonic() #start of the gateway, for the time to first sample
 
 #log
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s [%(levelname)7s] [%(filename)24s] [%(funcName)24s]  [%(threadName)8s]  %(message)s')
@@ -11,4 +14,14 @@ directory_path = os.path.abspath(os.path.dirname(__file__))
 setup_mqtt_filepath         = os.path.join(directory_path,'setup_files', 'setup_mqtt.json')
 setup_modbus_temp_filepath  = os.path.join(directory_path,'setup_files', 'setup_modbus_temp.json')
 setup_modbus_filepath       = os.path.join(directory_path,'setup_files', 'setup_modbus.json')
+learned_timeouts_filepath   = os.path.join(directory_path,'setup_files', 'learned_timeouts.json') #written by the gateway, see g_slave_health
+
+#ports
+DEFAULT_PORT = "default" #name of the "port_config" of setup_modbus.json, used by slaves without "port"
+
+def port_configs(config_json):
+    """returns dict port name: port config of a setup_modbus.json, "port_config" is named DEFAULT_PORT"""
+    ports = {DEFAULT_PORT: config_json["port_config"]}
+    ports.update(config_json.get("ports", dict()))
+    return ports
 
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+"""
+ IoT Gateway Modbus
+ (C)2020 - Michael Feil
+ This is distributed under MIT license, see LICENSE
+"""
+
+"""g_slave_health.py
+
+Function: Health of the slaves of a port: circuit breaker and adaptive response timeout per slave.
+
+Circuit breaker: a slave that stops responding is no longer asked at its sampling rate,
+so it does not block the bus for the other slaves with a timeout per request.
+
+A breaker opens after "breaker_failures" consecutive failures (no response, invalid response or gateway exception) of its slave.
+While open, requests to the slave are skipped without using the bus. After "breaker_backoff" seconds the next request
+is sent as probe (half open): success closes the breaker, failure opens it again with twice the backoff, up to BREAKER_MAX_BACKOFF.
+A probe without outcome (not sent, e.g. the serial port was closed before) is followed by the next probe after the backoff.
+Exception responses (e.g. illegal data address) prove that the slave is alive and count as success.
+
+Adaptive response timeout: the turnaround of every slave is learned as moving average and mean deviation (as the TCP 
+retransmission timeout, RFC 6298). A transaction waits for the wire time of its frames + mean + 4 deviations, at least 
+MIN_RESPONSE_TIMEOUT and at most "timeout_connection" of the port. Every timeout doubles the bound of the slave until its next response. 
+The learned values are saved in setup_files/learned_timeouts.json and used again after a restart.
+
+Per port_config and port in "ports" of setup_modbus.json (all optional):
+    "breaker_failures": consecutive failures opening the breaker, default 3
+    "breaker_backoff": seconds until the first probe of an open breaker, default 5
+    "adaptive_timeout": false to wait "timeout_connection" for every response, default true
+"""
+
+#[Start includes]
+import json
+import os
+import socket
+import threading
+
+from modbus_tk.exceptions import ModbusError, ModbusInvalidResponseError
+#[End includes]
+
+#[includes own scripts]
+import g_shared_utils as su
+from g_shared_utils import logger
+#[includes own scripts]
+
+#[Start Global Variables]
+DEFAULT_BREAKER_FAILURES = 3
+DEFAULT_BREAKER_BACKOFF = 5.0       #seconds
+BREAKER_MAX_BACKOFF = 600.0         #seconds
+GATEWAY_EXCEPTION_CODES = (10, 11)  #gateway path unavailable, gateway target device failed to respond
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+MIN_RESPONSE_TIMEOUT = 0.05         #seconds
+ADAPTIVE_MIN_SAMPLES = 8            #responses of a slave before its learned timeout is used
+MEAN_GAIN, DEVIATION_GAIN = 1 / 8.0, 1 / 4.0
+MAX_TIMEOUT_BACKOFF = 64
+TIMEOUTS_SAVE_INTERVAL = 300        #seconds between saving the learned timeouts
+
+learned_timeouts_lock = threading.Lock() #all ports share learned_timeouts.json
+#[End Global Variables]
+
+
+def is_slave_failure(ex):
+    """True if the exception of a request means its slave did not respond, while the port itself works"""
+    if isinstance(ex, ModbusError):
+        return ex.get_exception_code() in GATEWAY_EXCEPTION_CODES
+    return isinstance(ex, (ModbusInvalidResponseError, socket.timeout))
+
+
+# [Start Class CircuitBreakers]
+class CircuitBreakers(object):
+    """
+    Circuit breakers of all slaves of a port, used by one Modbus_reader
+        ...
+
+    Attributes
+    ----------
+    breakers : dict
+        slave_id: dict with "state", "failures" (consecutive), "backoff" and "retry_at" (time.monotonic())
+
+    Methods
+    -------
+    configure(port_config)
+        Takes breaker_failures and breaker_backoff of the port_config
+    allow(slave_id, now)
+        Returns True if a request to the slave is sent, the first request after the backoff is the probe
+    success(slave_id, now), failure(slave_id, now)
+        Records the outcome of a request, returns the new state if it changed, otherwise None
+    all_open()
+        True if every known slave of the port has an open breaker
+    statistics()
+        Returns a copy of the breakers
+    """
+
+    def __init__(self):
+        self.breakers = dict()
+        self.failure_threshold = DEFAULT_BREAKER_FAILURES
+        self.initial_backoff = DEFAULT_BREAKER_BACKOFF
+
+    def configure(self, port_config):
+        self.failure_threshold = port_config.get("breaker_failures", DEFAULT_BREAKER_FAILURES)
+        self.initial_backoff = port_config.get("breaker_backoff", DEFAULT_BREAKER_BACKOFF)
+
+    def breaker(self, slave_id):
+        if slave_id not in self.breakers:
+            self.breakers[slave_id] = {"state": CLOSED, "failures": 0, "backoff": self.initial_backoff, "retry_at": 0.0}
+        return self.breakers[slave_id]
+
+    def allow(self, slave_id, now):
+        breaker = self.breakers.get(slave_id)
+        if breaker is None or breaker["state"] == CLOSED:
+            return True
+        if now >= breaker["retry_at"]: #open: after the backoff, half open: the probe got no outcome (e.g. not sent, the port was closed)
+            breaker["state"] = HALF_OPEN #this request is the probe
+            breaker["retry_at"] = now + breaker["backoff"]
+            return True
+        return False
+
+    def success(self, slave_id, now):
+        breaker = self.breaker(slave_id)
+        breaker["failures"] = 0
+        breaker["backoff"] = self.initial_backoff
+        if breaker["state"] != CLOSED:
+            breaker["state"] = CLOSED
+            return CLOSED
+        return None
+
+    def failure(self, slave_id, now):
+        breaker = self.breaker(slave_id)
+        breaker["failures"] += 1
+
+        if breaker["state"] == HALF_OPEN: #probe failed
+            breaker["backoff"] = min(2 * breaker["backoff"], max(BREAKER_MAX_BACKOFF, self.initial_backoff))
+        elif breaker["state"] == OPEN or breaker["failures"] < self.failure_threshold:
+            return None
+
+        breaker["state"] = OPEN
+        breaker["retry_at"] = now + breaker["backoff"]
+        return OPEN
+
+    def all_open(self):
+        return bool(self.breakers) and all(breaker["state"] != CLOSED for breaker in self.breakers.values())
+
+    def statistics(self):
+        return {slave_id: dict(breaker) for slave_id, breaker in self.breakers.items()}
+# [End Class CircuitBreakers]
+
+
+# [Start Class ResponseTimeouts]
+class ResponseTimeouts(object):
+    """
+    Learned turnaround and response timeout of all slaves of a port, used by one Modbus_reader
+        ...
+
+    Attributes
+    ----------
+    estimates : dict
+        slave_id: dict with "mean" and "deviation" of the turnaround in seconds, "n" responses and timeout "backoff" factor
+
+    Methods
+    -------
+    observe(slave_id, turnaround)
+        Learns the turnaround (seconds between request and response without the wire time) of a response
+    timed_out(slave_id)
+        Doubles the timeout of the slave until its next response
+    timeout(slave_id, wire, maximum)
+        Returns the timeout of a transaction with the wire time wire, at most maximum
+    load(port_name), save(port_name)
+        Reads or writes the estimates of the port in learned_timeouts.json
+    snapshot()
+        Returns a copy, e.g. saved in another thread while the estimates are updated
+    """
+
+    def __init__(self):
+        self.estimates = dict()
+
+    def observe(self, slave_id, turnaround):
+        estimate = self.estimates.get(slave_id)
+        if estimate is None:
+            self.estimates[slave_id] = {"mean": turnaround, "deviation": turnaround / 2, "n": 1, "backoff": 1}
+            return
+
+        error = turnaround - estimate["mean"]
+        estimate["mean"] += MEAN_GAIN * error
+        estimate["deviation"] += DEVIATION_GAIN * (abs(error) - estimate["deviation"])
+        estimate["n"] += 1
+        estimate["backoff"] = 1
+
+    def timed_out(self, slave_id):
+        estimate = self.estimates.get(slave_id)
+        if estimate is not None:
+            estimate["backoff"] = min(2 * estimate["backoff"], MAX_TIMEOUT_BACKOFF)
+
+    def mean(self, slave_id):
+        return self.estimates[slave_id]["mean"]
+
+    def timeout(self, slave_id, wire, maximum):
+        estimate = self.estimates.get(slave_id)
+        if estimate is None or estimate["n"] < ADAPTIVE_MIN_SAMPLES:
+            return maximum
+
+        bound = (wire + estimate["mean"] + 4 * estimate["deviation"]) * estimate["backoff"]
+        return min(maximum, max(MIN_RESPONSE_TIMEOUT, bound))
+
+    def snapshot(self):
+        snapshot = ResponseTimeouts()
+        snapshot.estimates = {slave_id: dict(estimate) for slave_id, estimate in self.estimates.items()}
+        return snapshot
+
+    def load(self, port_name):
+        """takes the estimates of port_name saved in learned_timeouts.json, if any"""
+        try:
+            with learned_timeouts_lock, open(su.learned_timeouts_filepath) as file:
+                saved = json.load(file).get(port_name, dict())
+        except (OSError, ValueError):
+            return
+
+        for slave_id, estimate in saved.items():
+            self.estimates[int(slave_id)] = {"mean": estimate["mean"], "deviation": estimate["deviation"], "n": estimate["n"], "backoff": 1}
+
+    def save(self, port_name):
+        """writes the estimates of port_name to learned_timeouts.json, keeps the other ports"""
+        with learned_timeouts_lock:
+            try:
+                with open(su.learned_timeouts_filepath) as file:
+                    saved = json.load(file)
+            except (OSError, ValueError):
+                saved = dict()
+
+            saved[port_name] = {str(slave_id): {"mean": round(estimate["mean"], 6), "deviation": round(estimate["deviation"], 6), "n": estimate["n"]}
+                                for slave_id, estimate in self.estimates.items()}
+            try:
+                temp_filepath = su.learned_timeouts_filepath + ".tmp"
+                with open(temp_filepath, "w") as file:
+                    json.dump(saved, file, indent=4)
+                os.replace(temp_filepath, su.learned_timeouts_filepath) #no partly written file after a power loss
+            except OSError as e:
+                logger.warning("learned timeouts not saved: {}".format(e))
+# [End Class ResponseTimeouts]
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+
+"""
+ IoT Gateway Modbus
+ (C)2020 - Michael Feil
+ This is distributed under MIT license, see LICENSE
+"""
+
+"""g_spool.py
+
+Function: Disk-backed store and forward spool of the telemetry batches between the telemetry_encoder and handle_mqtt.
+
+Every batch is appended to a memory-mapped segment file and published from there, oldest first. Batches survive offline
+periods of hours and a reboot instead of being dropped by the full publishing_queue or paho's queue of queued messages.
+A batch counts as delivered when the broker acknowledges it (QoS 1), the position after the last acknowledged batch is saved
+in "offsets.json" at most once per SPOOL_COMMIT_INTERVAL: after a crash, up to that interval of batches is published twice, none is lost.
+The disk use is bounded by "spool_max_bytes": if a new segment exceeds it, the oldest segment is evicted with its unpublished batches.
+After an offline period, the backlog is published at "spool_drain_rate" bytes per second at most, so the catch-up does not saturate the link.
+The backlog are the batches appended before the connection was (again) acknowledged (mark_backlog), later batches are published without limit.
+
+Per paramteter_settings in setup_mqtt.json (optional):
+    "spool_max_bytes": disk bytes of the spool, default 0: no spool, batches are queued in memory
+    "spool_segment_bytes": bytes per segment file, default 1048576
+    "spool_drain_rate": bytes per second of published batches of the backlog, default 0: no limit
+    "spool_directory": directory of the segment files, relative to src, default "spool"
+
+Segment file "<sequence>.seg", records one after another, the rest of the file is zero:
+    uint32 length of the body, uint32 crc32 of the body, body: uint8 qos, uint8 payload type (0: bytes, 1: str), uint16 length of the sub_topic, sub_topic, payload
+A record with length 0 or a wrong crc32 (not written or torn by a power loss) ends its segment.
+"""
+
+#[Start includes]
+import collections
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+#[End includes]
+
+#[includes own scripts]
+from g_shared_utils import logger
+#[includes own scripts]
+
+#[Start Global Variables]
+RECORD_HEADER = struct.Struct("<II") #length, crc32 of the body
+BODY_HEADER = struct.Struct("<BBH") #qos, payload type, length of the sub_topic
+DEFAULT_SEGMENT_BYTES = 1048576
+SPOOL_MAX_IN_FLIGHT = 20            #published batches waiting for their acknowledgement, far below max_queued_messages of paho
+SPOOL_ACK_TIMEOUT = 300             #seconds without acknowledgement of the oldest batch in flight until the unacknowledged batches are published again
+SPOOL_COMMIT_INTERVAL = 1.0         #seconds between writes of offsets.json
+#[End Global Variables]
+
+
+# [Start Records]
+def encode_record(request):
+    """segment record of a publish request {"sub_topic", "payload", "qos"}"""
+    payload = request["payload"]
+    text = isinstance(payload, str)
+    if text:
+        payload = payload.encode("utf-8")
+    sub_topic = request["sub_topic"].encode("utf-8")
+    body = BODY_HEADER.pack(int(request["qos"]), int(text), len(sub_topic)) + sub_topic + payload
+    return RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode_body(body):
+    """publish request of a record body"""
+    qos, text, topic_length = BODY_HEADER.unpack_from(body)
+    start = BODY_HEADER.size
+    payload = body[start + topic_length:]
+    return {"sub_topic": body[start:start + topic_length].decode("utf-8"),
+            "payload": payload.decode("utf-8") if text else payload,
+            "qos": qos}
+# [End Records]
+
+
+# [Start Class TelemetrySpool]
+class TelemetrySpool(object):
+    """
+    Append-only spool of publish requests in memory-mapped segment files, shared by the telemetry_encoder (append)
+    and handle_mqtt (take, sent, update). Opened with the first use, disabled if max_bytes is 0.
+        ...
+
+    Attributes
+    ----------
+    segments : collections.OrderedDict
+        sequence: [file, mmap, size] of the segment files, oldest first, the last one is written
+    write_end : int
+        offset after the last record of the last segment
+    read, committed : tuple
+        (sequence, offset) of the next record to publish and after the last acknowledged record
+    backlog_end : tuple
+        (sequence, offset) after the last record of the backlog, records before it are published at drain_rate at most
+    in_flight : collections.deque
+        (paho MQTTMessageInfo, start, end, bytes, time published) of the published, not yet acknowledged records
+    depth_records, depth_bytes : int
+        records and bytes not yet acknowledged
+    counters : dict
+        appended, acknowledged, evicted (unacknowledged records of evicted segments), republished (records after an acknowledgement timeout)
+
+    Methods
+    -------
+    append(request)
+        Appends a publish request to the last segment, rolls to a new segment and evicts the oldest ones if needed
+    take(now)
+        Returns (request, start, end) of the next record to publish, None if there is none, the in-flight window is full or the drain rate is used up
+    sent(info, start, end, now)
+        Registers the record published with paho's MQTTMessageInfo info
+    carry_over(info, new_info)
+        Replaces info of a record published again on a new connection (rotation of handle_mqtt)
+    mark_backlog()
+        Marks the records appended so far as backlog, called when the connection is acknowledged
+    update(now)
+        Takes the acknowledged records, saves offsets.json and removes fully acknowledged segments
+    statistics()
+        Returns depth, drain progress and counters of the spool
+    """
+
+    def __init__(self, directory, max_bytes, segment_bytes=DEFAULT_SEGMENT_BYTES, drain_rate=0):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.drain_rate = drain_rate
+        self.enabled = max_bytes > 0
+
+        self.lock = threading.Lock()
+        self.opened = False
+        self.segments = collections.OrderedDict()
+        self.write_end = 0
+        self.next_sequence = 0
+        self.read = self.committed = (0, 0)
+        self.backlog_end = (0, 0)
+        self.saved = None
+        self.last_commit = None
+        self.in_flight = collections.deque()
+        self.tokens = 0.0
+        self.token_time = None
+
+        self.depth_records = self.depth_bytes = 0
+        self.backlog_peak = 0 #most records not yet acknowledged since the spool was last empty
+        self.counters = {"appended": 0, "acknowledged": 0, "evicted": 0, "republished": 0}
+
+    # [Start Segments]
+    def segment_path(self, sequence):
+        return os.path.join(self.directory, "{:012d}.seg".format(sequence))
+
+    def map_segment(self, sequence, size=None):
+        """maps a segment file, creates it with size zero bytes if size is given"""
+        file = open(self.segment_path(sequence), "w+b" if size is not None else "r+b")
+        if size is not None:
+            file.truncate(size)
+        else:
+            size = os.fstat(file.fileno()).st_size
+        self.segments[sequence] = [file, mmap.mmap(file.fileno(), size), size]
+
+    def remove_segment(self, sequence):
+        file, segment_map, unused_size = self.segments.pop(sequence)
+        segment_map.close()
+        file.close()
+        os.remove(self.segment_path(sequence))
+
+    def record_at(self, sequence, offset):
+        """(body, end) of the record at offset, None at the end of the segment"""
+        unused_file, segment_map, size = self.segments[sequence]
+        if offset + RECORD_HEADER.size > size:
+            return None
+        length, crc = RECORD_HEADER.unpack_from(segment_map, offset)
+        end = offset + RECORD_HEADER.size + length
+        if length == 0 or end > size:
+            return None
+        body = segment_map[offset + RECORD_HEADER.size:end]
+        if zlib.crc32(body) != crc:
+            return None
+        return body, end
+
+    def records(self, sequence, offset):
+        """(start, end) of the records of a segment from offset"""
+        record = self.record_at(sequence, offset)
+        while record is not None:
+            yield offset, record[1]
+            offset = record[1]
+            record = self.record_at(sequence, offset)
+
+    def disk_bytes(self):
+        return sum(segment[2] for segment in self.segments.values())
+    # [End Segments]
+
+    def open(self):
+        """maps the existing segments and takes the saved offsets, called with the lock held"""
+        self.opened = True
+        os.makedirs(self.directory, exist_ok=True)
+        for name in sorted(os.listdir(self.directory)):
+            if not (name.endswith(".seg") and name[:-4].isdigit()):
+                continue
+            if os.path.getsize(os.path.join(self.directory, name)) == 0: #created just before a power loss
+                os.remove(os.path.join(self.directory, name))
+            else:
+                self.map_segment(int(name[:-4]))
+
+        try:
+            with open(os.path.join(self.directory, "offsets.json")) as file:
+                saved = json.load(file)
+            self.saved = (saved["sequence"], saved["offset"])
+        except (OSError, ValueError, KeyError):
+            self.saved = None
+
+        if self.segments:
+            first = next(iter(self.segments))
+            self.committed = self.saved if self.saved is not None and self.saved[0] in self.segments else (first, 0)
+            self.next_sequence = next(reversed(self.segments)) + 1
+        elif self.saved is not None:
+            self.committed = (self.saved[0] + 1, 0)
+            self.next_sequence = self.committed[0]
+        self.read = self.committed
+
+        for sequence in self.segments:
+            offset = self.committed[1] if sequence == self.committed[0] else 0
+            if sequence < self.committed[0]:
+                continue
+            for start, end in self.records(sequence, offset):
+                self.depth_records += 1
+                self.depth_bytes += end - start
+        self.backlog_peak = self.depth_records
+
+        if self.segments: #continue after the last valid record, zero a record torn by a power loss
+            last = next(reversed(self.segments))
+            self.write_end = 0
+            for unused_start, end in self.records(last, 0):
+                self.write_end = end
+            unused_file, segment_map, size = self.segments[last]
+            segment_map[self.write_end:size] = bytes(size - self.write_end)
+        self.backlog_end = self.end_position() #records of before the restart
+        logger.info("telemetry spool {}: {} segments, {} records not yet published".format(self.directory, len(self.segments), self.depth_records))
+
+    def end_position(self):
+        """(sequence, offset) after the last record"""
+        if not self.segments:
+            return (self.next_sequence, 0)
+        return (next(reversed(self.segments)), self.write_end)
+
+    def mark_backlog(self):
+        with self.lock:
+            if self.opened: #otherwise set by open()
+                self.backlog_end = self.end_position()
+
+    def roll(self, length):
+        """starts a new segment for a record of length bytes, evicts the oldest segments beyond max_bytes"""
+        sequence = self.next_sequence
+        self.next_sequence += 1
+        self.map_segment(sequence, max(self.segment_bytes, length))
+        self.write_end = 0
+
+        while len(self.segments) > 1 and self.disk_bytes() > self.max_bytes:
+            oldest = next(iter(self.segments))
+            if self.committed[0] <= oldest:
+                offset = self.committed[1] if self.committed[0] == oldest else 0
+                for start, end in self.records(oldest, offset):
+                    self.depth_records -= 1
+                    self.depth_bytes -= end - start
+                    self.backlog_peak -= 1 #drain_progress counts published records only
+                    self.counters["evicted"] += 1
+            self.remove_segment(oldest)
+            self.committed = max(self.committed, (oldest + 1, 0))
+            self.read = max(self.read, (oldest + 1, 0))
+            logger.warning("telemetry spool full, evicted segment {}".format(oldest))
+
+    def append(self, request):
+        record = encode_record(request)
+        with self.lock:
+            if not self.opened:
+                self.open()
+            if not self.segments or self.write_end + len(record) > self.segments[next(reversed(self.segments))][2]:
+                self.roll(len(record))
+
+            unused_file, segment_map, unused_size = self.segments[next(reversed(self.segments))]
+            start = self.write_end
+            segment_map[start:start + len(record)] = record
+            page_start = start - start % mmap.ALLOCATIONGRANULARITY
+            segment_map.flush(page_start, start + len(record) - page_start) #on disk before a power loss
+            self.write_end += len(record)
+
+            self.counters["appended"] += 1
+            self.depth_records += 1
+            self.depth_bytes += len(record)
+            self.backlog_peak = max(self.backlog_peak, self.depth_records)
+
+    def take(self, now):
+        with self.lock:
+            if not self.opened:
+                self.open()
+            if len(self.in_flight) >= SPOOL_MAX_IN_FLIGHT:
+                return None
+
+            sequence, offset = self.read
+            if sequence not in self.segments:
+                return None
+            record = self.record_at(sequence, offset)
+            while record is None: #end of the segment, continue with the next one
+                if sequence + 1 not in self.segments:
+                    return None
+                sequence, offset = sequence + 1, 0
+                self.read = (sequence, offset)
+                record = self.record_at(sequence, offset)
+            body, end = record
+
+            if self.drain_rate > 0 and (sequence, offset) < self.backlog_end: #token bucket, at most one second of drain_rate as burst
+                if self.token_time is None:
+                    self.tokens = self.drain_rate
+                else:
+                    self.tokens = min(self.drain_rate, self.tokens + self.drain_rate * (now - self.token_time))
+                self.token_time = now
+                if self.tokens < min(end - offset, self.drain_rate):
+                    return None
+                self.tokens -= end - offset
+
+            self.read = (sequence, end)
+            return decode_body(body), (sequence, offset), (sequence, end)
+
+    def sent(self, info, start, end, now):
+        with self.lock:
+            if info.rc not in (0, 4): #MQTT_ERR_SUCCESS, MQTT_ERR_NO_CONN: queued by paho and sent after the reconnect
+                self.read = min(self.read, start) #not queued, publish again
+                return
+            self.in_flight.append((info, start, end, end[1] - start[1], now))
+
+    def carry_over(self, info, new_info):
+        with self.lock:
+            for index, entry in enumerate(self.in_flight):
+                if entry[0] is info:
+                    self.in_flight[index] = (new_info,) + entry[1:]
+                    return
+
+    def update(self, now):
+        with self.lock:
+            if not self.opened:
+                return
+            while self.in_flight and self.in_flight[0][0].is_published():
+                unused_info, unused_start, end, length, unused_time = self.in_flight.popleft()
+                if end > self.committed: #records of evicted segments are no longer counted
+                    self.committed = end
+                    self.depth_records -= 1
+                    self.depth_bytes -= length
+                    self.counters["acknowledged"] += 1
+
+            if self.in_flight and now - self.in_flight[0][4] > SPOOL_ACK_TIMEOUT:
+                logger.warning("telemetry spool: no acknowledgement for {}s, publishing {} records again".format(SPOOL_ACK_TIMEOUT, len(self.in_flight)))
+                self.counters["republished"] += len(self.in_flight)
+                self.in_flight.clear()
+                self.read = self.committed
+
+            if self.depth_records == 0:
+                self.backlog_peak = 0
+            if self.committed != self.saved and (self.last_commit is None or now - self.last_commit >= SPOOL_COMMIT_INTERVAL):
+                self.commit(now)
+
+    def commit(self, now):
+        """saves the committed position and removes the segments before it, called with the lock held"""
+        try:
+            filepath = os.path.join(self.directory, "offsets.json")
+            with open(filepath + ".tmp", "w") as file:
+                json.dump({"sequence": self.committed[0], "offset": self.committed[1]}, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(filepath + ".tmp", filepath) #no partly written file after a power loss
+            self.saved = self.committed
+            self.last_commit = now
+        except OSError as e:
+            logger.warning("telemetry spool offsets not saved: {}".format(e))
+            return
+
+        while len(self.segments) > 1 and next(iter(self.segments)) < self.committed[0]:
+            self.remove_segment(next(iter(self.segments)))
+
+    def statistics(self):
+        with self.lock:
+            statistics = dict(self.counters)
+            statistics.update({
+                "segments": len(self.segments),
+                "disk_bytes": self.disk_bytes(),
+                "depth_records": self.depth_records,
+                "depth_bytes": self.depth_bytes,
+                "in_flight": len(self.in_flight),
+                "drain_progress": round(1 - self.depth_records / float(self.backlog_peak), 3) if self.backlog_peak else 1.0,
+                "drain_eta_s": round(self.depth_bytes / float(self.drain_rate)) if self.drain_rate > 0 else None,
+            })
+        return statistics
+# [End Class TelemetrySpool]
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""
+ IoT Gateway Modbus
+ (C)2020 - Michael Feil
+ This is distributed under MIT license, see LICENSE
+"""
+
+"""g_telemetry_decoder.py
+
+Function: Reference decoder of the telemetry published on the events topic, for the receiving side in the cloud.
+Standalone, without the other modules of the gateway: copy this file to decode the payloads.
+
+decode_payload(payload) returns the list of samples {"na": display_name, "res": result, "sl": slave_id, "time": seconds}
+of a payload, for every "compression" and "encoding" of setup_mqtt.json.
+
+With "compression": "adaptive" and "compression_dictionary", batches are compressed by zlib with a preset dictionary.
+The gateway publishes every dictionary once on the state topic as {"compression_dictionary": {"id": id, "data": base64 of the dictionary}},
+pass them to register_dictionary before decoding; the zlib header of a batch names the id (adler32) of its dictionary.
+
+Binary batch format ("encoding": "binary", see g_telemetry_encoder), version 1:
+varint: unsigned LEB128, 7 bits per byte, least significant first. zigzag: signed as varint, 0, -1, 1, -2, ... as 0, 1, 2, 3, ...
+    magic b"MBT" and version byte 1
+    varint samples N
+    varint names D, then per name: varint length and utf-8 bytes of the display_name
+    varint time of the first sample, milliseconds since 1970
+    column names: N varints, index of the display_name of the sample
+    column slaves: N varints, slave_id
+    column times: N zigzags, milliseconds since the previous sample (the first sample: 0)
+    column kinds: N bytes, KIND_INT: list of integers, KIND_FLOAT: list of floats, KIND_JSON: any other result
+    column lengths: N varints, values of KIND_INT and KIND_FLOAT, bytes of KIND_JSON
+    column integers: zigzags of all KIND_INT results; minus the value at the same position in the previous KIND_INT result
+                     of the same display_name if that result has the same length
+    column floats: float64 little endian of all KIND_FLOAT results
+    column json: utf-8 JSON of all KIND_JSON results
+"""
+
+#[Start includes]
+import base64
+import gzip
+import json
+import lzma
+import struct
+import zlib
+#[End includes]
+
+#[Start Global Variables]
+MAGIC = b"MBT"
+VERSION = 1
+KIND_INT, KIND_FLOAT, KIND_JSON = 0, 1, 2
+GZIP_MAGIC = b"\x1f\x8b"
+LZMA_MAGIC = b"\xfd7zXZ"
+DICTIONARIES = dict() #adler32 id: preset dictionary of zlib, see register_dictionary
+#[End Global Variables]
+
+
+# [Start Decoder]
+def register_dictionary(data):
+    """registers a preset dictionary (bytes or the base64 text of the state message), returns its id"""
+    if isinstance(data, str):
+        data = base64.b64decode(data)
+    dictionary_id = zlib.adler32(data)
+    DICTIONARIES[dictionary_id] = data
+    return dictionary_id
+
+
+def is_zlib(payload):
+    """True if payload starts with a zlib header (deflate, 32 KiB window), JSON and binary batches never do"""
+    return len(payload) > 2 and payload[0] == 0x78 and (payload[0] * 256 + payload[1]) % 31 == 0
+
+
+def decompress(payload):
+    """payload without gzip, lzma or zlib compression, as bytes"""
+    if isinstance(payload, str):
+        return payload.encode("utf-8")
+    if payload[:2] == GZIP_MAGIC:
+        return gzip.decompress(payload)
+    if payload[:5] == LZMA_MAGIC:
+        return lzma.decompress(payload)
+    if is_zlib(payload):
+        if payload[1] & 0x20: #FDICT: adler32 of the preset dictionary follows
+            dictionary_id = struct.unpack(">I", payload[2:6])[0]
+            if dictionary_id not in DICTIONARIES:
+                raise ValueError("compression dictionary {} not registered".format(dictionary_id))
+            decompressor = zlib.decompressobj(zdict=DICTIONARIES[dictionary_id])
+            return decompressor.decompress(payload) + decompressor.flush()
+        return zlib.decompress(payload)
+    return payload
+
+
+def decode_payload(payload):
+    """list of samples of an events payload, binary or JSON, compressed or not"""
+    data = decompress(payload)
+    if data[:3] == MAGIC:
+        return decode_batch(data)
+    return json.loads(data.decode("utf-8"))
+
+
+class Reader(object):
+    """reads varints and fixed size values from data, starting at offset"""
+
+    def __init__(self, data, offset=0):
+        self.data = data
+        self.offset = offset
+
+    def uvarint(self):
+        data = self.data
+        value = shift = 0
+        while True:
+            byte = data[self.offset]
+            self.offset += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def zigzag(self):
+        value = self.uvarint()
+        return (value >> 1) ^ -(value & 1)
+
+    def take(self, length):
+        chunk = self.data[self.offset:self.offset + length]
+        if len(chunk) != length:
+            raise ValueError("binary telemetry batch truncated")
+        self.offset += length
+        return chunk
+
+
+def decode_batch(data):
+    """list of samples of a binary batch"""
+    if data[:3] != MAGIC or data[3] != VERSION:
+        raise ValueError("no binary telemetry batch of version {}".format(VERSION))
+    reader = Reader(data, 4)
+
+    count = reader.uvarint()
+    names = [reader.take(reader.uvarint()).decode("utf-8") for unused in range(reader.uvarint())]
+    time_ms = reader.uvarint()
+
+    name_indices = [reader.uvarint() for unused in range(count)]
+    slave_ids = [reader.uvarint() for unused in range(count)]
+    times = list()
+    for unused in range(count):
+        time_ms += reader.zigzag()
+        times.append(time_ms / 1000.0)
+    kinds = reader.take(count)
+    lengths = [reader.uvarint() for unused in range(count)]
+
+    results = [None] * count
+    previous = dict() #name index: last KIND_INT result
+    for index in range(count):
+        if kinds[index] != KIND_INT:
+            continue
+        values = [reader.zigzag() for unused in range(lengths[index])]
+        last = previous.get(name_indices[index])
+        if last is not None and len(last) == len(values):
+            values = [value + last_value for value, last_value in zip(values, last)]
+        previous[name_indices[index]] = values
+        results[index] = values
+
+    for index in range(count):
+        if kinds[index] == KIND_FLOAT:
+            results[index] = list(struct.unpack("<{}d".format(lengths[index]), reader.take(8 * lengths[index])))
+
+    for index in range(count):
+        if kinds[index] == KIND_JSON:
+            results[index] = json.loads(reader.take(lengths[index]).decode("utf-8"))
+
+    return [{"na": names[name_indices[index]], "res": results[index], "sl": slave_ids[index], "time": times[index]} for index in range(count)]
+# [End Decoder]
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""
+ IoT Gateway Modbus
+ (C)2020 - Michael Feil
+ This is distributed under MIT license, see LICENSE
+"""
+
+"""g_telemetry_encoder.py
+
+Function: Compact binary encoding of a batch of telemetry samples, instead of JSON, with "encoding": "binary" in setup_mqtt.json.
+
+Every display_name is sent once per batch, timestamps as millisecond deltas, register values as zigzag varints
+(as difference to the previous result of the same operation) and every field in its own column, so the following
+gzip or lzma compression finds long runs of similar bytes. The format and its reference decoder are in g_telemetry_decoder.
+"""
+
+#[Start includes]
+import json
+import struct
+#[End includes]
+
+#[includes own scripts]
+from g_telemetry_decoder import MAGIC, VERSION, KIND_INT, KIND_FLOAT, KIND_JSON
+#[includes own scripts]
+
+
+# [Start Encoder]
+def write_uvarint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def write_zigzag(out, value):
+    write_uvarint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+
+
+def result_kind(result):
+    """KIND_INT, KIND_FLOAT or KIND_JSON of a result"""
+    if not isinstance(result, (list, tuple)):
+        return KIND_JSON
+    kind = KIND_INT
+    for value in result:
+        if isinstance(value, float):
+            kind = KIND_FLOAT
+        elif not isinstance(value, int):
+            return KIND_JSON
+    return kind
+
+
+def encode_batch(samples):
+    """binary batch (bytes) of a list of samples {"na", "res", "sl", "time"}"""
+    names = dict()          #display_name: index
+    name_indices = bytearray()
+    slave_ids = bytearray()
+    times = bytearray()
+    kinds = bytearray()
+    lengths = bytearray()
+    integers = bytearray()
+    floats = list()
+    json_results = list()
+    previous = dict()       #name index: last KIND_INT result
+
+    last_ms = first_ms = int(round(samples[0]["time"] * 1000)) if samples else 0
+    for sample in samples:
+        name_index = names.setdefault(sample["na"], len(names))
+        write_uvarint(name_indices, name_index)
+        write_uvarint(slave_ids, sample["sl"])
+
+        time_ms = int(round(sample["time"] * 1000))
+        write_zigzag(times, time_ms - last_ms)
+        last_ms = time_ms
+
+        result = sample["res"]
+        kind = result_kind(result)
+        kinds.append(kind)
+        if kind == KIND_INT:
+            write_uvarint(lengths, len(result))
+            last = previous.get(name_index)
+            if last is not None and len(last) == len(result):
+                for value, last_value in zip(result, last):
+                    write_zigzag(integers, value - last_value)
+            else:
+                for value in result:
+                    write_zigzag(integers, value)
+            previous[name_index] = result
+        elif kind == KIND_FLOAT:
+            write_uvarint(lengths, len(result))
+            floats.extend(result)
+        else:
+            encoded = json.dumps(result, separators=(",", ":")).encode("utf-8")
+            write_uvarint(lengths, len(encoded))
+            json_results.append(encoded)
+
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    write_uvarint(out, len(samples))
+    write_uvarint(out, len(names))
+    for name in names:
+        encoded = name.encode("utf-8")
+        write_uvarint(out, len(encoded))
+        out += encoded
+    write_uvarint(out, first_ms)
+    for column in (name_indices, slave_ids, times, kinds, lengths, integers):
+        out += column
+    out += struct.pack("<{}d".format(len(floats)), *floats)
+    for encoded in json_results:
+        out += encoded
+    return bytes(out)
+# [End Encoder]
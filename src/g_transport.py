@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+
+"""
+ IoT Gateway Modbus
+ (C)2020 - Michael Feil 
+ This is distributed under MIT license, see LICENSE
+"""
+
+"""g_transport.py
+
+Function: Modbus TCP and Modbus RTU over TCP transports for the Modbus_reader, next to Modbus RTU over a serial port (modbus_tk).
+
+Connections are kept open per remote gateway (type, host, tcp_port) in the connection_pool, shared by all ports of the setup_modbus.json.
+Modbus TCP requests can be pipelined: up to "max_pipeline" requests are sent back to back with their own transaction ids, 
+before the responses are read and matched by transaction id. Use "max_pipeline": 1 for servers which do not allow it.
+Every request waits for its own response timeout, a request without response does not fail the other requests of the pipeline.
+Modbus RTU over TCP has no transaction ids and is never pipelined.
+"""
+
+#[Start includes]
+import socket
+import struct
+import threading
+import time
+
+#Modbus Test Kit is licensed under LGPL Licence and available at https://pypi.org/project/modbus_tk/
+from modbus_tk import utils
+from modbus_tk.exceptions import ModbusError, ModbusInvalidResponseError, ModbusFunctionNotSupportedError
+#[End includes]
+
+#[includes own scripts]
+from g_shared_utils import logger
+#[includes own scripts]
+
+#[Start Global Variables]
+DEFAULT_TCP_PORT = 502
+#[End Global Variables]
+
+
+# [Start PDU]
+def build_request_pdu(request):
+    """Modbus PDU of a request dict (function_code, startadress, quantity_of_x or output_value)"""
+    function_code = request["function_code"]
+    startadress = request["startadress"]
+
+    if function_code in (1, 2, 3, 4):
+        return struct.pack(">BHH", function_code, startadress, request["quantity_of_x"])
+    elif function_code == 5:
+        return struct.pack(">BHH", function_code, startadress, 0xff00 if request["output_value"] else 0)
+    elif function_code == 6:
+        return struct.pack(">BH" + ("H" if request["output_value"] >= 0 else "h"), function_code, startadress, request["output_value"])
+    elif function_code == 15:
+        bits = request["output_value"]
+        packed = bytearray((len(bits) + 7) // 8)
+        for i, bit in enumerate(bits):
+            if bit:
+                packed[i // 8] |= 1 << (i % 8)
+        return struct.pack(">BHHB", function_code, startadress, len(bits), len(packed)) + bytes(packed)
+    elif function_code == 16:
+        values = request["output_value"]
+        return struct.pack(">BHHB", function_code, startadress, len(values), 2 * len(values)) + \
+            b"".join(struct.pack(">H" if value >= 0 else ">h", value) for value in values)
+    raise ModbusFunctionNotSupportedError("The {0} function code is not supported. ".format(function_code))
+
+
+def response_pdu_length(request):
+    """length of the response PDU of a successful request"""
+    function_code = request["function_code"]
+    if function_code in (1, 2):
+        return 2 + (request["quantity_of_x"] + 7) // 8
+    elif function_code in (3, 4):
+        return 2 + 2 * request["quantity_of_x"]
+    return 5
+
+
+def parse_response_pdu(request, pdu):
+    """result tuple of a response PDU as returned by modbus_tk, raises ModbusError for exception responses"""
+    function_code = request["function_code"]
+
+    if pdu[0] == function_code | 0x80:
+        raise ModbusError(pdu[1])
+    if pdu[0] != function_code or len(pdu) != response_pdu_length(request):
+        raise ModbusInvalidResponseError("Invalid response {!r} to function code {}".format(pdu, function_code))
+
+    if function_code in (1, 2):
+        quantity = request["quantity_of_x"]
+        return tuple((pdu[2 + i // 8] >> (i % 8)) & 1 for i in range(quantity))
+    elif function_code in (3, 4):
+        return struct.unpack(">{}H".format(request["quantity_of_x"]), pdu[2:])
+    return struct.unpack(">HH", pdu[1:5])
+
+
+def build_rtu_frame(request):
+    """Modbus RTU frame of a request: slave id, PDU and CRC"""
+    data = struct.pack(">B", request["slave_id"]) + build_request_pdu(request)
+    return data + struct.pack(">H", utils.calculate_crc(data))
+
+
+def rtu_frame_length(request, header):
+    """length of the RTU response frame to request, from its first two bytes (slave id, function code)"""
+    if header[1] & 0x80:
+        return 5
+    return 1 + response_pdu_length(request) + 2
+
+
+def rtu_frame_pdu(frame):
+    """PDU of a RTU response frame, raises ModbusInvalidResponseError if the CRC is invalid"""
+    if struct.pack(">H", utils.calculate_crc(frame[:-2])) != frame[-2:]:
+        raise ModbusInvalidResponseError("Invalid CRC in RTU response")
+    return frame[1:-2]
+# [End PDU]
+
+
+def expire(in_flight, results, timeouts, sent, deadline, timeout_error):
+    """sets timeout_error as result of the requests in flight which are due at deadline, used by execute_pipelined"""
+    for transaction_id, index in list(in_flight.items()):
+        if sent + timeouts[index] <= deadline:
+            results[index] = timeout_error
+            del in_flight[transaction_id]
+
+
+# [Start Class TcpMaster]
+class TcpMaster(object):
+    """
+    Modbus TCP or Modbus RTU over TCP master on a persistent connection, thread safe.
+    Offers execute(), set_timeout() and set_verbose() like the modbus_tk masters.
+        ...
+
+    Attributes
+    ----------
+    framing : str
+        "tcp": MBAP header with transaction id, "rtu_over_tcp": RTU frames with CRC
+    
+    Methods
+    -------
+    open(), close()
+        Opens or closes the connection, execute opens it if needed 
+    execute(slave, function_code, starting_address, quantity_of_x=0, output_value=0)
+        Executes a single request, returns the result tuple
+    execute_pipelined(requests, max_pipeline, timeouts=None)
+        Executes request dicts with up to max_pipeline in flight, returns results, ModbusError or socket.timeout instances
+    """
+
+    def __init__(self, host, tcp_port=DEFAULT_TCP_PORT, framing="tcp", timeout=5.0):
+        self.host = host
+        self.tcp_port = tcp_port
+        self.framing = framing
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = bytearray()   #received bytes of responses not yet complete
+        self.lock = threading.RLock()
+        self.transaction_id = 0
+
+    def open(self):
+        with self.lock:
+            if self.sock is None:
+                self.sock = socket.create_connection((self.host, self.tcp_port), timeout=self.timeout)
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                logger.debug("connected {} to {}:{}".format(self.framing, self.host, self.tcp_port))
+
+    def close(self):
+        with self.lock:
+            if self.sock is not None:
+                try:
+                    self.sock.close()
+                finally:
+                    self.sock = None
+                    self.buffer = bytearray()
+
+    def set_timeout(self, timeout_in_sec):
+        self.timeout = timeout_in_sec
+        if self.sock is not None:
+            self.sock.settimeout(timeout_in_sec)
+
+    def set_verbose(self, verbose):
+        pass
+
+    def execute(self, slave, function_code, starting_address, quantity_of_x=0, output_value=0):
+        request = {"slave_id": slave, "function_code": function_code, "startadress": starting_address, 
+                   "quantity_of_x": quantity_of_x, "output_value": output_value}
+        result = self.execute_pipelined([request], 1)[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def execute_pipelined(self, requests, max_pipeline, timeouts=None):
+        """executes the request dicts, returns list of result tuples, ModbusError or socket.timeout instances in the order of requests
+        
+        timeouts: response timeout of every request, default self.timeout. A request without response in time gets a 
+        socket.timeout instance as result, the other requests are still executed. Connection errors close the connection and are raised.
+        """
+        if self.framing != "tcp":
+            max_pipeline = 1
+        if timeouts is None:
+            timeouts = [self.timeout] * len(requests)
+
+        results = [None] * len(requests)
+        with self.lock:
+            try:
+                for chunk_start in range(0, len(requests), max_pipeline):
+                    self.open()
+                    in_flight = dict()      #transaction id: index of request
+                    frames = list()
+                    for index in range(chunk_start, min(chunk_start + max_pipeline, len(requests))):
+                        self.transaction_id = (self.transaction_id + 1) % 0x10000
+                        in_flight[self.transaction_id] = index
+                        frames.append(self.build_frame(self.transaction_id, requests[index]))
+                    self.sock.settimeout(self.timeout)
+                    self.sock.sendall(b"".join(frames))
+                    sent = time.monotonic()
+
+                    while in_flight:
+                        deadline = sent + min(timeouts[index] for index in in_flight.values())
+                        try:
+                            transaction_id, pdu = self.receive_frame(requests[min(in_flight.values())], deadline)
+                        except socket.timeout as e:
+                            expire(in_flight, results, timeouts, sent, deadline, e)
+                            if self.framing != "tcp": #a late response would be taken as the response to the next request
+                                self.close()
+                            continue
+                        index = in_flight.pop(transaction_id if self.framing == "tcp" else min(in_flight), None)
+                        if index is None: #response to an earlier request, e.g. after a timeout
+                            continue
+                        try:
+                            results[index] = parse_response_pdu(requests[index], pdu)
+                        except ModbusError as e:
+                            results[index] = e
+            except Exception:
+                self.close()
+                raise
+        return results
+
+    def build_frame(self, transaction_id, request):
+        if self.framing == "tcp":
+            pdu = build_request_pdu(request)
+            return struct.pack(">HHHB", transaction_id, 0, len(pdu) + 1, request["slave_id"]) + pdu
+        return build_rtu_frame(request)
+
+    def receive_frame(self, request, deadline):
+        """returns (transaction id, PDU) of the next response, raises socket.timeout at deadline (time.monotonic())
+        
+        request is needed to know the length of RTU over TCP responses. Bytes of an incomplete response stay in the buffer.
+        """
+        frame = self.buffered_frame(request)
+        while frame is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("No response from {}:{}".format(self.host, self.tcp_port))
+            self.sock.settimeout(remaining)
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise ModbusInvalidResponseError("Connection closed by {}:{}".format(self.host, self.tcp_port))
+            self.buffer += chunk
+            frame = self.buffered_frame(request)
+        return frame
+
+    def buffered_frame(self, request):
+        """takes (transaction id, PDU) of the next response from the buffer, None if it is not complete yet"""
+        if self.framing == "tcp":
+            if len(self.buffer) < 7:
+                return None
+            transaction_id, unused_protocol, length, unused_unit = struct.unpack_from(">HHHB", self.buffer)
+            if len(self.buffer) < 6 + length:
+                return None
+            return transaction_id, self.take(6 + length)[7:]
+
+        if len(self.buffer) < 2: #slave id, function code
+            return None
+        length = rtu_frame_length(request, self.buffer)
+        if len(self.buffer) < length:
+            return None
+        return None, rtu_frame_pdu(self.take(length))
+
+    def take(self, size):
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+# [End Class TcpMaster]
+
+
+# [Start Class ConnectionPool]
+class ConnectionPool(object):
+    """
+    One TcpMaster per remote gateway (type, host, tcp_port), shared by all ports using it and closed when the last port releases it.
+    master_class: TcpMaster or a subclass with the same constructor, e.g. the AsyncTcpMaster of g_async_runtime
+    """
+
+    def __init__(self, master_class=TcpMaster):
+        self.master_class = master_class
+        self.lock = threading.Lock()
+        self.masters = dict()      #(type, host, tcp_port): [TcpMaster, number of users]
+
+    def acquire(self, port_config):
+        key = (port_config["type"], port_config["host"], port_config.get("tcp_port", DEFAULT_TCP_PORT))
+        with self.lock:
+            if key not in self.masters:
+                self.masters[key] = [self.master_class(key[1], key[2], framing=key[0], timeout=port_config["timeout_connection"]), 0]
+            self.masters[key][1] += 1
+            return self.masters[key][0]
+
+    def release(self, master):
+        with self.lock:
+            for key, (pooled_master, users) in list(self.masters.items()):
+                if pooled_master is master:
+                    if users <= 1:
+                        del self.masters[key]
+                        master.close()
+                    else:
+                        self.masters[key][1] = users - 1
+                    return
+# [End Class ConnectionPool]
+
+connection_pool = ConnectionPool() #shared by all Modbus_readers
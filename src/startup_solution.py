@@ -10,15 +10,16 @@ Starts up the Gateway solution"""
 
 
 # [START includes]
-import queue
 import sys, os
 import time
+import asyncio
 
 dirname = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(dirname)                                #only needed if not executing in current directory
 
-from g_modbus import Scheduler, Modbus_reader
-from g_mqtt_client import handle_mqtt
+from g_modbus import Scheduler, Modbus_readers
+from g_mqtt_client import handle_mqtt, FAST_START, RUNTIME, EVENTS_RATE, STATE_RATE, REPLY_RATE
+from g_publish_lanes import PublishLanes
 import g_shared_utils as su
 from g_shared_utils import logger
 # [End includes]
@@ -27,20 +28,24 @@ from g_shared_utils import logger
 def main():
     logger.debug("Starting Application")
     
-    timing_queue = queue.Queue(maxsize=100)                                                 #everything that lands here will get requested from the modbus
-    publishing_queue = queue.Queue(maxsize=100)                                              #everything that lands here will get send to the cloud (telemetry, statusupdates, errors)
+    publishing_queue = PublishLanes(maxsize=100, events_rate=EVENTS_RATE, state_rate=STATE_RATE, reply_rate=REPLY_RATE) #everything that lands here will get send to the cloud (telemetry, statusupdates, errors), one lane each
     
-    schedule = Scheduler(timing_queue, publishing_queue)                                    #making sure to fill requests for the modbus_reader according to documentation
-    modbus_client = Modbus_reader(timing_queue, publishing_queue)                           #making sure to fullfill all modbus_reader requests from timing_queue and gives them to handle_mqtt
+    modbus_client = Modbus_readers(publishing_queue, queue_size=100)                        #one Modbus_reader and timing queue per port, fullfills all requests and gives them to handle_mqtt
+    schedule = Scheduler(modbus_client, publishing_queue)                                   #making sure to fill requests in the timing queue of their port according to documentation
     mqtt_handler = handle_mqtt(publishing_queue, schedule, modbus_client)                    #making sure to renew cloud connection
 
     schedule.daemon = True
     modbus_client.daemon = True
     mqtt_handler.daemon = True
 
-    mqtt_handler.start()
-    schedule.start() 
-    modbus_client.start() 
+    if FAST_START: #first samples are read while the MQTT connection is set up
+        modbus_client.start() 
+        schedule.start() 
+        mqtt_handler.start()
+    else:
+        mqtt_handler.start()
+        schedule.start() 
+        modbus_client.start() 
 
     # endless loop
     while True:
@@ -49,5 +54,13 @@ def main():
         
     logger.info("Quitting Application")
 
+def main_asyncio():
+    """Runs the Gateway in one asyncio event loop instead of threads, see g_async_runtime"""
+    from g_async_runtime import run_gateway
+    asyncio.run(run_gateway())
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if RUNTIME == "asyncio":
+        main_asyncio()
+    else:
+        main()
\ No newline at end of file